@@ -1,175 +1,120 @@
-# Monkey-patch deve ser o primeiro import para modo gevent (producao)
-try:
-    from gevent import monkey
-    monkey.patch_all()
-except ImportError:
-    pass
-
+# Monkey-patch deve ser o primeiro import para modo gevent (opcional: so quando o
+# pacote gevent esta instalado; requirements.txt nao o inclui, entao o Render roda
+# em threads). GEVENT=0 desliga (padrao quando FLASK_DEBUG=1)
 import os
+if os.getenv('GEVENT', '0' if os.getenv('FLASK_DEBUG', '0') == '1' else '1') == '1':
+    try:
+        from gevent import monkey
+        monkey.patch_all()
+    except ImportError:
+        pass
+
 import logging
 import time
 import json
 import re
+import random
+import hmac
+import atexit
+import hashlib
+import shelve
+import functools
 import urllib.request
 import urllib.error
 from typing import List, Dict, Any
 from datetime import datetime, timedelta
 from threading import Thread
 import threading
+import queue
 from concurrent.futures import ThreadPoolExecutor, as_completed
-import firebase_admin
-from firebase_admin import credentials, firestore
+from collections import Counter, deque
+from firebase_admin import firestore
 from openai import OpenAI
+from werkzeug.middleware.proxy_fix import ProxyFix
 import openai as _openai_module
 from dotenv import load_dotenv
 from flask import Flask, request, jsonify, render_template, Response, session, redirect, url_for, send_file
 from flask_socketio import SocketIO, emit
 from flask_cors import CORS
 
-# Tipos Firestore especiais
-try:
-    from google.cloud.firestore_v1 import DocumentReference, GeoPoint
-except Exception:
-    try:
-        from google.cloud.firestore_v1 import DocumentReference
-        from google.cloud.firestore_v1._helpers import GeoPoint
-    except Exception:
-        DocumentReference = None
-        GeoPoint = None
-
-try:
-    from google.api_core.datetime_helpers import DatetimeWithNanoseconds
-except Exception:
-    DatetimeWithNanoseconds = None
-
-try:
-    from google.protobuf.timestamp_pb2 import Timestamp as ProtoTimestamp
-except Exception:
-    ProtoTimestamp = None
-
 # Configuração e extensões extraídas para módulos separados
-from config import logger, SECRET_KEY
-from extensions import init_extensions, init_firebase, get_db, _reload_openai_client, _is_quota_error, emit_quota_exceeded
-from utils import (to_json_safe, firestore_default, safe_sample, get_today_stats, record_daily_usage,
+from config import (logger, SECRET_KEY, FALLBACK_ADMIN_USER, FALLBACK_ADMIN_PASS,
+                    CATEGORIZER_MAX_WORKERS, OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT)
+import extensions as _ext
+from extensions import (init_extensions, init_firebase, get_db, _reload_openai_client, reload_openai_client_async,
+                        _is_quota_error, emit_quota_exceeded)
+from utils import (to_json_safe, firestore_default, get_today_stats, record_daily_usage, stats_version,
                    get_all_stats, automation_state, explorer_state, categorizer_state,
-                   categorizer_targeted_state, tagger_state, undo_store, _undo_lock)
+                   categorizer_targeted_state, tagger_state, undo_store, _undo_locks, reset_progress,
+                   queue_log_emit, queue_progress_emit, progress_changed, chunked, _dumps)
 
 app = Flask(__name__)
+# Atras de exatamente um proxy (Render): remote_addr passa a ser o IP que ele anexou
+# ao X-Forwarded-For; valores extras enviados pelo cliente sao ignorados
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
 app.config['SECRET_KEY'] = SECRET_KEY
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=30)
 
 # Inicializa socketio, CORS e OpenAI client (setados no módulo extensions)
 init_extensions(app)
-from extensions import socketio, openai_client  # disponíveis após init_extensions
+from extensions import socketio  # disponível após init_extensions
+# openai_client e lido sempre via _ext.openai_client para enxergar recargas da chave
 
 # ============================================================
 # Firebase compartilhado
 # ============================================================
+# Client singleton de extensions.init_firebase, atribuido por init_all
 db = None
 
-def init_firebase():
-    global db
-    if not firebase_admin._apps:
-        # 1. JSON inline (preferido em producao/Render — cole o conteudo do JSON como env var)
-        creds_json = os.getenv('FIREBASE_CREDENTIALS_JSON', '').strip()
-        if creds_json:
-            creds_dict = json.loads(creds_json)
-            cred = credentials.Certificate(creds_dict)
-            firebase_admin.initialize_app(cred)
-        # 2. Caminho para arquivo (desenvolvimento local)
-        elif os.getenv('FIREBASE_CREDENTIALS_PATH') and os.path.exists(os.getenv('FIREBASE_CREDENTIALS_PATH')):
-            cred = credentials.Certificate(os.getenv('FIREBASE_CREDENTIALS_PATH'))
-            firebase_admin.initialize_app(cred)
-        # 3. Application Default Credentials (Google Cloud / fallback)
-        else:
-            firebase_admin.initialize_app()
-    db = firestore.client()
-    return db
-
 # ============================================================
-# Serializadores JSON
+# Estado global
 # ============================================================
-def to_json_safe(value):
-    """Converte recursivamente tipos do Firestore em algo serializavel."""
-    if DatetimeWithNanoseconds and isinstance(value, DatetimeWithNanoseconds):
-        return value.isoformat()
-    if isinstance(value, datetime):
-        return value.isoformat()
-    if GeoPoint and isinstance(value, GeoPoint):
-        return {"_type": "GeoPoint", "latitude": float(value.latitude), "longitude": float(value.longitude)}
-    if hasattr(value, "latitude") and hasattr(value, "longitude") and \
-       isinstance(getattr(value, "latitude"), (int, float)) and \
-       isinstance(getattr(value, "longitude"), (int, float)):
-        return {"_type": "GeoPoint", "latitude": float(value.latitude), "longitude": float(value.longitude)}
-    if DocumentReference and isinstance(value, DocumentReference):
-        return {"_type": "DocumentReference", "path": value.path}
-    if hasattr(value, "path") and hasattr(value, "parent") and hasattr(value, "id"):
-        try:
-            return {"_type": "DocumentReference", "path": str(value.path)}
-        except Exception:
-            pass
-    if isinstance(value, (bytes, bytearray, memoryview)):
+# Estados e undo_store importados de utils.py — compartilhados com automator.py e categorizer.py
+
+# Execucoes longas disparadas pelas rotas /start: JOB_POOL_WORKERS threads fixas
+# consomem uma fila (sem thread nova por requisicao). Threads daemon, como antes:
+# Ctrl-C ou o fim do processo nao ficam presos esperando uma categorizacao terminar.
+JOB_POOL_WORKERS = 8
+_job_queue = queue.Queue()
+# Jobs na fila ou rodando, por nome (renamer, categorizer...): um segundo /start do
+# mesmo modulo e recusado mesmo antes de o job marcar state['running']
+_active_jobs = set()
+_active_jobs_lock = threading.Lock()
+# Na saida do processo, jobs que ainda estao na fila nao comecam mais
+_jobs_stopping = threading.Event()
+atexit.register(_jobs_stopping.set)
+
+
+def _job_worker():
+    while True:
+        name, fn = _job_queue.get()
         try:
-            return {"_type": "bytes", "base16": bytes(value).hex()}
-        except Exception:
-            return {"_type": "bytes", "len": len(value)}
-    if isinstance(value, dict):
-        return {str(k): to_json_safe(v) for k, v in value.items()}
-    if isinstance(value, (list, tuple, set)):
-        return [to_json_safe(v) for v in list(value)]
-    try:
-        json.dumps(value)
-        return value
-    except Exception:
-        return str(value)
+            if not _jobs_stopping.is_set():
+                fn()
+        except Exception as e:
+            logger.error(f"Erro em job de background ({name}): {e}")
+        finally:
+            with _active_jobs_lock:
+                _active_jobs.discard(name)
 
 
-def firestore_default(obj):
-    """Serializador para json.dumps(default=...)."""
-    if 'GeoPoint' in obj.__class__.__name__ if hasattr(obj, '__class__') else False:
-        try:
-            lat = getattr(obj, 'latitude', None) or getattr(obj, '_latitude', None)
-            lng = getattr(obj, 'longitude', None) or getattr(obj, '_longitude', None)
-            return {"_type": "GeoPoint", "latitude": float(lat), "longitude": float(lng)}
-        except Exception:
-            return {"_type": "GeoPoint", "repr": str(obj)}
-    try:
-        if DocumentReference and isinstance(obj, DocumentReference):
-            return {"_type": "DocumentReference", "path": obj.path}
-    except Exception:
-        pass
-    if ProtoTimestamp is not None and isinstance(obj, ProtoTimestamp):
-        try:
-            return obj.ToJsonString()
-        except Exception:
-            pass
-    if isinstance(obj, datetime):
-        return obj.isoformat()
-    if isinstance(obj, (bytes, bytearray, memoryview)):
-        try:
-            return {"_type": "bytes", "base16": bytes(obj).hex()}
-        except Exception:
-            return {"_type": "bytes", "len": len(obj)}
-    if isinstance(obj, (set, tuple)):
-        return list(obj)
-    try:
-        return str(obj)
-    except Exception:
-        return "<unserializable>"
+for _i in range(JOB_POOL_WORKERS):
+    Thread(target=_job_worker, daemon=True, name=f'job-{_i}').start()
 
 
-def safe_sample(value):
-    try:
-        return json.loads(json.dumps(value, default=firestore_default))
-    except Exception:
-        s = str(value)
-        return s[:100] + ("..." if len(s) > 100 else "")
+def submit_job(name, fn):
+    """Enfileira fn; False (sem enfileirar) se ja ha um job `name` na fila ou rodando."""
+    with _active_jobs_lock:
+        if name in _active_jobs:
+            return False
+        _active_jobs.add(name)
+    _job_queue.put((name, fn))
+    return True
 
 
-# ============================================================
-# Estado global
-# ============================================================
-# Estados e undo_store importados de utils.py — compartilhados com automator.py e categorizer.py
+def job_queue_depth():
+    """Jobs aguardando um worker livre."""
+    return _job_queue.qsize()
 
 
 from automator import FirestoreProductAutomator
@@ -177,58 +122,238 @@ from tagger import ProductTagger
 
 
 # ============================================================
-# Classe: FirestoreStructureExplorer (avancado)
+# Exploradores (avancado e rapido)
+# ============================================================
 from explorer import FirestoreStructureExplorer, FirestoreSimpleExplorer
 
 
 # ============================================================
-# Classe: FirestoreSimpleExplorer (rapido)
+# Estimativa de tokens (tiktoken opcional)
 # ============================================================
-class FirestoreSimpleExplorer:
-    def __init__(self, db_client):
-        self.db = db_client
-
-    def parse_path(self, path: str):
-        path = path.strip('/')
-        return path.split('/') if path else []
-
-    def explore_collection(self, collection_ref, max_docs=5):
-        docs_out = []
-        docs = collection_ref.limit(max_docs).stream()
-        for doc in docs:
-            raw = doc.to_dict() or {}
-            docs_out.append({"id": doc.id, "fields": to_json_safe(raw)})
-        return docs_out
-
-    def explore_document(self, doc_ref):
-        doc = doc_ref.get()
-        if not doc.exists:
-            return {}
-        raw = doc.to_dict() or {}
-        return {"id": doc.id, "fields": to_json_safe(raw)}
-
-    def explore(self, path: str, max_docs=5):
-        components = self.parse_path(path)
-        if not components:
-            return {"error": "Caminho vazio"}
-        is_collection_path = len(components) % 2 == 1
-        if is_collection_path:
-            collection_ref = self.db.collection(components[0])
-            for i in range(1, len(components), 2):
-                if i + 1 < len(components):
-                    collection_ref = collection_ref.document(components[i]).collection(components[i + 1])
-            return {"collection": components[-1] if components else "", "documents": self.explore_collection(collection_ref, max_docs)}
-        else:
-            doc_ref = self.db.collection(components[0])
-            for i in range(1, len(components), 2):
-                doc_ref = doc_ref.document(components[i])
-                if i + 1 < len(components):
-                    doc_ref = doc_ref.collection(components[i + 1])
-            return {"document": components[-1], "data": self.explore_document(doc_ref)}
+@functools.lru_cache(maxsize=1)
+def _get_encoding():
+    try:
+        import tiktoken
+        return tiktoken.encoding_for_model('gpt-4o-mini')
+    except Exception:
+        return None
+
+
+def estimate_tokens(text):
+    """Tokens do texto pelo tokenizer do modelo; sem tiktoken, aproxima por len/4."""
+    enc = _get_encoding()
+    if enc is None:
+        return len(text) // 4
+    return len(enc.encode(text))
+
+
+# ============================================================
+# Limite proativo de taxa da OpenAI
+# ============================================================
+class TokenBucket:
+    """Baldes de requisicoes e tokens por minuto que reabastecem continuamente;
+    acquire() dorme ate haver capacidade, em vez de disparar e tomar 429."""
+
+    def __init__(self, rpm, tpm):
+        self.rpm = float(rpm)
+        self.tpm = float(tpm)
+        self._requests = self.rpm
+        self._tokens = self.tpm
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens):
+        tokens = min(tokens, self.tpm)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                elapsed = now - self._last
+                self._last = now
+                self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60.0)
+                self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60.0)
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                wait = max((1 - self._requests) * 60.0 / self.rpm,
+                           (tokens - self._tokens) * 60.0 / self.tpm)
+            time.sleep(wait)
+
+
+openai_rate_limiter = TokenBucket(OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT)
+
+
+# ============================================================
+# Cache persistente de categorizacao
+# ============================================================
+# nome normalizado + versao do catalogo -> (cat_id, sub_id); evita pagar a IA
+# de novo por produtos repetidos entre execucoes. O shelve local e a primeira
+# camada; o Firestore (Automacoes/categorizer_cache) sobrevive a redeploys e e
+# compartilhado entre instancias.
+CAT_CACHE_FILE = 'cat_cache.db'
+CAT_CACHE_REMOTE_MAX_WRITES = 500  # limite de operacoes por WriteBatch
+_cat_cache = None
+_cat_cache_lock = threading.Lock()
+
+
+def _cat_cache_db():
+    """Abre o shelve na primeira utilizacao. Deve ser chamado com _cat_cache_lock."""
+    global _cat_cache
+    if _cat_cache is None:
+        _cat_cache = shelve.open(CAT_CACHE_FILE)
+        atexit.register(_cat_cache.close)
+    return _cat_cache
+
+
+_NAME_SPACES_RE = re.compile(r'\s+')
+_NAME_SIZE_RE = re.compile(r'\b\d+(?:[.,]\d+)?\s*(?:g|gr|kg|mg|ml|l|lt|un|und)\b')
+
+
+def normalize_product_name(name):
+    """Nome usado para agrupar produtos equivalentes: minusculo, sem tamanho/peso
+    (ex: '500g', '2 L') e com espacos colapsados."""
+    text = _NAME_SIZE_RE.sub(' ', (name or '').lower())
+    return _NAME_SPACES_RE.sub(' ', text).strip() or (name or '').lower().strip()
+
+
+def _cat_cache_key(name, catalog_hash):
+    return hashlib.sha1(normalize_product_name(name).encode('utf-8')).hexdigest() + '|' + catalog_hash
+
+
+def _cat_cache_remote():
+    """Colecao do cache no Firestore, ou None se o Firebase ainda nao foi iniciado."""
+    if _ext._db is None:
+        return None
+    return _ext._db.collection('Automacoes').document('categorizer_cache').collection('itens')
+
+
+def cat_cache_get_many(names, catalog_hash):
+    """Retorna {indice: (cat_id, sub_id)} para os nomes ja categorizados."""
+    hits = {}
+    missing = {}
+    try:
+        with _cat_cache_lock:
+            db = _cat_cache_db()
+            for i, name in enumerate(names):
+                key = _cat_cache_key(name, catalog_hash)
+                value = db.get(key)
+                if value is not None:
+                    hits[i] = value
+                else:
+                    missing.setdefault(key, []).append(i)
+    except Exception as e:
+        logger.warning(f"Cache de categorizacao indisponivel: {e}")
+    col = _cat_cache_remote()
+    if not missing or col is None:
+        return hits
+    # Segunda camada: uma leitura em lote no Firestore, copiada para o shelve
+    found = {}
+    try:
+        for snap in _ext._db.get_all([col.document(key) for key in missing]):
+            data = snap.to_dict() if snap.exists else None
+            if data and data.get('sub_id'):
+                found[snap.id] = (data.get('cat_id'), data['sub_id'])
+    except Exception as e:
+        logger.warning(f"Cache remoto de categorizacao indisponivel: {e}")
+        return hits
+    if found:
+        try:
+            with _cat_cache_lock:
+                db = _cat_cache_db()
+                for key, value in found.items():
+                    db[key] = value
+        except Exception as e:
+            logger.warning(f"Falha ao gravar cache de categorizacao: {e}")
+        for key, value in found.items():
+            for i in missing[key]:
+                hits[i] = value
+    return hits
+
+
+def cat_cache_put_many(items, catalog_hash):
+    """Grava [(nome, (cat_id, sub_id)), ...] ignorando resultados vazios."""
+    entries = {_cat_cache_key(name, catalog_hash): tuple(value)
+               for name, value in items if value and value[1]}
+    if not entries:
+        return
+    try:
+        with _cat_cache_lock:
+            db = _cat_cache_db()
+            for key, value in entries.items():
+                db[key] = value
+            db.sync()
+    except Exception as e:
+        logger.warning(f"Falha ao gravar cache de categorizacao: {e}")
+    col = _cat_cache_remote()
+    if col is None:
+        return
+    try:
+        keys = list(entries)
+        for start in range(0, len(keys), CAT_CACHE_REMOTE_MAX_WRITES):
+            batch = _ext._db.batch()
+            for key in keys[start:start + CAT_CACHE_REMOTE_MAX_WRITES]:
+                cat_id, sub_id = entries[key]
+                batch.set(col.document(key), {'cat_id': cat_id, 'sub_id': sub_id})
+            batch.commit()
+    except Exception as e:
+        logger.warning(f"Falha ao gravar cache remoto de categorizacao: {e}")
+
+
+# Respostas cruas da IA por prompt completo (modelo + system + user + parametros):
+# repetir uma execucao (ex: dry run e depois a real) nao paga a IA de novo. Cobre as
+# chamadas que nao passam pelo cache por nome (revisao, mercearia, fase 2 do dirigido).
+LLM_CACHE_TTL = 7 * 24 * 3600
+_LLM_CACHE_PREFIX = 'llm|'
+
+
+def llm_cache_key(*parts):
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return _LLM_CACHE_PREFIX + hashlib.blake2b(raw.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def llm_cache_get(key):
+    try:
+        with _cat_cache_lock:
+            value = _cat_cache_db().get(key)
+    except Exception as e:
+        logger.warning(f"Cache de respostas indisponivel: {e}")
+        return None
+    if value is None:
+        return None
+    if time.time() - value[0] > LLM_CACHE_TTL:
+        # Expirada: remove na leitura para o arquivo do shelve nao crescer sem fim
+        try:
+            with _cat_cache_lock:
+                _cat_cache_db().pop(key, None)
+        except Exception:
+            pass
+        return None
+    return value[1]
+
+
+def llm_cache_put(key, text):
+    try:
+        with _cat_cache_lock:
+            db = _cat_cache_db()
+            db[key] = (time.time(), text)
+            db.sync()
+    except Exception as e:
+        logger.warning(f"Falha ao gravar cache de respostas: {e}")
 
 
-from categorizer import ProductCategorizerAgent
 class ProductCategorizerAgent:
+    # Lotes processados em paralelo no modo dirigido e teto de chamadas OpenAI
+    # simultaneas (compartilhado entre execucoes; threads reais, ou greenlets se o gevent estiver ativo)
+    PHASE_WORKERS = 4
+    # Threads do pool compartilhado: um run completo (ate 16 lotes) + um dirigido + cargas
+    POOL_WORKERS = 24
+    _openai_slots = threading.BoundedSemaphore(8)
+    # Rate limits recentes (monotonic) e pausa global: com varios 429 seguidos
+    # todos os workers esperam juntos em vez de repetir a chamada e tomar outro 429
+    _rl_events = deque(maxlen=16)
+    _rl_lock = threading.Lock()
+    _rl_pause_until = 0.0
+
     DEFAULT_CAT_SYSTEM_PROMPT = (
         "Voce e um especialista em categorizacao de produtos de supermercado.\n"
         "Responda APENAS com o ID solicitado, sem explicacoes, sem pontuacao extra.\n"
@@ -755,16 +880,57 @@ class ProductCategorizerAgent:
         """Remove pares de Dúvidas da lista de resultados."""
         return [(c, s) for c, s in pairs if not self._is_duvidas(c, s)]
 
-    def __init__(self, db_client):
-        self.db = db_client
-        self.tokens_used = 0
-        self.estimated_cost = 0
+    def __init__(self, db_client=None):
+        self.db = db_client if db_client is not None else get_db()
+        # Contadores de uso (in/out/cached); custo calculado na leitura. Lock proprio
+        # (curto, so para os incrementos) para nao disputar self._lock com o progresso
+        self._usage = Counter()
+        self._usage_lock = threading.Lock()
+        # Sinal de parada do polling do Batch API (setado por stop_batchapi)
+        self._batchapi_stop = threading.Event()
         self.input_token_cost  = 0.00015 / 1000   # gpt-4o-mini: $0.15/1M input
         self.output_token_cost = 0.00060 / 1000   # gpt-4o-mini: $0.60/1M output
         self._lock = threading.Lock()
+        # Pool de threads unico para todas as execucoes (cargas e lotes); o limite de
+        # paralelismo de cada execucao e aplicado em _run_parallel
+        self._pool = ThreadPoolExecutor(max_workers=self.POOL_WORKERS, thread_name_prefix='cat')
+        atexit.register(self._pool.shutdown, wait=False)
+        self._writers = {}
+        self._subs_prefix_cache = None
+        self._subs_index_cache = None
+        self._match_index_cache = {}
+        self._catalog_cache = {}
+        self._products_cols = {}
         self.cat_user_additions = self._load_user_additions()
         self.cat_system_prompt = self._build_system_prompt()
 
+    def _run_parallel(self, fn, items, workers):
+        """Executa fn(item) no pool compartilhado com no maximo `workers` tarefas desta
+        chamada em andamento, sem ordem entre elas (um lote lento nao segura os outros).
+        Depois de uma excecao nao submete mais itens; retorna quando as submetidas
+        terminam e propaga a primeira excecao."""
+        slots = threading.BoundedSemaphore(max(1, workers))
+        failed = threading.Event()
+
+        def _task(item):
+            try:
+                return fn(item)
+            except BaseException:
+                failed.set()
+                raise
+            finally:
+                slots.release()
+
+        futures = []
+        for item in items:
+            slots.acquire()
+            if failed.is_set():
+                slots.release()
+                break
+            futures.append(self._pool.submit(_task, item))
+        for future in as_completed(futures):
+            future.result()
+
     def _build_system_prompt(self) -> str:
         if self.cat_user_additions:
             return self.DEFAULT_CAT_SYSTEM_PROMPT + '\n\nInstruções adicionais:\n' + self.cat_user_additions
@@ -786,7 +952,7 @@ class ProductCategorizerAgent:
         try:
             self.db.collection('Automacoes').document('defenir_catsub').set({
                 'user_additions': additions,
-                'updated_at': datetime.now().isoformat(),
+                'updated_at': firestore.SERVER_TIMESTAMP,
             }, merge=True)
             self.cat_user_additions = additions
             self.cat_system_prompt = self._build_system_prompt()
@@ -800,18 +966,55 @@ class ProductCategorizerAgent:
         timestamp = datetime.now().strftime("%H:%M:%S")
         log_entry = {'timestamp': timestamp, 'message': message, 'level': level}
         categorizer_state['logs'].append(log_entry)
-        if len(categorizer_state['logs']) > 200:
-            categorizer_state['logs'] = categorizer_state['logs'][-200:]
-        socketio.emit('categorizer_log_update', log_entry)
-        logger.info(f"CATEGORIZER {level.upper()}: {message}")
+        queue_log_emit('categorizer_log_update', log_entry)
+        logger.info("CATEGORIZER %s: %s", level.upper(), message)
 
     def update_progress(self, current_product=None):
         if current_product is not None:
             categorizer_state['current_product'] = current_product
-        socketio.emit('categorizer_progress_update', {
-            'progress': categorizer_state['progress'],
-            'current_product': categorizer_state['current_product']
-        })
+        queue_progress_emit('categorizer_progress_update', categorizer_state)
+
+    def emit_status(self):
+        try:
+            socketio.emit('categorizer_status_update', {
+                'running': categorizer_state['running'],
+                'progress': categorizer_state['progress'],
+                'current_product': categorizer_state['current_product'],
+            })
+        except Exception:
+            pass
+
+    def _products_col(self, estabelecimento_id):
+        """CollectionReference de Products do estabelecimento, criada uma vez e reutilizada."""
+        col_ref = self._products_cols.get(estabelecimento_id)
+        if col_ref is None:
+            col_ref = (self.db.collection('estabelecimentos')
+                       .document(estabelecimento_id)
+                       .collection('Products'))
+            self._products_cols[estabelecimento_id] = col_ref
+        return col_ref
+
+    # ---- Cache de catalogo por estabelecimento (TTL) ----
+    # Categorias/subcategorias quase nao mudam; produtos mudam com as proprias execucoes
+    CATALOG_TTL = 300
+    PRODUCTS_TTL = 30
+
+    def _cached_load(self, ttl, loader, *args):
+        """Chama loader(*args) reaproveitando o resultado por ttl segundos."""
+        key = (loader.__name__,) + args
+        now = time.monotonic()
+        hit = self._catalog_cache.get(key)
+        if hit and now - hit[0] < ttl:
+            return hit[1]
+        data = loader(*args)
+        if data:
+            self._catalog_cache[key] = (now, data)
+        return data
+
+    def _invalidate_products_cache(self, estabelecimento_id):
+        for key in list(self._catalog_cache):
+            if key[0] in ('load_products', 'load_all_products_with_cats') and key[1] == estabelecimento_id:
+                self._catalog_cache.pop(key, None)
 
     def load_categories(self, estabelecimento_id):
         try:
@@ -819,7 +1022,7 @@ class ProductCategorizerAgent:
                        .document(estabelecimento_id)
                        .collection('ProductCategories'))
             categories = []
-            for doc in col_ref.stream():
+            for doc in col_ref.select(['id', 'name', 'isActive']).stream():
                 data = doc.to_dict()
                 if data and data.get('isActive', True):
                     categories.append({
@@ -838,7 +1041,7 @@ class ProductCategorizerAgent:
                        .document(estabelecimento_id)
                        .collection('ProductSubcategories'))
             subcategories = []
-            for doc in col_ref.stream():
+            for doc in col_ref.select(['id', 'name', 'categoryId', 'isActive']).stream():
                 data = doc.to_dict()
                 if data and data.get('isActive', True):
                     subcategories.append({
@@ -856,11 +1059,20 @@ class ProductCategorizerAgent:
                       filter_category_id=None, filter_subcategory_id=None,
                       use_images=False):
         try:
-            col_ref = (self.db.collection('estabelecimentos')
-                       .document(estabelecimento_id)
-                       .collection('Products'))
+            col_ref = self._products_col(estabelecimento_id)
             products = []
-            for doc in col_ref.stream():
+            # Projecao: o servidor so envia os campos usados aqui
+            fields = ['name', 'categoriesIds', 'subcategoriesIds']
+            if use_images:
+                fields.append('images')
+            # Filtro no servidor: so uma clausula array_contains por consulta, entao usa a
+            # subcategoria (mais seletiva) quando houver; o outro filtro segue abaixo no cliente
+            query = col_ref
+            if filter_subcategory_id:
+                query = query.where('subcategoriesIds', 'array_contains', filter_subcategory_id)
+            elif filter_category_id:
+                query = query.where('categoriesIds', 'array_contains', filter_category_id)
+            for doc in query.select(fields).stream():
                 data = doc.to_dict()
                 if not data or not data.get('name'):
                     continue
@@ -928,28 +1140,55 @@ class ProductCategorizerAgent:
                 return True
         return True
 
-    def _call_openai(self, prompt, max_tokens=60, content=None, system_prompt=None):
+    def _call_openai(self, prompt, max_tokens=60, content=None, system_prompt=None, on_delta=None,
+                     response_format=None, cache_check=None):
+        """Chama o modelo e retorna o texto. Com on_delta a resposta vem em streaming
+        e cada trecho e repassado ao callback assim que chega. A resposta so vai para
+        o cache quando termina normalmente (finish_reason 'stop') e, se informado,
+        cache_check(texto) a aprova; respostas truncadas ou invalidas nao sao reusadas."""
         max_retries = 5
         msg_content = content if content is not None else prompt
         sys_msg = system_prompt if system_prompt is not None else self.cat_system_prompt
+        stream_kwargs = {}
+        if on_delta is not None:
+            stream_kwargs = {'stream': True, 'stream_options': {'include_usage': True}}
+        if response_format is not None:
+            stream_kwargs['response_format'] = response_format
+        cache_key = llm_cache_key("gpt-4o-mini", sys_msg, msg_content, max_tokens, response_format)
+        cached_text = llm_cache_get(cache_key)
+        if cached_text is not None:
+            if on_delta is not None:
+                on_delta(cached_text)
+            return cached_text
+        # Estimativa barata (len/4) para reservar capacidade no balde de TPM
+        text_len = len(sys_msg) + (len(msg_content) if isinstance(msg_content, str) else len(prompt))
+        est_tokens = text_len // 4 + max_tokens
         for attempt in range(max_retries):
+            pause = ProductCategorizerAgent._rl_pause_until - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
+            openai_rate_limiter.acquire(est_tokens)
             try:
-                response = openai_client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[
-                        {"role": "system", "content": sys_msg},
-                        {"role": "user", "content": msg_content}
-                    ],
-                    max_tokens=max_tokens,
-                    temperature=0
-                )
+                with self._openai_slots:
+                    response = _ext.openai_client.chat.completions.create(
+                        model="gpt-4o-mini",
+                        messages=[
+                            {"role": "system", "content": sys_msg},
+                            {"role": "user", "content": msg_content}
+                        ],
+                        max_tokens=max_tokens,
+                        temperature=0,
+                        **stream_kwargs
+                    )
+                    if on_delta is not None:
+                        text, usage, finish_reason = self._consume_stream(response, on_delta)
             except _openai_module.RateLimitError as e:
                 if _is_quota_error(e):
                     self.log_message("ERRO: Créditos da API OpenAI esgotados. O agente foi interrompido.", "error")
                     emit_quota_exceeded()
                     raise
                 # Throttling temporário (RPM/TPM) — aguarda e tenta novamente
-                wait = 0.5 * (2 ** attempt)  # 0.5s, 1s, 2s, 4s, 8s
+                wait = self._rate_limit_wait(e, attempt)
                 self.log_message(f"Rate limit atingido, aguardando {wait:.1f}s (tentativa {attempt + 1}/{max_retries})...", "warning")
                 time.sleep(wait)
                 if attempt == max_retries - 1:
@@ -961,57 +1200,204 @@ class ProductCategorizerAgent:
                     emit_quota_exceeded()
                 raise
             break
-        if hasattr(response, 'usage') and response.usage:
-            inp = response.usage.prompt_tokens
-            out = response.usage.completion_tokens
-            call_cost = (inp * self.input_token_cost) + (out * self.output_token_cost)
-            with self._lock:
-                self.tokens_used += inp + out
-                self.estimated_cost += call_cost
+        if on_delta is None:
+            choice = response.choices[0]
+            text, usage, finish_reason = choice.message.content or '', getattr(response, 'usage', None), choice.finish_reason
+        if usage:
+            inp = usage.prompt_tokens
+            out = usage.completion_tokens
+            # Tokens de prefixo em cache sao cobrados pela metade
+            details = getattr(usage, 'prompt_tokens_details', None)
+            cached = (getattr(details, 'cached_tokens', 0) or 0) if details else 0
+            call_cost = ((inp - cached * 0.5) * self.input_token_cost) + (out * self.output_token_cost)
+            self._add_usage({'in': inp, 'out': out, 'cached': cached})
             record_daily_usage(inp + out, call_cost)
-        return response.choices[0].message.content.strip()
+        text = text.strip()
+        if text and finish_reason == 'stop' and (cache_check is None or cache_check(text)):
+            llm_cache_put(cache_key, text)
+        return text
+
+    @classmethod
+    def _rate_limit_wait(cls, error, attempt):
+        """Espera com jitter (ate 0.5s * 2^tentativa), respeitando Retry-After quando vier."""
+        wait = min(60.0, random.uniform(0.5, 0.5 * (2 ** attempt)))
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get('retry-after') if response is not None else None
+        if retry_after:
+            try:
+                wait = max(wait, float(retry_after))
+            except ValueError:
+                pass
+        now = time.monotonic()
+        with cls._rl_lock:
+            cls._rl_events.append(now)
+            recent = sum(1 for t in cls._rl_events if now - t <= 5.0)
+            if recent > 3:
+                cls._rl_pause_until = max(cls._rl_pause_until, now + wait)
+        return wait
+
+    def _add_usage(self, counts):
+        """Soma tokens ao contador de uso; Counter += nao e atomico entre threads."""
+        with self._usage_lock:
+            self._usage.update(counts)
+
+    @property
+    def tokens_used(self):
+        u = self._usage
+        return u['in'] + u['out'] + u['batch_in'] + u['batch_out']
+
+    @property
+    def cached_tokens(self):
+        return self._usage['cached']
+
+    @property
+    def estimated_cost(self):
+        u = self._usage
+        realtime = ((u['in'] - u['cached'] * 0.5) * self.input_token_cost) + (u['out'] * self.output_token_cost)
+        # Batch API: metade do preco
+        batch = (u['batch_in'] * self.input_token_cost + u['batch_out'] * self.output_token_cost) * 0.5
+        return realtime + batch
+
+    @staticmethod
+    def _consume_stream(stream, on_delta):
+        """Le um stream de chat completions; o uso vem no ultimo chunk (include_usage)."""
+        parts = []
+        usage = finish_reason = None
+        for chunk in stream:
+            if chunk.usage:
+                usage = chunk.usage
+            if chunk.choices:
+                choice = chunk.choices[0]
+                delta = choice.delta.content
+                if delta:
+                    parts.append(delta)
+                    on_delta(delta)
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+        return ''.join(parts), usage, finish_reason
+
+    @staticmethod
+    def _has_json_object(raw):
+        """True se a resposta contem um objeto JSON parseavel (com ou sem cercas de markdown)."""
+        text = re.sub(r'```[a-z]*\n?', '', raw).strip()
+        start_idx, end_idx = text.find('{'), text.rfind('}')
+        if start_idx == -1 or end_idx <= start_idx:
+            return False
+        try:
+            return isinstance(json.loads(text[start_idx:end_idx + 1]), dict)
+        except ValueError:
+            return False
 
     def _best_match(self, returned_id, valid_items):
         """Retorna o item com id que melhor corresponde ao retornado pela IA."""
         if not returned_id or not valid_items:
             return None
-        valid_ids = {item['id'] for item in valid_items}
-        # 1. Match exato
-        if returned_id in valid_ids:
-            return returned_id
+        valid_ids, lower_map = self._match_index(valid_items)
         lower = returned_id.lower()
-        # 2. Match exato case-insensitive
-        for item in valid_items:
-            if item['id'].lower() == lower:
-                return item['id']
+        # 1. Match exato / 2. Match exato case-insensitive
+        match = (returned_id if returned_id in valid_ids else None) or lower_map.get(lower)
+        if match:
+            return match
         # 3. Match parcial (IDs hex longos com prefixo extra, ex: "5G5AQjg..." → "G5AQjg...")
-        for item in valid_items:
-            item_lower = item['id'].lower()
+        for item_lower, item_id in lower_map.items():
             if len(item_lower) >= 8 and (item_lower in lower or lower in item_lower):
-                return item['id']
+                return item_id
         # 4. Sem match — retorna None (não assume primeira subcategoria)
         return None
 
-    def get_category_and_subcategory(self, product_name, categories, subcategories):
-        """Avalia subcategoria primeiro; a categoria é derivada da subcategoria escolhida."""
-        cat_by_id = {c['id']: c for c in categories}
+    def _match_index(self, valid_items):
+        """(ids, {id.lower(): id}) de uma lista de itens, calculado uma vez por lista."""
+        cache = self._match_index_cache
+        cached = cache.get(id(valid_items))
+        if cached and cached[0] is valid_items:
+            return cached[1], cached[2]
+        valid_ids = {item['id'] for item in valid_items}
+        lower_map = {}
+        for item in valid_items:
+            lower_map.setdefault(item['id'].lower(), item['id'])
+        if len(cache) >= 32:
+            cache.clear()
+        cache[id(valid_items)] = (valid_items, valid_ids, lower_map)
+        return valid_ids, lower_map
+
+    @staticmethod
+    def _forced_pair(subcategories):
+        """Com uma unica subcategoria valida a resposta e obrigatoria: nao chama a IA."""
+        if len(subcategories) == 1:
+            sub = subcategories[0]
+            return sub['categoryId'], sub['id']
+        return None
+
+    def _subs_index(self, subcategories):
+        """Indices {categoryId: [subs]} e {id: sub}, montados uma vez por lista de subcategorias."""
+        cached = self._subs_index_cache
+        if cached and cached[0] is subcategories:
+            return cached[1], cached[2]
+        subs_by_cat = {}
+        for s in subcategories:
+            subs_by_cat.setdefault(s.get('categoryId'), []).append(s)
+        sub_by_id = {s['id']: s for s in subcategories}
+        self._subs_index_cache = (subcategories, subs_by_cat, sub_by_id)
+        return subs_by_cat, sub_by_id
+
+    def _name_maps(self, categories, subcategories):
+        """(cat_id -> nome, sub_id -> nome) para os loops por produto: um lookup por nome."""
+        return ({c['id']: c.get('name', c['id']) for c in categories},
+                {s['id']: s.get('name', s['id']) for s in subcategories})
+
+    def _subs_prefix(self, categories, subcategories):
+        """Bloco 'SUBCATEGORIAS VALIDAS' montado uma vez por catalogo e reutilizado
+        com os mesmos bytes em todas as chamadas, para acertar o cache de prompt da OpenAI."""
+        return self._catalog_info(categories, subcategories)[0]
+
+    def _catalog_hash(self, categories, subcategories):
+        """Versao do catalogo + prompt de sistema; muda quando o cache deve ser invalidado."""
+        return self._catalog_info(categories, subcategories)[1]
+
+    def _catalog_info(self, categories, subcategories):
+        cached = self._subs_prefix_cache
+        if cached and cached[0] is categories and cached[1] is subcategories:
+            return cached[2]
+        # Agrupado por categoria: o nome da categoria aparece uma vez por grupo em vez
+        # de repetido em cada linha (prefixo menor, mesma informacao)
+        cat_names = {c['id']: c.get('name', c['id']) for c in categories}
+        groups = {}
+        for s in subcategories:
+            groups.setdefault(s.get('categoryId'), []).append(f"{s['id']}|{s['name']}")
         subs_text = "\n".join(
-            f"{s['id']}|{s['name']}|{cat_by_id.get(s['categoryId'], {}).get('name', s['categoryId'])}"
-            for s in subcategories
+            f"# {cat_names.get(cat_id, cat_id)}\n" + "\n".join(lines)
+            for cat_id, lines in groups.items()
         )
+        prefix = f"SUBCATEGORIAS VALIDAS (id|nome), agrupadas por categoria (# categoria):\n{subs_text}\n\n"
+        catalog_hash = hashlib.sha1((self.cat_system_prompt + prefix).encode('utf-8')).hexdigest()
+        info = (prefix, catalog_hash)
+        self._subs_prefix_cache = (categories, subcategories, info)
+        return info
+
+    def get_category_and_subcategory(self, product_name, categories, subcategories):
+        """Avalia subcategoria primeiro; a categoria é derivada da subcategoria escolhida."""
+        forced = self._forced_pair(subcategories)
+        if forced:
+            return forced
+        catalog_hash = self._catalog_hash(categories, subcategories)
+        hit = cat_cache_get_many([product_name], catalog_hash).get(0)
+        if hit:
+            return hit
+        # Catalogo (estatico) primeiro, produto por ultimo: prefixo reaproveitado pelo cache da OpenAI
         prompt = (
-            f"Produto: \"{product_name}\"\n\n"
-            f"SUBCATEGORIAS VÁLIDAS (id|nome|categoria):\n{subs_text}\n\n"
-            f"Responda APENAS com o id exato (da lista acima) da subcategoria mais adequada.\n"
-            f"Não invente IDs. Sem explicações."
+            self._subs_prefix(categories, subcategories)
+            + "Responda APENAS com o id exato (da lista acima) da subcategoria mais adequada.\n"
+            "Não invente IDs. Sem explicações.\n\n"
+            f"Produto: \"{product_name}\""
         )
         try:
-            raw = self._call_openai(prompt, max_tokens=60)
+            raw = self._call_openai(prompt, max_tokens=self.TOKENS_PER_ID)
             sub_id = self._best_match(raw.strip(), subcategories)
             if not sub_id:
                 self.log_message(f"Nao foi possivel determinar subcategoria para '{product_name}'", "warning")
                 return None, None
-            sub = next(s for s in subcategories if s['id'] == sub_id)
+            sub = self._subs_index(subcategories)[1][sub_id]
+            cat_cache_put_many([(product_name, (sub['categoryId'], sub_id))], catalog_hash)
             return sub['categoryId'], sub_id
         except Exception as e:
             self.log_message(f"Erro na chamada OpenAI para '{product_name}': {e}", "error")
@@ -1020,21 +1406,160 @@ class ProductCategorizerAgent:
     # Sufixo de formato adicionado ao cat_system_prompt nas chamadas em batch.
     _BATCH_FORMAT_SUFFIX = ""  # instruções de formato estão no user message
 
-    def get_categories_batch(self, product_names, categories, subcategories, image_urls=None):
-        """Avalia subcategoria primeiro em batch; a categoria é derivada da subcategoria. Retorna lista de (cat_id, sub_id)."""
-        cat_by_id = {c['id']: c for c in categories}
-        sub_by_id = {s['id']: s for s in subcategories}
-        subs_text = "\n".join(
-            f"{s['id']}|{s['name']}|{cat_by_id.get(s['categoryId'], {}).get('name', s['categoryId'])}"
-            for s in subcategories
-        )
-        header = (
-            f"SUBCATEGORIAS VÁLIDAS (id|nome|categoria):\n{subs_text}\n\n"
+    def get_categories_batch(self, product_names, categories, subcategories, image_urls=None,
+                             on_result=None):
+        """Avalia subcategoria primeiro em batch; a categoria é derivada da subcategoria. Retorna lista de (cat_id, sub_id).
+        Produtos ja presentes no cache persistente nao sao enviados a IA. Se on_result for
+        informado, on_result(indice, cat_id, sub_id) e chamado para cada produto resolvido
+        assim que a resposta dele chega (antes do retorno)."""
+        forced = self._forced_pair(subcategories)
+        if forced:
+            if on_result is not None:
+                for i in range(len(product_names)):
+                    on_result(i, *forced)
+            return [forced] * len(product_names)
+        catalog_hash = self._catalog_hash(categories, subcategories)
+        hits = cat_cache_get_many(product_names, catalog_hash)
+        if on_result is not None:
+            for i, (cat_id, sub_id) in hits.items():
+                on_result(i, cat_id, sub_id)
+        if len(hits) == len(product_names):
+            return [hits[i] for i in range(len(product_names))]
+        # Nomes equivalentes no mesmo lote vao uma unica vez para a IA
+        groups = {}
+        for i, name in enumerate(product_names):
+            if i not in hits:
+                groups.setdefault(normalize_product_name(name), []).append(i)
+        first_idx = [idxs[0] for idxs in groups.values()]
+        miss_names = [product_names[i] for i in first_idx]
+        miss_images = [image_urls[i] for i in first_idx] if image_urls else None
+        group_idxs = list(groups.values())
+
+        def _fan_out(j, cat_id, sub_id):
+            for i in group_idxs[j]:
+                on_result(i, cat_id, sub_id)
+        miss_results = self._get_categories_batch_uncached(miss_names, categories, subcategories, miss_images,
+                                                           on_item=_fan_out if on_result is not None else None)
+        cat_cache_put_many(zip(miss_names, miss_results), catalog_hash)
+        results = [hits.get(i) for i in range(len(product_names))]
+        for idxs, r in zip(groups.values(), miss_results):
+            for i in idxs:
+                results[i] = r
+        return results
+
+    # Orcamento de saida por produto: um id do Firestore (~20 chars) custa ~10-14 tokens,
+    # mais chave/aspas/virgula no JSON. Folga fixa para chaves e quebras de linha.
+    TOKENS_PER_ID = 22
+    TOKENS_SLACK = 8
+
+    def _batch_max_tokens(self, n_products, ids_per_product=1):
+        return self.TOKENS_PER_ID * ids_per_product * n_products + self.TOKENS_SLACK
+
+    # Structured Outputs aceita enums de ate ~500 valores / 15k caracteres
+    _SCHEMA_ENUM_MAX = 500
+    _SCHEMA_ENUM_MAX_CHARS = 15000
+
+    def _batch_response_format(self, n_products, subcategories):
+        """json_schema estrito para {"1": id, ..., "N": id}; os ids viram enum quando cabem."""
+        ids = [s['id'] for s in subcategories]
+        sub_schema = {'type': 'string'}
+        if len(ids) <= self._SCHEMA_ENUM_MAX and sum(len(i) for i in ids) <= self._SCHEMA_ENUM_MAX_CHARS:
+            sub_schema['enum'] = ids
+        keys = [str(i + 1) for i in range(n_products)]
+        return {
+            'type': 'json_schema',
+            'json_schema': {
+                'name': 'categorias_lote',
+                'strict': True,
+                'schema': {
+                    'type': 'object',
+                    '$defs': {'sub': sub_schema},
+                    'properties': {k: {'$ref': '#/$defs/sub'} for k in keys},
+                    'required': keys,
+                    'additionalProperties': False,
+                },
+            },
+        }
+
+    # Par completo '"N": "id"' dentro do JSON parcial recebido em streaming
+    _STREAM_PAIR_RE = re.compile(r'"(\d+)"\s*:\s*"([^"]+)"')
+    # Linha numerada "N. resto" das respostas em texto
+    _BATCH_LINE_RE = re.compile(r'^\s*(\d+)\s*\.\s*(.*?)\s*$')
+
+    def _batch_header(self, categories, subcategories):
+        """Cabecalho do prompt em lote: catalogo estatico + instrucoes de formato."""
+        return (
+            self._subs_prefix(categories, subcategories) +
             f"Use EXCLUSIVAMENTE os IDs exatos da lista acima. Não invente IDs. Não use IDs de memória.\n"
             f"Responda SOMENTE com JSON: {{\"1\": \"id\", \"2\": \"id\", ...}}\n"
             f"Chave = número do produto. Sem markdown, sem explicações.\n\n"
             f"Produtos:"
         )
+
+    def _resolve_batch_sub(self, sub_id_raw, subcategories):
+        sub_id = self._best_match(sub_id_raw.split('|')[0].strip(), subcategories)
+        if not sub_id:
+            return None, None
+        sub = self._subs_index(subcategories)[1].get(sub_id)
+        if not sub:
+            return None, None
+        return sub['categoryId'], sub_id
+
+    def _parse_batch_response(self, raw_text, n_products, subcategories):
+        """Converte a resposta de um lote em [(cat_id, sub_id)] na ordem dos produtos."""
+        parsed = [(None, None)] * n_products
+        text = raw_text.strip()
+
+        # Remove markdown code fences if present
+        text = re.sub(r'```[a-z]*\n?', '', text).strip()
+
+        # 1) Tenta JSON: {"1": "sub_id", "2": "sub_id", ...}
+        # Extrai o bloco JSON entre o primeiro { e o último } para tolerar texto extra e chaves aninhadas
+        start_idx = text.find('{')
+        end_idx = text.rfind('}')
+        if start_idx != -1 and end_idx > start_idx:
+            try:
+                mapping = json.loads(text[start_idx:end_idx + 1])
+                for key, val in mapping.items():
+                    try:
+                        n = int(key) - 1
+                        if n < 0 or n >= n_products:
+                            continue
+                        cat_id, sub_id = self._resolve_batch_sub(str(val), subcategories)
+                        if sub_id:
+                            parsed[n] = (cat_id, sub_id)
+                    except (ValueError, TypeError):
+                        continue
+                return parsed
+            except (json.JSONDecodeError, ValueError):
+                pass
+
+        # 2) Fallback: formato numerado "N. sub_id"
+        lines = [l.strip() for l in text.split('\n') if l.strip()]
+        matches = [self._BATCH_LINE_RE.match(line) for line in lines]
+        if any(matches):
+            for m in matches:
+                if not m:
+                    continue
+                n = int(m.group(1)) - 1
+                if n < 0 or n >= n_products:
+                    continue
+                cat_id, sub_id = self._resolve_batch_sub(m.group(2), subcategories)
+                if sub_id:
+                    parsed[n] = (cat_id, sub_id)
+        else:
+            # 3) Último recurso: sequencial (sujeito a desalinhamento)
+            for i, line in enumerate(lines):
+                if i >= n_products:
+                    break
+                cat_id, sub_id = self._resolve_batch_sub(line, subcategories)
+                if sub_id:
+                    parsed[i] = (cat_id, sub_id)
+        return parsed
+
+    def _get_categories_batch_uncached(self, product_names, categories, subcategories, image_urls=None,
+                                       on_item=None):
+        header = self._batch_header(categories, subcategories)
         has_images = bool(image_urls and any(image_urls))
         if has_images:
             content = [{"type": "text", "text": header}]
@@ -1042,27 +1567,59 @@ class ProductCategorizerAgent:
                 content.append({"type": "text", "text": f"\n{i+1}. {name}"})
                 if img_url:
                     content.append({"type": "image_url", "image_url": {"url": img_url, "detail": "low"}})
-        else:
-            numbered = "\n".join(f"{i+1}. {name}" for i, name in enumerate(product_names))
-            content = None
-            prompt = f"{header}\n{numbered}"
         results = [(None, None)] * len(product_names)
         numbered = "\n".join(f"{i+1}. {name}" for i, name in enumerate(product_names))
         text_only_prompt = f"{header}\n{numbered}"
+
+        def _resolve_sub(sub_id_raw):
+            return self._resolve_batch_sub(sub_id_raw, subcategories)
+
+        # Streaming: repassa cada produto ao on_item assim que seu par fica completo
+        stream_state = {'text': '', 'pos': 0}
+        emitted = set()
+
+        def _on_stream_delta(delta):
+            text = stream_state['text'] = stream_state['text'] + delta
+            for m in self._STREAM_PAIR_RE.finditer(text, stream_state['pos']):
+                stream_state['pos'] = m.end()
+                n = int(m.group(1)) - 1
+                if n in emitted or n < 0 or n >= len(product_names):
+                    continue
+                cat_id, sub_id = _resolve_sub(m.group(2))
+                if sub_id:
+                    emitted.add(n)
+                    on_item(n, cat_id, sub_id)
+        on_delta = _on_stream_delta if on_item is not None else None
+
+        def _parse_batch_raw(raw_text):
+            return self._parse_batch_response(raw_text, len(product_names), subcategories)
+
+        def _any_parsed(raw_text):
+            return any(r != (None, None) for r in _parse_batch_raw(raw_text))
+
+        response_format = self._batch_response_format(len(product_names), subcategories)
         try:
             if has_images:
-                raw = self._call_openai('', max_tokens=50 * len(product_names), content=content,
-                                        system_prompt=self.cat_system_prompt + self._BATCH_FORMAT_SUFFIX)
+                raw = self._call_openai('', max_tokens=self._batch_max_tokens(len(product_names)), content=content,
+                                        system_prompt=self.cat_system_prompt + self._BATCH_FORMAT_SUFFIX,
+                                        on_delta=on_delta, response_format=response_format,
+                                        cache_check=_any_parsed)
             else:
-                raw = self._call_openai(text_only_prompt, max_tokens=50 * len(product_names),
-                                        system_prompt=self.cat_system_prompt + self._BATCH_FORMAT_SUFFIX)
+                raw = self._call_openai(text_only_prompt, max_tokens=self._batch_max_tokens(len(product_names)),
+                                        system_prompt=self.cat_system_prompt + self._BATCH_FORMAT_SUFFIX,
+                                        on_delta=on_delta, response_format=response_format,
+                                        cache_check=_any_parsed)
         except Exception as e:
             err_str = str(e).lower()
             if has_images and ('image' in err_str or 'downloading' in err_str or '400' in err_str):
                 self.log_message(f"Erro ao processar imagens do batch, reprocessando sem imagens...", "warning")
+                if on_delta is not None:
+                    stream_state['text'], stream_state['pos'] = '', 0
                 try:
-                    raw = self._call_openai(text_only_prompt, max_tokens=50 * len(product_names),
-                                            system_prompt=self.cat_system_prompt + self._BATCH_FORMAT_SUFFIX)
+                    raw = self._call_openai(text_only_prompt, max_tokens=self._batch_max_tokens(len(product_names)),
+                                            system_prompt=self.cat_system_prompt + self._BATCH_FORMAT_SUFFIX,
+                                            on_delta=on_delta, response_format=response_format,
+                                            cache_check=_any_parsed)
                 except Exception as e2:
                     self.log_message(f"Erro OpenAI no batch (sem imagens): {e2}", "error")
                     return results
@@ -1070,71 +1627,6 @@ class ProductCategorizerAgent:
                 self.log_message(f"Erro OpenAI no batch: {e}", "error")
                 return results
 
-        def _resolve_sub(sub_id_raw):
-            sub_id = self._best_match(sub_id_raw.split('|')[0].strip(), subcategories)
-            if not sub_id:
-                return None, None
-            sub = sub_by_id.get(sub_id)
-            if not sub:
-                return None, None
-            return sub['categoryId'], sub_id
-
-        def _parse_batch_raw(raw_text):
-            parsed = [(None, None)] * len(product_names)
-            text = raw_text.strip()
-
-            # Remove markdown code fences if present
-            text = re.sub(r'```[a-z]*\n?', '', text).strip()
-
-            # 1) Tenta JSON: {"1": "sub_id", "2": "sub_id", ...}
-            # Extrai o bloco JSON entre o primeiro { e o último } para tolerar texto extra e chaves aninhadas
-            start_idx = text.find('{')
-            end_idx = text.rfind('}')
-            if start_idx != -1 and end_idx > start_idx:
-                try:
-                    mapping = json.loads(text[start_idx:end_idx + 1])
-                    for key, val in mapping.items():
-                        try:
-                            n = int(key) - 1
-                            if n < 0 or n >= len(product_names):
-                                continue
-                            cat_id, sub_id = _resolve_sub(str(val))
-                            if sub_id:
-                                parsed[n] = (cat_id, sub_id)
-                        except (ValueError, TypeError):
-                            continue
-                    return parsed
-                except (json.JSONDecodeError, ValueError):
-                    pass
-
-            # 2) Fallback: formato numerado "N. sub_id"
-            lines = [l.strip() for l in text.split('\n') if l.strip()]
-            has_numbered = any(
-                line[:line.index('.')].strip().isdigit()
-                for line in lines if '.' in line
-            )
-            if has_numbered:
-                for line in lines:
-                    try:
-                        dot_idx = line.index('.')
-                        n = int(line[:dot_idx].strip()) - 1
-                        if n < 0 or n >= len(product_names):
-                            continue
-                        cat_id, sub_id = _resolve_sub(line[dot_idx + 1:].strip())
-                        if sub_id:
-                            parsed[n] = (cat_id, sub_id)
-                    except (ValueError, IndexError):
-                        continue
-            else:
-                # 3) Último recurso: sequencial (sujeito a desalinhamento)
-                for i, line in enumerate(lines):
-                    if i >= len(product_names):
-                        break
-                    cat_id, sub_id = _resolve_sub(line)
-                    if sub_id:
-                        parsed[i] = (cat_id, sub_id)
-            return parsed
-
         results = _parse_batch_raw(raw)
 
         # Se todos os produtos falharam, loga o response e tenta novamente com prompt reforçado
@@ -1149,8 +1641,9 @@ class ProductCategorizerAgent:
                 f"{text_only_prompt}"
             )
             try:
-                raw2 = self._call_openai(retry_prompt, max_tokens=50 * len(product_names),
-                                         system_prompt=self.cat_system_prompt + self._BATCH_FORMAT_SUFFIX)
+                raw2 = self._call_openai(retry_prompt, max_tokens=self._batch_max_tokens(len(product_names)),
+                                         system_prompt=self.cat_system_prompt + self._BATCH_FORMAT_SUFFIX,
+                                         cache_check=_any_parsed)
                 results = _parse_batch_raw(raw2)
                 if all(r == (None, None) for r in results):
                     self.log_message(
@@ -1162,10 +1655,120 @@ class ProductCategorizerAgent:
 
         return results
 
+    # ---- Escritas em lote (BulkWriter) ----
+
+    _HISTORY_STATE = {
+        'categorizer': categorizer_state,
+        'categorizer_targeted': categorizer_targeted_state,
+    }
+
+    def _open_writer(self, history_key, estabelecimento_id):
+        """Abre um BulkWriter para a execucao: as escritas sao enviadas em paralelo
+        em vez de uma por round-trip. O undo so e registrado quando a escrita confirma."""
+        # Um writer por chave: um que tenha sobrado de uma execucao anterior e fechado antes
+        self._close_writer(history_key)
+        writer = self.db.bulk_writer()
+        # path -> fila de entradas de undo (o mesmo documento pode entrar mais de uma vez)
+        pending = {}
+        pending_lock = threading.Lock()
+        log_fn = self.log_message_targeted if history_key == 'categorizer_targeted' else self.log_message
+
+        def _take(path):
+            with pending_lock:
+                entries = pending.get(path)
+                if not entries:
+                    return None
+                entry = entries.popleft()
+                if not entries:
+                    del pending[path]
+                return entry
+
+        def _on_result(reference, result, bulk_writer):
+            entry = _take(reference.path)
+            if entry is not None:
+                with _undo_locks[history_key]:
+                    undo_store[history_key].append(entry)
+
+        def _on_error(error, bulk_writer):
+            if error.attempts < 3:
+                return True
+            reference = error.operation.reference
+            entry = _take(reference.path)
+            pid = entry['product_id'] if entry else reference.id
+            log_fn(f"Erro ao atualizar produto {pid}: {error.message}", "error")
+            progress = self._HISTORY_STATE[history_key]['progress']
+            with self._lock:
+                progress['updated'] = max(0, progress['updated'] - 1)
+                progress['errors'] += 1
+            return False
+
+        writer.on_write_result(_on_result)
+        writer.on_write_error(_on_error)
+        self._writers[history_key] = (writer, pending, pending_lock, threading.Lock(), estabelecimento_id)
+
+    def _close_writer(self, history_key):
+        """Envia as escritas pendentes e aguarda a confirmacao de todas."""
+        item = self._writers.pop(history_key, None)
+        if item is None:
+            return
+        writer, _, _, _, estabelecimento_id = item
+        try:
+            writer.close()
+        except Exception as e:
+            logger.error(f"Erro ao finalizar escritas ({history_key}): {e}")
+        # Os produtos mudaram: a proxima execucao precisa reler
+        self._invalidate_products_cache(estabelecimento_id)
+
+    def _queue_product_update(self, doc_ref, update_data, undo_entry, history_key):
+        item = self._writers.get(history_key)
+        if item is None:
+            # Fora de uma execucao (sem BulkWriter aberto): escrita direta
+            doc_ref.update(update_data)
+            with _undo_locks[history_key]:
+                undo_store[history_key].append(undo_entry)
+            return
+        writer, pending, pending_lock, write_lock, _ = item
+        with write_lock:
+            with pending_lock:
+                pending.setdefault(doc_ref.path, deque()).append(undo_entry)
+            writer.update(doc_ref, update_data)
+
+    # Campos guardados no undo (estado anterior do produto)
+    _UNDO_FIELDS = ['categoriesIds', 'subcategoriesIds', 'shelves', 'shelvesIds']
+
+    @classmethod
+    def _old_data_from_snapshot(cls, snap):
+        if not snap.exists:
+            return {}
+        d = snap.to_dict() or {}
+        return {f: d.get(f, []) for f in cls._UNDO_FIELDS}
+
+    def _read_old_data(self, doc_ref):
+        try:
+            return self._old_data_from_snapshot(doc_ref.get(field_paths=self._UNDO_FIELDS))
+        except Exception:
+            return {}
+
+    def _prefetch_old_data(self, estabelecimento_id, products, chunk_size=300):
+        """Le o estado anterior de todos os produtos com get_all (BatchGetDocuments)
+        em vez de um doc_ref.get() por produto durante a escrita."""
+        col_ref = self._products_col(estabelecimento_id)
+        refs = [col_ref.document(p['id']) for p in products]
+        old_data_map = {}
+        for start in range(0, len(refs), chunk_size):
+            try:
+                for snap in self.db.get_all(refs[start:start + chunk_size],
+                                            field_paths=self._UNDO_FIELDS):
+                    old_data_map[snap.id] = self._old_data_from_snapshot(snap)
+            except Exception as e:
+                # Produtos sem entrada no mapa caem no get() individual
+                logger.warning(f"Falha ao pre-carregar estado anterior: {e}")
+        return old_data_map
+
     def update_product_categories(self, product_id, estabelecimento_id,
                                    category_id, subcategory_id,
                                    category_name, subcategory_name, dry_run=False,
-                                   history_key='categorizer'):
+                                   history_key='categorizer', old_data=None):
         shelf_id = f"{category_id}_{subcategory_id}"
         shelf_entry = {
             'id': shelf_id,
@@ -1186,32 +1789,15 @@ class ProductCategorizerAgent:
             )
             return True
         try:
-            doc_ref = (self.db.collection('estabelecimentos')
-                       .document(estabelecimento_id)
-                       .collection('Products')
-                       .document(product_id))
-            # Lê estado anterior para possibilitar desfazer
-            old_data = {}
-            try:
-                snap = doc_ref.get()
-                if snap.exists:
-                    d = snap.to_dict() or {}
-                    old_data = {
-                        'categoriesIds': d.get('categoriesIds', []),
-                        'subcategoriesIds': d.get('subcategoriesIds', []),
-                        'shelves': d.get('shelves', []),
-                        'shelvesIds': d.get('shelvesIds', []),
-                    }
-            except Exception:
-                pass
-            doc_ref.update(update_data)
-            with _undo_lock:
-                undo_store[history_key].append({
-                    'product_id': product_id,
-                    'estabelecimento_id': estabelecimento_id,
-                    'old_data': old_data,
-                    'new_data': update_data,
-                })
+            doc_ref = self._products_col(estabelecimento_id).document(product_id)
+            # Estado anterior para possibilitar desfazer (normalmente pre-carregado)
+            if old_data is None:
+                old_data = self._read_old_data(doc_ref)
+            self._queue_product_update(doc_ref, update_data, {
+                'product_id': product_id,
+                'estabelecimento_id': estabelecimento_id,
+                'old_data': old_data,
+            }, history_key)
             return True
         except Exception as e:
             self.log_message(f"Erro ao atualizar produto {product_id}: {e}", "error")
@@ -1223,12 +1809,12 @@ class ProductCategorizerAgent:
     def get_categories_batch_multi(self, products, categories, subcategories, force_relocate=False):
         """Para o modo realocar: retorna ate 2 (cat_id, sub_id) por produto.
         Inclui categoria atual de cada produto no contexto."""
+        forced = self._forced_pair(subcategories)
+        if forced:
+            return [[forced] for _ in products]
         cat_by_id = {c['id']: c for c in categories}
-        sub_by_id = {s['id']: s for s in subcategories}
-        subs_text = "\n".join(
-            f"{s['id']}|{s['name']}|{cat_by_id.get(s['categoryId'], {}).get('name', s['categoryId'])}"
-            for s in subcategories
-        )
+        sub_by_id = self._subs_index(subcategories)[1]
+        subs_prefix = self._subs_prefix(categories, subcategories)
         lines = []
         for i, p in enumerate(products):
             cat_name = ''
@@ -1250,7 +1836,7 @@ class ProductCategorizerAgent:
         )
         if force_relocate:
             instruction = (
-                f"SUBCATEGORIAS VALIDAS (id|nome|categoria):\n{subs_text}\n\n"
+                f"{subs_prefix}"
                 f"{fmt}"
                 f"ATENCAO: os produtos abaixo estao INCORRETAMENTE categorizados. "
                 f"A categoria entre colchetes esta ERRADA — ignore-a. "
@@ -1259,15 +1845,16 @@ class ProductCategorizerAgent:
             )
         else:
             instruction = (
-                f"SUBCATEGORIAS VALIDAS (id|nome|categoria):\n{subs_text}\n\n"
+                f"{subs_prefix}"
                 f"{fmt}"
                 f"A categoria atual do produto e exibida entre colchetes como referencia.\n\n"
                 f"Produtos:\n" + "\n".join(lines)
             )
         results = [[] for _ in products]
         try:
-            raw = self._call_openai(instruction, max_tokens=50 * len(products),
-                                    system_prompt=self.cat_system_prompt)
+            raw = self._call_openai(instruction, max_tokens=self._batch_max_tokens(len(products), 2),
+                                    system_prompt=self.cat_system_prompt,
+                                    cache_check=self._has_json_object)
         except Exception as e:
             self.log_message(f"Erro OpenAI batch multi: {e}", "error")
             return results
@@ -1304,9 +1891,9 @@ class ProductCategorizerAgent:
         Uma chamada à IA: pede sub principal (nao-mercearia) + sub mercearia opcional."""
         mercearia_cat_id = 'mercearia'
         cat_by_id = {c['id']: c for c in categories}
-        sub_by_id = {s['id']: s for s in subcategories}
+        subs_by_cat, sub_by_id = self._subs_index(subcategories)
         non_merc_subs = [s for s in subcategories if s.get('categoryId') != mercearia_cat_id]
-        merc_subs = [s for s in subcategories if s.get('categoryId') == mercearia_cat_id]
+        merc_subs = subs_by_cat.get(mercearia_cat_id, [])
 
         non_merc_text = "\n".join(
             f"{s['id']}|{s['name']}|{cat_by_id.get(s['categoryId'],{}).get('name','')}"
@@ -1324,8 +1911,9 @@ class ProductCategorizerAgent:
         )
         results = [[] for _ in product_names]
         try:
-            raw = self._call_openai(header, max_tokens=50 * len(product_names),
-                                    system_prompt=self.cat_system_prompt)
+            raw = self._call_openai(header, max_tokens=self._batch_max_tokens(len(product_names), 2),
+                                    system_prompt=self.cat_system_prompt,
+                                    cache_check=self._has_json_object)
         except Exception as e:
             self.log_message(f"Erro OpenAI batch mercearia: {e}", "error")
             return results
@@ -1361,19 +1949,20 @@ class ProductCategorizerAgent:
         return results
 
     def update_product_categories_multi(self, product_id, estabelecimento_id,
-                                        pairs, cat_by_id, sub_by_id,
+                                        pairs, cat_names, sub_names,
                                         dry_run=False, history_key='categorizer_targeted',
-                                        log_fn=None):
-        """Atualiza produto com 1 ou 2 pares (cat_id, sub_id)."""
+                                        log_fn=None, old_data=None):
+        """Atualiza produto com 1 ou 2 pares (cat_id, sub_id); cat_names/sub_names
+        mapeiam id -> nome (ver _name_maps)."""
         if not pairs:
             return False
         _log = log_fn or self.log_message_targeted
         valid_pairs = []
         for c, s in pairs:
-            if c not in cat_by_id:
+            if c not in cat_names:
                 _log(f"  [ignorado] categoria '{c}' nao existe neste estabelecimento", "warning")
                 continue
-            if s not in sub_by_id:
+            if s not in sub_names:
                 _log(f"  [ignorado] subcategoria '{s}' nao existe neste estabelecimento", "warning")
                 continue
             valid_pairs.append((c, s))
@@ -1388,8 +1977,8 @@ class ProductCategorizerAgent:
                 'id': f"{c}_{s}",
                 'productCategoryId': c,
                 'productSubcategoryId': s,
-                'categoryName': cat_by_id.get(c, {}).get('name', c),
-                'subcategoryName': sub_by_id.get(s, {}).get('name', s)
+                'categoryName': cat_names.get(c, c),
+                'subcategoryName': sub_names.get(s, s)
             }
             for c, s in pairs
         ]
@@ -1401,37 +1990,20 @@ class ProductCategorizerAgent:
         }
         if dry_run:
             labels = ', '.join(
-                f"{cat_by_id.get(c,{}).get('name',c)} / {sub_by_id.get(s,{}).get('name',s)}"
+                f"{cat_names.get(c, c)} / {sub_names.get(s, s)}"
                 for c, s in pairs
             )
             _log(f"[DRY RUN] {product_id}: {labels}", "warning")
             return True
         try:
-            doc_ref = (self.db.collection('estabelecimentos')
-                       .document(estabelecimento_id)
-                       .collection('Products')
-                       .document(product_id))
-            old_data = {}
-            try:
-                snap = doc_ref.get()
-                if snap.exists:
-                    d = snap.to_dict() or {}
-                    old_data = {
-                        'categoriesIds': d.get('categoriesIds', []),
-                        'subcategoriesIds': d.get('subcategoriesIds', []),
-                        'shelves': d.get('shelves', []),
-                        'shelvesIds': d.get('shelvesIds', []),
-                    }
-            except Exception:
-                pass
-            doc_ref.update(update_data)
-            with _undo_lock:
-                undo_store[history_key].append({
-                    'product_id': product_id,
-                    'estabelecimento_id': estabelecimento_id,
-                    'old_data': old_data,
-                    'new_data': update_data,
-                })
+            doc_ref = self._products_col(estabelecimento_id).document(product_id)
+            if old_data is None:
+                old_data = self._read_old_data(doc_ref)
+            self._queue_product_update(doc_ref, update_data, {
+                'product_id': product_id,
+                'estabelecimento_id': estabelecimento_id,
+                'old_data': old_data,
+            }, history_key)
             return True
         except Exception as e:
             _log(f"Erro ao atualizar produto {product_id}: {e}", "error")
@@ -1443,27 +2015,30 @@ class ProductCategorizerAgent:
         timestamp = datetime.now().strftime("%H:%M:%S")
         log_entry = {'timestamp': timestamp, 'message': message, 'level': level}
         categorizer_targeted_state['logs'].append(log_entry)
-        if len(categorizer_targeted_state['logs']) > 200:
-            categorizer_targeted_state['logs'] = categorizer_targeted_state['logs'][-200:]
-        socketio.emit('categorizer_targeted_log_update', log_entry)
-        logger.info(f"CATDIR {level.upper()}: {message}")
+        queue_log_emit('categorizer_targeted_log_update', log_entry)
+        logger.info("CATDIR %s: %s", level.upper(), message)
 
     def update_progress_targeted(self, current_product=None):
         if current_product is not None:
             categorizer_targeted_state['current_product'] = current_product
-        socketio.emit('categorizer_targeted_progress_update', {
-            'progress': categorizer_targeted_state['progress'],
-            'current_product': categorizer_targeted_state['current_product']
-        })
+        queue_progress_emit('categorizer_targeted_progress_update', categorizer_targeted_state)
+
+    def emit_status_targeted(self):
+        try:
+            socketio.emit('categorizer_targeted_status_update', {
+                'running': categorizer_targeted_state['running'],
+                'progress': categorizer_targeted_state['progress'],
+                'current_product': categorizer_targeted_state['current_product'],
+            })
+        except Exception:
+            pass
 
     def load_all_products_with_cats(self, estabelecimento_id):
         """Carrega todos os produtos com id, name, categoriesIds e subcategoriesIds."""
         try:
-            col_ref = (self.db.collection('estabelecimentos')
-                       .document(estabelecimento_id)
-                       .collection('Products'))
+            col_ref = self._products_col(estabelecimento_id)
             products = []
-            for doc in col_ref.stream():
+            for doc in col_ref.select(['name', 'categoriesIds', 'subcategoriesIds']).stream():
                 data = doc.to_dict()
                 if data and data.get('name'):
                     products.append({
@@ -1482,12 +2057,12 @@ class ProductCategorizerAgent:
         """Avalia pela subcategoria se o produto pertence à categoria."""
         subs_text = "\n".join(f"{s['id']}|{s['name']}" for s in target_subs)
         prompt = (
-            f"Produto: \"{product_name}\"\n\n"
             f"Subcategorias de '{category_name}':\n{subs_text}\n\n"
             f"Se o produto pertence a '{category_name}', responda com o id da subcategoria mais adequada.\n"
-            f"Se NAO pertence, responda apenas: NENHUMA"
+            f"Se NAO pertence, responda apenas: NENHUMA\n\n"
+            f"Produto: \"{product_name}\""
         )
-        raw = self._call_openai(prompt, max_tokens=60).strip()
+        raw = self._call_openai(prompt, max_tokens=self.TOKENS_PER_ID).strip()
         if raw.upper() == 'NENHUMA':
             return False, None
         sub_id = self._best_match(raw, target_subs)
@@ -1507,27 +2082,23 @@ class ProductCategorizerAgent:
         )
         results = [(False, None)] * len(product_names)
         try:
-            raw = self._call_openai(prompt, max_tokens=30 * len(product_names))
+            raw = self._call_openai(prompt, max_tokens=self._batch_max_tokens(len(product_names)))
         except Exception as e:
             self.log_message_targeted(f"Erro OpenAI no batch fase 2: {e}", "error")
             return results
-        for line in raw.strip().split('\n'):
-            line = line.strip()
-            if not line:
+        for line in raw.split('\n'):
+            m = self._BATCH_LINE_RE.match(line)
+            if not m:
                 continue
-            try:
-                dot_idx = line.index('.')
-                n = int(line[:dot_idx].strip()) - 1
-                if n < 0 or n >= len(product_names):
-                    continue
-                rest = line[dot_idx + 1:].strip()
-                if rest.upper() == 'NENHUMA':
-                    results[n] = (False, None)
-                else:
-                    sub_id = self._best_match(rest, target_subs)
-                    results[n] = (True, sub_id) if sub_id else (False, None)
-            except (ValueError, IndexError):
+            n = int(m.group(1)) - 1
+            if n < 0 or n >= len(product_names):
                 continue
+            rest = m.group(2)
+            if rest.upper() == 'NENHUMA':
+                results[n] = (False, None)
+            else:
+                sub_id = self._best_match(rest, target_subs)
+                results[n] = (True, sub_id) if sub_id else (False, None)
         return results
 
     def run_categorization_targeted(self, estabelecimento_id, target_category_id,
@@ -1536,17 +2107,15 @@ class ProductCategorizerAgent:
                                      include_mercearia=False,
                                      fallback_category_id=None, fallback_subcategory_id=None):
         try:
-            self.tokens_used = 0
-            self.estimated_cost = 0
+            self._usage.clear()
             categorizer_targeted_state['running'] = True
-            categorizer_targeted_state['logs'] = []
+            categorizer_targeted_state['logs'].clear()
             categorizer_targeted_state['current_product'] = None
-            categorizer_targeted_state['progress'] = {
-                'total': 0, 'processed': 0, 'updated': 0,
-                'skipped': 0, 'errors': 0, 'tokens_used': 0, 'estimated_cost': 0.0
-            }
-            with _undo_lock:
+            reset_progress(categorizer_targeted_state['progress'])
+            with _undo_locks['categorizer_targeted']:
                 undo_store['categorizer_targeted'].clear()
+            if not dry_run:
+                self._open_writer('categorizer_targeted', estabelecimento_id)
             try:
                 socketio.emit('categorizer_targeted_status_update', {
                     'running': True,
@@ -1565,25 +2134,32 @@ class ProductCategorizerAgent:
             if dry_run:
                 self.log_message_targeted("MODO DRY RUN - Nenhuma atualizacao sera feita", "warning")
 
-            categories = self.load_categories(estabelecimento_id)
-            subcategories = self.load_subcategories(estabelecimento_id)
+            # Categorias, subcategorias e produtos sao independentes: carrega em paralelo
+            f_cats = self._pool.submit(self._cached_load, self.CATALOG_TTL, self.load_categories, estabelecimento_id)
+            f_subs = self._pool.submit(self._cached_load, self.CATALOG_TTL, self.load_subcategories, estabelecimento_id)
+            f_prods = self._pool.submit(self._cached_load, self.PRODUCTS_TTL, self.load_all_products_with_cats,
+                                        estabelecimento_id)
+            categories, subcategories = f_cats.result(), f_subs.result()
             if not include_mercearia:
                 categories = [c for c in categories if c['id'].lower() != 'mercearia']
                 allowed_cat_ids = {c['id'] for c in categories}
                 subcategories = [s for s in subcategories if s.get('categoryId') in allowed_cat_ids]
             cat_by_id = {c['id']: c for c in categories}
-            sub_by_id = {s['id']: s for s in subcategories}
+            subs_by_cat, sub_by_id = self._subs_index(subcategories)
+            cat_names, sub_names = self._name_maps(categories, subcategories)
+            prefix_tokens = estimate_tokens(self.cat_system_prompt + self._subs_prefix(categories, subcategories))
+            self.log_message_targeted(f"Prefixo estatico do prompt: ~{prefix_tokens:,} tokens", "info")
 
             # Fallback configurável
             outros_cat_id = fallback_category_id or None
             outros_sub_id = fallback_subcategory_id or None
             # Se só a categoria foi configurada, usa a primeira sub disponível dela
             if outros_cat_id and not outros_sub_id:
-                first_sub = next((s for s in subcategories if s.get('categoryId') == outros_cat_id), None)
-                if first_sub:
-                    outros_sub_id = first_sub['id']
-            outros_cat_name = cat_by_id.get(outros_cat_id, {}).get('name', 'Fallback') if outros_cat_id else None
-            outros_sub_name = sub_by_id.get(outros_sub_id, {}).get('name', 'Fallback') if outros_sub_id else None
+                first_subs = subs_by_cat.get(outros_cat_id)
+                if first_subs:
+                    outros_sub_id = first_subs[0]['id']
+            outros_cat_name = cat_names.get(outros_cat_id, 'Fallback') if outros_cat_id else None
+            outros_sub_name = sub_names.get(outros_sub_id, 'Fallback') if outros_sub_id else None
 
             target_cat = cat_by_id.get(target_category_id)
             if not target_cat:
@@ -1591,7 +2167,7 @@ class ProductCategorizerAgent:
                 categorizer_targeted_state['running'] = False
                 return False
 
-            target_subs = [s for s in subcategories if s['categoryId'] == target_category_id]
+            target_subs = subs_by_cat.get(target_category_id, [])
             if not target_subs:
                 self.log_message_targeted(f"Sem subcategorias para '{target_category_id}'", "error")
                 categorizer_targeted_state['running'] = False
@@ -1600,7 +2176,7 @@ class ProductCategorizerAgent:
             subs_preview = ', '.join(s['name'] for s in target_subs[:8])
             self.log_message_targeted(f"Subcategorias ({len(target_subs)}): {subs_preview}...", "info")
 
-            all_products = self.load_all_products_with_cats(estabelecimento_id)
+            all_products = f_prods.result()
             if not all_products:
                 self.log_message_targeted("Nenhum produto encontrado", "warning")
                 categorizer_targeted_state['running'] = False
@@ -1609,14 +2185,18 @@ class ProductCategorizerAgent:
             if find_mode:
                 # Modo atrair: varre todos os produtos que NÃO estão na categoria alvo
                 phase1 = []
-                phase2 = [p for p in all_products if target_category_id not in p.get('categories_ids', [])]
+                phase2 = [p for p in all_products if target_category_id not in (p.get('categories_ids') or ())]
                 self.log_message_targeted(f"Varredura: {len(phase2)} produtos fora de '{target_cat['name']}' a avaliar", "info")
             else:
                 # Modo realocar: apenas produtos já na categoria (+ filtro de subcategoria)
-                phase1 = [p for p in all_products if target_category_id in p.get('categories_ids', [])]
-                if filter_subcategory_id:
-                    phase1 = [p for p in phase1 if filter_subcategory_id in p.get('subcategories_ids', [])]
-                phase2 = [p for p in all_products if target_category_id not in p.get('categories_ids', [])] if include_others else []
+                # Particao em uma unica passada
+                phase1, phase2 = [], []
+                for p in all_products:
+                    if target_category_id in (p.get('categories_ids') or ()):
+                        if not filter_subcategory_id or filter_subcategory_id in (p.get('subcategories_ids') or ()):
+                            phase1.append(p)
+                    elif include_others:
+                        phase2.append(p)
                 self.log_message_targeted(f"Fase 1 — ja em '{target_cat['name']}': {len(phase1)} produtos", "info")
                 if include_others:
                     self.log_message_targeted(f"Fase 2 — outras categorias a avaliar: {len(phase2)} produtos", "info")
@@ -1627,16 +2207,16 @@ class ProductCategorizerAgent:
                 categorizer_targeted_state['running'] = False
                 return False
 
-            categorizer_targeted_state['progress'] = {
-                'total': total, 'processed': 0, 'updated': 0,
-                'skipped': 0, 'errors': 0, 'tokens_used': 0, 'estimated_cost': 0.0
-            }
+            reset_progress(categorizer_targeted_state['progress'], total)
             self.update_progress_targeted()
 
+            # Estado anterior (undo) de todos os produtos em leituras em lote
+            old_data_map = {} if dry_run else self._prefetch_old_data(estabelecimento_id, phase1 + phase2)
+
             subs_text = "\n".join([f"id={s['id']} | nome={s['name']}" for s in target_subs])
 
             def _tick(ok):
-                # Must be called inside self._lock
+                # Must be called inside self._lock (o emit fica fora)
                 if ok is True:
                     categorizer_targeted_state['progress']['updated'] += 1
                 elif ok is False:
@@ -1646,15 +2226,13 @@ class ProductCategorizerAgent:
                 categorizer_targeted_state['progress']['processed'] += 1
                 categorizer_targeted_state['progress']['tokens_used'] = self.tokens_used
                 categorizer_targeted_state['progress']['estimated_cost'] = self.estimated_cost
-                self.update_progress_targeted()
 
-            BATCH_SIZE = 10
+            BATCH_SIZE = 20
 
             # ── Fase 1: avalia produto contra TODAS as categorias (batch) ────
             if phase1:
-                batches_p1 = [phase1[s:s + BATCH_SIZE] for s in range(0, len(phase1), BATCH_SIZE)]
                 self.log_message_targeted(
-                    f"=== Fase 1: categorizando ({len(phase1)} produtos em lotes de {BATCH_SIZE}, 2 paralelos) ===", "info"
+                    f"=== Fase 1: categorizando ({len(phase1)} produtos em lotes de {BATCH_SIZE}, {self.PHASE_WORKERS} paralelos) ===", "info"
                 )
 
             def _phase1_batch(args):
@@ -1671,6 +2249,7 @@ class ProductCategorizerAgent:
                     with self._lock:
                         for _ in batch:
                             _tick(False)
+                    self.update_progress_targeted()
                     return
                 for j, (product, pairs) in enumerate(zip(batch, multi_results)):
                     if not categorizer_targeted_state['running']:
@@ -1686,33 +2265,36 @@ class ProductCategorizerAgent:
                             ok = self.update_product_categories(pid, estabelecimento_id,
                                                                 outros_cat_id, outros_sub_id,
                                                                 outros_cat_name, outros_sub_name, dry_run,
-                                                                history_key='categorizer_targeted')
+                                                                history_key='categorizer_targeted',
+                                                                old_data=old_data_map.get(pid))
                         else:
                             self.log_message_targeted(f"  Sem fallback configurado — produto ignorado", "warning")
                             ok = None
                     else:
                         labels = ' + '.join(
-                            f"{cat_by_id.get(c,{}).get('name',c)} / {sub_by_id.get(s,{}).get('name',s)}"
+                            f"{cat_names.get(c, c)} / {sub_names.get(s, s)}"
                             for c, s in pairs
                         )
                         level = "success" if any(c == target_category_id for c, _ in pairs) else "info"
                         self.log_message_targeted(f"  -> {labels}", level)
                         ok = self.update_product_categories_multi(pid, estabelecimento_id,
-                                                                   pairs, cat_by_id, sub_by_id,
+                                                                   pairs, cat_names, sub_names,
                                                                    dry_run,
-                                                                   history_key='categorizer_targeted')
+                                                                   history_key='categorizer_targeted',
+                                                                   old_data=old_data_map.get(pid))
                     with self._lock:
                         _tick(ok)
+                    self.update_progress_targeted()
 
             if phase1:
-                with ThreadPoolExecutor(max_workers=2) as executor:
-                    list(executor.map(_phase1_batch, ((i * BATCH_SIZE, b) for i, b in enumerate(batches_p1))))
+                self._run_parallel(_phase1_batch,
+                                   ((i * BATCH_SIZE, b) for i, b in enumerate(chunked(phase1, BATCH_SIZE))),
+                                   self.PHASE_WORKERS)
 
             # ── Fase 2: avalia se produto pertence à categoria (batch) ────────
             if phase2 and categorizer_targeted_state['running']:
-                batches_p2 = [phase2[s:s + BATCH_SIZE] for s in range(0, len(phase2), BATCH_SIZE)]
                 self.log_message_targeted(
-                    f"=== Fase 2: avaliando outros produtos ({len(phase2)} em lotes de {BATCH_SIZE}, 2 paralelos) ===", "info"
+                    f"=== Fase 2: avaliando outros produtos ({len(phase2)} em lotes de {BATCH_SIZE}, {self.PHASE_WORKERS} paralelos) ===", "info"
                 )
 
             def _phase2_batch(args):
@@ -1736,56 +2318,67 @@ class ProductCategorizerAgent:
                         self.log_message_targeted(f"  -> Nao pertence a '{target_cat['name']}', ignorado", "info")
                         with self._lock:
                             _tick(None)
+                        self.update_progress_targeted()
                     else:
-                        subcategory_name = sub_by_id.get(subcategory_id, {}).get('name', subcategory_id) if subcategory_id else ''
+                        subcategory_name = sub_names.get(subcategory_id, subcategory_id) if subcategory_id else ''
                         self.log_message_targeted(f"  -> {target_cat['name']} / {subcategory_name}", "success")
                         ok = self.update_product_categories(pid, estabelecimento_id,
                                                             target_category_id, subcategory_id,
                                                             target_cat['name'], subcategory_name, dry_run,
-                                                            history_key='categorizer_targeted')
+                                                            history_key='categorizer_targeted',
+                                                            old_data=old_data_map.get(pid))
                         with self._lock:
                             _tick(ok)
+                        self.update_progress_targeted()
 
             if phase2 and categorizer_targeted_state['running']:
-                with ThreadPoolExecutor(max_workers=2) as executor:
-                    list(executor.map(_phase2_batch, ((i * BATCH_SIZE, b) for i, b in enumerate(batches_p2))))
+                self._run_parallel(_phase2_batch,
+                                   ((i * BATCH_SIZE, b) for i, b in enumerate(chunked(phase2, BATCH_SIZE))),
+                                   self.PHASE_WORKERS)
 
+            self._close_writer('categorizer_targeted')
             prog = categorizer_targeted_state['progress']
             self.log_message_targeted("=== RESULTADO ===", "info")
             self.log_message_targeted(
                 f"Total: {prog['total']} | Atualizados: {prog['updated']} | "
                 f"Ignorados: {prog['skipped']} | Erros: {prog['errors']}", "info"
             )
-            self.log_message_targeted(f"Tokens: {self.tokens_used:,} | Custo: ${self.estimated_cost:.4f}", "info")
+            self.log_message_targeted(
+                f"Tokens: {self.tokens_used:,} (em cache: {self.cached_tokens:,}) | Custo: ${self.estimated_cost:.4f}", "info"
+            )
 
             categorizer_targeted_state['running'] = False
             categorizer_targeted_state['current_product'] = None
             self.update_progress_targeted()
+            self.emit_status_targeted()
             return True
         except Exception as e:
             self.log_message_targeted(f"Erro: {e}", "error")
             categorizer_targeted_state['running'] = False
             categorizer_targeted_state['current_product'] = None
             self.update_progress_targeted()
+            self.emit_status_targeted()
             return False
+        finally:
+            # Retornos antecipados (validacoes) tambem fecham o BulkWriter aberto
+            self._close_writer('categorizer_targeted')
 
     def run_categorization(self, estabelecimento_id, delay_between_products=0.5, dry_run=False,
                            only_uncategorized=False, filter_category_id=None,
                            include_mercearia=False, filter_subcategory_id=None,
                            use_images=False, fallback_category_id=None, fallback_subcategory_id=None,
-                           review_categorized=False, max_categories=2, create_backup=True):
+                           review_categorized=False, max_categories=2, create_backup=True,
+                           max_workers=None):
         try:
-            self.tokens_used = 0
-            self.estimated_cost = 0
+            self._usage.clear()
             categorizer_state['running'] = True
-            categorizer_state['logs'] = []
+            categorizer_state['logs'].clear()
             categorizer_state['current_product'] = None
-            categorizer_state['progress'] = {
-                'total': 0, 'processed': 0, 'updated': 0,
-                'errors': 0, 'tokens_used': 0, 'estimated_cost': 0.0
-            }
-            with _undo_lock:
+            reset_progress(categorizer_state['progress'])
+            with _undo_locks['categorizer']:
                 undo_store['categorizer'].clear()
+            if not dry_run:
+                self._open_writer('categorizer', estabelecimento_id)
             try:
                 socketio.emit('categorizer_status_update', {
                     'running': True,
@@ -1801,7 +2394,14 @@ class ProductCategorizerAgent:
             if dry_run:
                 self.log_message("MODO DRY RUN - Nenhuma atualizacao sera feita", "warning")
 
-            categories = self.load_categories(estabelecimento_id)
+            # Categorias, subcategorias e produtos sao independentes: carrega em paralelo
+            _only_uncat = only_uncategorized and not review_categorized
+            f_cats = self._pool.submit(self._cached_load, self.CATALOG_TTL, self.load_categories, estabelecimento_id)
+            f_subs = self._pool.submit(self._cached_load, self.CATALOG_TTL, self.load_subcategories, estabelecimento_id)
+            f_prods = self._pool.submit(self._cached_load, self.PRODUCTS_TTL, self.load_products, estabelecimento_id,
+                                        _only_uncat, filter_category_id, filter_subcategory_id, use_images)
+
+            categories = f_cats.result()
             if not categories:
                 self.log_message("Nenhuma categoria encontrada", "warning")
                 categorizer_state['running'] = False
@@ -1817,7 +2417,7 @@ class ProductCategorizerAgent:
             if filter_subcategory_id:
                 self.log_message(f"Filtro de subcategoria: {filter_subcategory_id}", "info")
 
-            subcategories = self.load_subcategories(estabelecimento_id)
+            subcategories = f_subs.result()
             if not subcategories:
                 self.log_message("Nenhuma subcategoria encontrada", "warning")
                 categorizer_state['running'] = False
@@ -1830,51 +2430,42 @@ class ProductCategorizerAgent:
                 self.log_message("Modo revisao: todos os produtos serao avaliados e realocados se necessario", "info")
             if use_images:
                 self.log_message("Analise de imagens ativada", "info")
-            _only_uncat = only_uncategorized and not review_categorized
-            products = self.load_products(estabelecimento_id, _only_uncat,
-                                          filter_category_id, filter_subcategory_id, use_images)
+            products = f_prods.result()
             if not products:
                 self.log_message("Nenhum produto encontrado com os filtros aplicados", "warning")
                 categorizer_state['running'] = False
                 return False
+            # Estado anterior (undo) em leituras em lote, em paralelo com o backup e o prompt
+            f_old = None if dry_run else self._pool.submit(self._prefetch_old_data, estabelecimento_id, products)
 
             if create_backup:
-                try:
-                    from utils import create_backup_file
-                    backup_data = [{'id': p['id'], 'name': p.get('name', ''),
-                                    'categoriesIds': p.get('categoriesIds', []),
-                                    'subcategoriesIds': p.get('subcategoriesIds', [])} for p in products]
-                    filename = create_backup_file('categorizer', estabelecimento_id, backup_data)
-                    self.log_message(f"Backup criado: {filename}", "info")
-                    socketio.emit('backup_created', {'filename': filename, 'automation': 'categorizer'})
-                except Exception as e:
-                    self.log_message(f"Aviso: não foi possível criar backup: {e}", "warning")
+                self._backup_products(estabelecimento_id, products)
 
-            cat_by_id = {c['id']: c for c in categories}
-            sub_by_id = {s['id']: s for s in subcategories}
+            subs_by_cat, _ = self._subs_index(subcategories)
+            cat_names, sub_names = self._name_maps(categories, subcategories)
+            prefix_tokens = estimate_tokens(self.cat_system_prompt + self._subs_prefix(categories, subcategories))
+            self.log_message(f"Prefixo estatico do prompt: ~{prefix_tokens:,} tokens", "info")
 
             # Fallback configurável (definido pelo usuário na UI)
             outros_cat_id = fallback_category_id or None
             outros_sub_id = fallback_subcategory_id or None
             # Se só a categoria foi configurada, usa a primeira sub disponível dela
             if outros_cat_id and not outros_sub_id:
-                first_sub = next((s for s in subcategories if s.get('categoryId') == outros_cat_id), None)
-                if first_sub:
-                    outros_sub_id = first_sub['id']
-            outros_cat_name = cat_by_id.get(outros_cat_id, {}).get('name', 'Fallback') if outros_cat_id else None
-            outros_sub_name = sub_by_id.get(outros_sub_id, {}).get('name', 'Fallback') if outros_sub_id else None
+                first_subs = subs_by_cat.get(outros_cat_id)
+                if first_subs:
+                    outros_sub_id = first_subs[0]['id']
+            outros_cat_name = cat_names.get(outros_cat_id, 'Fallback') if outros_cat_id else None
+            outros_sub_name = sub_names.get(outros_sub_id, 'Fallback') if outros_sub_id else None
 
             total = len(products)
-            categorizer_state['progress'] = {
-                'total': total, 'processed': 0, 'updated': 0,
-                'errors': 0, 'tokens_used': 0, 'estimated_cost': 0.0
-            }
+            reset_progress(categorizer_state['progress'], total)
             self.update_progress()
 
+            old_data_map = f_old.result() if f_old else {}
+
             BATCH_SIZE = 20
-            batches = [products[s:s + BATCH_SIZE] for s in range(0, total, BATCH_SIZE)]
             self.log_message(
-                f"Processando {total} produtos em {len(batches)} lotes de {BATCH_SIZE}", "info"
+                f"Processando {total} produtos em {-(-total // BATCH_SIZE)} lotes de {BATCH_SIZE}", "info"
             )
 
             def _tick_product(ok):
@@ -1888,6 +2479,7 @@ class ProductCategorizerAgent:
 
             def _cat_batch(args):
                 batch_start, batch = args
+                handled = set()
                 try:
                     if not categorizer_state['running']:
                         return
@@ -1897,18 +2489,8 @@ class ProductCategorizerAgent:
                     if not categorizer_state['running']:
                         return
 
-                    if include_mercearia:
-                        multi_results = self.get_categories_batch_with_mercearia(names, categories, subcategories)
-                    elif review_categorized:
-                        multi_results = self.get_categories_batch_multi(batch, categories, subcategories, force_relocate=True)
-                    else:
-                        image_urls = [p.get('image_url') for p in batch] if use_images else None
-                        single_results = self.get_categories_batch(names, categories, subcategories, image_urls)
-                        multi_results = [[(c, s)] if c and s else [] for c, s in single_results]
-
-                    for idx, (product, pairs) in enumerate(zip(batch, multi_results)):
-                        if not categorizer_state['running']:
-                            return
+                    def _process(idx, product, pairs):
+                        handled.add(idx)
                         pid, pname = product['id'], product['name']
                         i = batch_start + idx + 1
                         self.log_message(f"[{i}/{total}] {pname}", "info")
@@ -1927,95 +2509,318 @@ class ProductCategorizerAgent:
                             except Exception:
                                 pairs = []
 
-                        with self._lock:
-                            if not pairs:
-                                if outros_cat_id and outros_sub_id:
-                                    self.log_message(f"  -> {outros_cat_name} / {outros_sub_name} (fallback — nao foi possivel categorizar)", "warning")
-                                    ok = self.update_product_categories(
-                                        pid, estabelecimento_id,
-                                        outros_cat_id, outros_sub_id,
-                                        outros_cat_name, outros_sub_name, dry_run
-                                    )
-                                    _tick_product(ok)
-                                else:
-                                    self.log_message(f"  Sem fallback configurado — produto ignorado", "warning")
-                                    categorizer_state['progress']['errors'] += 1
-                                    categorizer_state['progress']['processed'] += 1
+                        if not pairs:
+                            if outros_cat_id and outros_sub_id:
+                                self.log_message(f"  -> {outros_cat_name} / {outros_sub_name} (fallback — nao foi possivel categorizar)", "warning")
+                                ok = self.update_product_categories(
+                                    pid, estabelecimento_id,
+                                    outros_cat_id, outros_sub_id,
+                                    outros_cat_name, outros_sub_name, dry_run,
+                                    old_data=old_data_map.get(pid)
+                                )
                             else:
-                                if review_categorized:
-                                    current_cats = set(product.get('categories_ids') or [])
-                                    current_subs = set(product.get('subcategories_ids') or [])
-                                    new_cats = {c for c, _ in pairs}
-                                    new_subs = {s for _, s in pairs}
-                                    if new_cats == current_cats and new_subs == current_subs:
-                                        self.log_message(f"  [ok] ja esta na categoria correta", "info")
+                                self.log_message(f"  Sem fallback configurado — produto ignorado", "warning")
+                                ok = False
+                        else:
+                            if review_categorized:
+                                current_cats = set(product.get('categories_ids') or [])
+                                current_subs = set(product.get('subcategories_ids') or [])
+                                new_cats = {c for c, _ in pairs}
+                                new_subs = {s for _, s in pairs}
+                                if new_cats == current_cats and new_subs == current_subs:
+                                    self.log_message(f"  [ok] ja esta na categoria correta", "info")
+                                    with self._lock:
                                         categorizer_state['progress']['processed'] += 1
-                                        self.update_progress()
-                                        continue
-                                    old_label = ', '.join(
-                                        f"{cat_by_id.get(c,{}).get('name',c)}/{sub_by_id.get(s,{}).get('name',s)}"
-                                        for c in current_cats for s in current_subs
-                                    ) or 'sem categoria'
-                                    new_label = ' + '.join(
-                                        f"{cat_by_id.get(c,{}).get('name',c)}/{sub_by_id.get(s,{}).get('name',s)}"
-                                        for c, s in pairs
-                                    )
-                                    self.log_message(f"  REALOCADO: {old_label} → {new_label}", "warning")
-                                else:
-                                    labels = ' + '.join(
-                                        f"{cat_by_id.get(c,{}).get('name',c)} / {sub_by_id.get(s,{}).get('name',s)}"
-                                        for c, s in pairs
-                                    )
-                                    self.log_message(f"  -> {labels}", "success")
-                                if len(pairs) == 1:
-                                    c, s = pairs[0]
-                                    ok = self.update_product_categories(
-                                        pid, estabelecimento_id,
-                                        c, s,
-                                        cat_by_id.get(c,{}).get('name',c),
-                                        sub_by_id.get(s,{}).get('name',s),
-                                        dry_run
-                                    )
-                                else:
-                                    ok = self.update_product_categories_multi(
-                                        pid, estabelecimento_id,
-                                        pairs, cat_by_id, sub_by_id,
-                                        dry_run, history_key='categorizer',
-                                        log_fn=self.log_message
-                                    )
-                                _tick_product(ok)
-                            categorizer_state['progress']['tokens_used'] = self.tokens_used
-                            categorizer_state['progress']['estimated_cost'] = self.estimated_cost
+                                    self.update_progress()
+                                    return
+                                old_label = ', '.join(
+                                    f"{cat_names.get(c, c)}/{sub_names.get(s, s)}"
+                                    for c in current_cats for s in current_subs
+                                ) or 'sem categoria'
+                                new_label = ' + '.join(
+                                    f"{cat_names.get(c, c)}/{sub_names.get(s, s)}"
+                                    for c, s in pairs
+                                )
+                                self.log_message(f"  REALOCADO: {old_label} → {new_label}", "warning")
+                            else:
+                                labels = ' + '.join(
+                                    f"{cat_names.get(c, c)} / {sub_names.get(s, s)}"
+                                    for c, s in pairs
+                                )
+                                self.log_message(f"  -> {labels}", "success")
+                            if len(pairs) == 1:
+                                c, s = pairs[0]
+                                ok = self.update_product_categories(
+                                    pid, estabelecimento_id,
+                                    c, s,
+                                    cat_names.get(c, c),
+                                    sub_names.get(s, s),
+                                    dry_run, old_data=old_data_map.get(pid)
+                                )
+                            else:
+                                ok = self.update_product_categories_multi(
+                                    pid, estabelecimento_id,
+                                    pairs, cat_names, sub_names,
+                                    dry_run, history_key='categorizer',
+                                    log_fn=self.log_message,
+                                    old_data=old_data_map.get(pid)
+                                )
+                        # So os contadores ficam sob o lock; log e escrita sao feitos fora
+                        with self._lock:
+                            _tick_product(ok)
                         self.update_progress()
+
+                    def _process_safe(idx, product, pairs):
+                        # Erro de um produto (ex.: Firestore) nao derruba o resto do lote
+                        try:
+                            _process(idx, product, pairs)
+                        except Exception as e:
+                            self.log_message(f"Erro ao processar {product.get('name', product['id'])}: {e}", "error")
+                            with self._lock:
+                                categorizer_state['progress']['errors'] += 1
+                                categorizer_state['progress']['processed'] += 1
+                            self.update_progress()
+
+                    if include_mercearia:
+                        multi_results = self.get_categories_batch_with_mercearia(names, categories, subcategories)
+                    elif review_categorized:
+                        multi_results = self.get_categories_batch_multi(batch, categories, subcategories, force_relocate=True)
+                    else:
+                        image_urls = [p.get('image_url') for p in batch] if use_images else None
+
+                        # Resposta em streaming: o callback roda dentro do slot da OpenAI, entao
+                        # so enfileira o par; gravacao/undo/progresso ficam para depois da chamada
+                        # (duvidas ficam para o fim do lote: o fallback faria outra chamada a IA)
+                        streamed = deque()
+
+                        def _on_result(idx, cat_id, sub_id):
+                            pairs = self._filter_duvidas([(cat_id, sub_id)])
+                            if pairs:
+                                streamed.append((idx, pairs))
+
+                        single_results = self.get_categories_batch(names, categories, subcategories, image_urls,
+                                                                   on_result=_on_result)
+                        multi_results = [[(c, s)] if c and s else [] for c, s in single_results]
+                        while streamed:
+                            idx, pairs = streamed.popleft()
+                            if not categorizer_state['running']:
+                                return
+                            if idx not in handled:
+                                _process_safe(idx, batch[idx], pairs)
+
+                    for idx, (product, pairs) in enumerate(zip(batch, multi_results)):
+                        if not categorizer_state['running']:
+                            return
+                        if idx not in handled:
+                            _process_safe(idx, product, pairs)
                 except Exception as e:
                     self.log_message(f"Erro no batch #{batch_start + 1}: {e}", "error")
+                    pending = len(batch) - len(handled)
                     with self._lock:
-                        categorizer_state['progress']['errors'] += len(batch)
-                        categorizer_state['progress']['processed'] += len(batch)
+                        categorizer_state['progress']['errors'] += pending
+                        categorizer_state['progress']['processed'] += pending
                     self.update_progress()
+            workers = max(1, min(16, int(max_workers or CATEGORIZER_MAX_WORKERS)))
+            self.log_message(f"{workers} lotes em paralelo", "info")
+            self._run_parallel(_cat_batch, ((i * BATCH_SIZE, b) for i, b in enumerate(chunked(products, BATCH_SIZE))),
+                               workers)
 
-            with ThreadPoolExecutor(max_workers=1) as executor:
-                list(executor.map(_cat_batch, ((i * BATCH_SIZE, b) for i, b in enumerate(batches))))
-
+            self._close_writer('categorizer')
             prog = categorizer_state['progress']
             self.log_message("=== ESTATISTICAS FINAIS ===", "info")
             self.log_message(f"Total: {prog['total']}", "info")
             self.log_message(f"Processados: {prog['processed']}", "info")
             self.log_message(f"Atualizados: {prog['updated']}", "success")
             self.log_message(f"Erros: {prog['errors']}", "error" if prog['errors'] > 0 else "info")
-            self.log_message(f"Tokens: {self.tokens_used:,}", "info")
+            self.log_message(f"Tokens: {self.tokens_used:,} (em cache: {self.cached_tokens:,})", "info")
             self.log_message(f"Custo estimado: ${self.estimated_cost:.4f}", "info")
 
             categorizer_state['running'] = False
             categorizer_state['current_product'] = None
             self.update_progress()
+            self.emit_status()
             return True
         except Exception as e:
             self.log_message(f"Erro durante a categorizacao: {e}", "error")
             categorizer_state['running'] = False
             categorizer_state['current_product'] = None
             self.update_progress()
+            self.emit_status()
+            return False
+        finally:
+            # Retornos antecipados (validacoes) tambem fecham o BulkWriter aberto
+            self._close_writer('categorizer')
+
+    def _backup_products(self, estabelecimento_id, products):
+        """Grava o arquivo de backup (categorias atuais) antes das escritas em massa."""
+        try:
+            from utils import create_backup_file
+            backup_data = [{'id': p['id'], 'name': p.get('name', ''),
+                            'categoriesIds': p.get('categoriesIds', []),
+                            'subcategoriesIds': p.get('subcategoriesIds', [])} for p in products]
+            filename = create_backup_file('categorizer', estabelecimento_id, backup_data)
+            self.log_message(f"Backup criado: {filename}", "info")
+            socketio.emit('backup_created', {'filename': filename, 'automation': 'categorizer'})
+        except Exception as e:
+            self.log_message(f"Aviso: não foi possível criar backup: {e}", "warning")
+
+    # ---- Batch API (execucoes longas, sem interacao) ----
+    BATCH_API_POLL_SECONDS = 30
+
+    def stop_batchapi(self):
+        """Acorda o polling do Batch API para que o cancelamento seja imediato."""
+        self._batchapi_stop.set()
+
+    def run_categorization_batchapi(self, estabelecimento_id, dry_run=False, only_uncategorized=False,
+                                    filter_category_id=None, include_mercearia=False,
+                                    filter_subcategory_id=None, fallback_category_id=None,
+                                    fallback_subcategory_id=None, create_backup=True):
+        """Categoriza pelo Batch API da OpenAI: envia todos os lotes num JSONL, aguarda o
+        processamento (ate 24h, metade do custo) e aplica os resultados no Firestore."""
+        history_key = 'categorizer'
+        self._batchapi_stop.clear()
+        try:
+            self._usage.clear()
+            categorizer_state['running'] = True
+            categorizer_state['logs'].clear()
+            categorizer_state['current_product'] = None
+            reset_progress(categorizer_state['progress'])
+            with _undo_locks[history_key]:
+                undo_store[history_key].clear()
+            self.emit_status()
+            self.log_message(f"Batch API — estabelecimento: {estabelecimento_id}", "info")
+            if dry_run:
+                self.log_message("MODO DRY RUN - Nenhuma atualizacao sera feita", "warning")
+
+            f_cats = self._pool.submit(self._cached_load, self.CATALOG_TTL, self.load_categories, estabelecimento_id)
+            f_subs = self._pool.submit(self._cached_load, self.CATALOG_TTL, self.load_subcategories, estabelecimento_id)
+            f_prods = self._pool.submit(self._cached_load, self.PRODUCTS_TTL, self.load_products, estabelecimento_id,
+                                        only_uncategorized, filter_category_id, filter_subcategory_id, False)
+            categories, subcategories, products = f_cats.result(), f_subs.result(), f_prods.result()
+            if not include_mercearia:
+                categories = [c for c in categories if c['id'].lower() != 'mercearia']
+                allowed_cat_ids = {c['id'] for c in categories}
+                subcategories = [s for s in subcategories if s.get('categoryId') in allowed_cat_ids]
+            if not categories or not subcategories or not products:
+                self.log_message("Nada para processar (sem categorias, subcategorias ou produtos)", "warning")
+                categorizer_state['running'] = False
+                self.emit_status()
+                return False
+            if create_backup:
+                self._backup_products(estabelecimento_id, products)
+            subs_by_cat, _ = self._subs_index(subcategories)
+            cat_names, sub_names = self._name_maps(categories, subcategories)
+            fallback_sub_id = fallback_subcategory_id
+            if fallback_category_id and not fallback_sub_id and subs_by_cat.get(fallback_category_id):
+                fallback_sub_id = subs_by_cat[fallback_category_id][0]['id']
+
+            total = len(products)
+            reset_progress(categorizer_state['progress'], total)
+            self.update_progress()
+
+            BATCH_SIZE = 20
+            batches = [products[s:s + BATCH_SIZE] for s in range(0, total, BATCH_SIZE)]
+            header = self._batch_header(categories, subcategories)
+            system_prompt = self.cat_system_prompt + self._BATCH_FORMAT_SUFFIX
+            lines = []
+            for i, batch in enumerate(batches):
+                numbered = "\n".join(f"{j+1}. {p['name']}" for j, p in enumerate(batch))
+                lines.append(json.dumps({
+                    'custom_id': f'lote-{i}',
+                    'method': 'POST',
+                    'url': '/v1/chat/completions',
+                    'body': {
+                        'model': 'gpt-4o-mini',
+                        'messages': [
+                            {'role': 'system', 'content': system_prompt},
+                            {'role': 'user', 'content': f"{header}\n{numbered}"},
+                        ],
+                        'max_tokens': self._batch_max_tokens(len(batch)),
+                        'temperature': 0,
+                        'response_format': self._batch_response_format(len(batch), subcategories),
+                    },
+                }, ensure_ascii=False))
+
+            client = _ext.openai_client
+            input_file = client.files.create(
+                file=('categorizacao.jsonl', '\n'.join(lines).encode('utf-8')), purpose='batch'
+            )
+            job = client.batches.create(input_file_id=input_file.id, endpoint='/v1/chat/completions',
+                                        completion_window='24h')
+            self.log_message(f"Lote {job.id} enviado ({len(batches)} requisicoes, {total} produtos)", "info")
+
+            while job.status not in ('completed', 'failed', 'expired', 'cancelled'):
+                # Espera o intervalo de polling, mas acorda na hora com /stop
+                if not categorizer_state['running'] or self._batchapi_stop.wait(self.BATCH_API_POLL_SECONDS):
+                    client.batches.cancel(job.id)
+                    self.log_message(f"Lote {job.id} cancelado", "warning")
+                    self.emit_status()
+                    return False
+                job = client.batches.retrieve(job.id)
+                counts = getattr(job, 'request_counts', None)
+                if counts:
+                    self.log_message(f"Lote {job.id}: {job.status} ({counts.completed}/{counts.total})", "info")
+            if job.status != 'completed' or not job.output_file_id:
+                raise RuntimeError(f"lote {job.id} terminou com status '{job.status}'")
+
+            responses = {}
+            for line in client.files.content(job.output_file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                body = (item.get('response') or {}).get('body') or {}
+                usage = body.get('usage') or {}
+                inp, out = usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+                self._add_usage({'batch_in': inp, 'batch_out': out})
+                record_daily_usage(inp + out, (inp * self.input_token_cost + out * self.output_token_cost) * 0.5)
+                choices = body.get('choices') or []
+                if choices:
+                    responses[item.get('custom_id')] = choices[0]['message'].get('content') or ''
+
+            old_data_map = {} if dry_run else self._prefetch_old_data(estabelecimento_id, products)
+            if not dry_run:
+                self._open_writer(history_key, estabelecimento_id)
+            prog = categorizer_state['progress']
+            for i, batch in enumerate(batches):
+                raw = responses.get(f'lote-{i}')
+                results = (self._parse_batch_response(raw, len(batch), subcategories)
+                           if raw is not None else [(None, None)] * len(batch))
+                for product, (cat_id, sub_id) in zip(batch, results):
+                    pid = product['id']
+                    if not sub_id or self._is_duvidas(cat_id, sub_id):
+                        cat_id, sub_id = fallback_category_id, fallback_sub_id
+                    if not (cat_id and sub_id):
+                        self.log_message(f"  {product['name']}: sem resultado e sem fallback", "warning")
+                        prog['errors'] += 1
+                    else:
+                        ok = self.update_product_categories(
+                            pid, estabelecimento_id, cat_id, sub_id,
+                            cat_names.get(cat_id, cat_id),
+                            sub_names.get(sub_id, sub_id),
+                            dry_run, old_data=old_data_map.get(pid)
+                        )
+                        prog['updated' if ok else 'errors'] += 1
+                    prog['processed'] += 1
+                prog['tokens_used'] = self.tokens_used
+                prog['estimated_cost'] = self.estimated_cost
+                self.update_progress()
+            self._close_writer(history_key)
+
+            self.log_message("=== ESTATISTICAS FINAIS (Batch API) ===", "info")
+            self.log_message(f"Atualizados: {prog['updated']} | Erros: {prog['errors']}", "info")
+            self.log_message(f"Tokens: {self.tokens_used:,} | Custo estimado: ${self.estimated_cost:.4f}", "info")
+            categorizer_state['running'] = False
+            self.update_progress()
+            self.emit_status()
+            return True
+        except Exception as e:
+            self.log_message(f"Erro na categorizacao via Batch API: {e}", "error")
+            categorizer_state['running'] = False
+            self.update_progress()
+            self.emit_status()
             return False
+        finally:
+            self._close_writer(history_key)
 
 
 # ============================================================
@@ -2028,10 +2833,16 @@ categorizer = None
 tagger = None
 
 
+# Sinaliza o fim de init_all (com ou sem sucesso); rotas que dependem do
+# Firestore esperam por ele via require_init em vez de o import bloquear
+_init_done = threading.Event()
+INIT_WAIT_SECONDS = 0.1
+
+
 def init_all():
-    global automator, advanced_explorer, simple_explorer, categorizer, tagger
+    global db, automator, advanced_explorer, simple_explorer, categorizer, tagger
     try:
-        init_firebase()
+        db = init_firebase()
         automator = FirestoreProductAutomator(db)
         advanced_explorer = FirestoreStructureExplorer(db)
         simple_explorer = FirestoreSimpleExplorer(db)
@@ -2045,9 +2856,9 @@ def init_all():
         # Carrega chave OpenAI salva no Firestore (se existir)
         try:
             if db:
-                doc = db.collection('Automacoes').document('config').get()
-                if doc.exists:
-                    key = (doc.to_dict() or {}).get('openai_api_key', '').strip()
+                data = _get_doc_dict(db.collection('Automacoes').document('config'))
+                if data is not None:
+                    key = data.get('openai_api_key', '').strip()
                     if key:
                         _reload_openai_client(key)
                         logger.info("Chave OpenAI carregada do Firestore")
@@ -2058,6 +2869,19 @@ def init_all():
     except Exception as e:
         logger.error(f"Erro ao inicializar: {e}")
         return False
+    finally:
+        _init_done.set()
+
+
+def require_init(fn):
+    """Responde 503 enquanto init_all ainda roda (cold start), em vez de 500 por
+    modulo ainda nao criado. Rotas de status/logs nao usam e respondem na hora."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not _init_done.wait(timeout=INIT_WAIT_SECONDS):
+            return jsonify({'success': False, 'error': 'Servidor inicializando, tente novamente'}), 503
+        return fn(*args, **kwargs)
+    return wrapper
 
 
 # ============================================================
@@ -2068,15 +2892,64 @@ def init_all():
 _admin_creds_cache: dict = {'user': None, 'passwd': None}
 
 
+# Cache dos documentos de configuracao (Automacoes/*): dentro de DOC_CACHE_TTL segundos
+# nem vai ao Firestore; depois le de novo, mas o to_dict() (copia profunda) so e refeito
+# quando update_time muda. Escritas deste processo atualizam o cache na hora.
+DOC_CACHE_TTL = 60
+_doc_cache = {}
+_doc_cache_lock = threading.Lock()
+
+
+def _get_doc_dict(doc_ref, ttl=DOC_CACHE_TTL):
+    """Retorna o dict do documento (ou None se nao existir). Nao modifique o retorno."""
+    now = time.monotonic()
+    with _doc_cache_lock:
+        cached = _doc_cache.get(doc_ref.path)
+    if cached and now - cached[2] < ttl:
+        return cached[1]
+    snap = doc_ref.get()
+    if not snap.exists:
+        with _doc_cache_lock:
+            _doc_cache.pop(doc_ref.path, None)
+        return None
+    data = cached[1] if cached and cached[0] == snap.update_time else (snap.to_dict() or {})
+    with _doc_cache_lock:
+        _doc_cache[doc_ref.path] = (snap.update_time, data, now)
+    return data
+
+
+_MISSING = object()
+
+
+def _cached_doc_field(doc_ref, field, ttl=DOC_CACHE_TTL):
+    """Valor do campo segundo o dict em cache (sem ir ao Firestore), ou _MISSING se
+    nao ha cache ou ele passou do ttl (mesma validade de _get_doc_dict)."""
+    with _doc_cache_lock:
+        cached = _doc_cache.get(doc_ref.path)
+    if not cached or time.monotonic() - cached[2] >= ttl:
+        return _MISSING
+    return cached[1].get(field, _MISSING)
+
+
+def _remember_doc_write(doc_ref, write_result, fields):
+    """Atualiza o cache apos um set(merge=True) para as proximas comparacoes."""
+    with _doc_cache_lock:
+        cached = _doc_cache.get(doc_ref.path)
+        if cached:
+            # Sentinelas (SERVER_TIMESTAMP) viram o horario da escrita informado pelo servidor
+            fields = {k: (write_result.update_time if v is firestore.SERVER_TIMESTAMP else v)
+                      for k, v in fields.items()}
+            _doc_cache[doc_ref.path] = (write_result.update_time, {**cached[1], **fields}, time.monotonic())
+
+
 def _load_admin_creds():
     """Carrega credenciais do Firestore para o cache em memória.
     Fallback para variáveis de ambiente ADMIN_USERNAME / ADMIN_PASSWORD."""
     global _admin_creds_cache
     try:
         if db:
-            doc = db.collection('Automacoes').document('admin').get()
-            if doc.exists:
-                data = doc.to_dict() or {}
+            data = _get_doc_dict(db.collection('Automacoes').document('admin'))
+            if data is not None:
                 user = data.get('userAdmin', '').strip()
                 passwd = data.get('passAdmin', '').strip()
                 if user and passwd:
@@ -2086,10 +2959,8 @@ def _load_admin_creds():
     except Exception as e:
         logger.warning(f"Erro ao carregar credenciais do Firestore: {e}")
     # Fallback: variáveis de ambiente (desenvolvimento local)
-    env_user = os.getenv('ADMIN_USERNAME', '').strip()
-    env_pass = os.getenv('ADMIN_PASSWORD', '').strip()
-    if env_user and env_pass:
-        _admin_creds_cache = {'user': env_user, 'passwd': env_pass}
+    if FALLBACK_ADMIN_USER and FALLBACK_ADMIN_PASS:
+        _admin_creds_cache = {'user': FALLBACK_ADMIN_USER, 'passwd': FALLBACK_ADMIN_PASS}
         logger.info("Credenciais de admin carregadas do .env (fallback)")
     else:
         _admin_creds_cache = {'user': None, 'passwd': None}
@@ -2099,11 +2970,13 @@ def get_admin_credentials():
     """Retorna credenciais de admin do cache em memória (sem chamada ao Firestore)."""
     return _admin_creds_cache.get('user'), _admin_creds_cache.get('passwd')
 
-PUBLIC_ROUTES = {'login', 'static'}
+PUBLIC_ROUTES = frozenset({'login', 'static'})
 
 @app.before_request
 def require_login():
-    if request.endpoint in PUBLIC_ROUTES:
+    # Assets estaticos e 404 (endpoint None) nao precisam decodificar o cookie de sessao
+    endpoint = request.endpoint
+    if endpoint is None or endpoint in PUBLIC_ROUTES:
         return
     if not session.get('logged_in'):
         return redirect(url_for('login'))
@@ -2112,12 +2985,14 @@ def require_login():
 def login():
     error = None
     if request.method == 'POST':
-        username = request.form.get('username', '').strip()
-        password = request.form.get('password', '').strip()
+        username = (request.form.get('username') or '').strip().encode()
+        password = (request.form.get('password') or '').strip().encode()
         admin_user, admin_pass = get_admin_credentials()
         if admin_user is None:
             error = 'Serviço indisponível. Tente novamente em instantes.'
-        elif username == admin_user and password == admin_pass:
+        # compare_digest evita vazar por tempo de resposta quantos caracteres batem
+        elif (hmac.compare_digest(username, admin_user.encode())
+              & hmac.compare_digest(password, admin_pass.encode())):
             remember = request.form.get('remember') == 'on'
             session.permanent = remember
             session['logged_in'] = True
@@ -2136,6 +3011,38 @@ def logout():
 # Rotas: Configurações
 # ============================================================
 
+def rate_limited(limit, period):
+    """Limita a rota a `limit` chamadas por cliente a cada `period` segundos (em memoria,
+    janela deslizante); acima disso responde 429 sem executar a rota."""
+    def decorator(fn):
+        hits = {}
+        lock = threading.Lock()
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            # remote_addr ja resolvido pelo ProxyFix (nao forjavel pelo cliente)
+            client = request.remote_addr
+            now = time.monotonic()
+            with lock:
+                if len(hits) > 1000:
+                    # Descarta clientes sem chamadas na janela (memoria limitada)
+                    for stale in [c for c, q in hits.items() if not q or now - q[-1] > period]:
+                        del hits[stale]
+                recent = hits.setdefault(client, deque())
+                while recent and now - recent[0] > period:
+                    recent.popleft()
+                if len(recent) >= limit:
+                    return jsonify({'success': False, 'error': 'Muitas tentativas. Aguarde um minuto.'}), 429
+                recent.append(now)
+            return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Formato das chaves da OpenAI (sk-..., sk-proj-...): rejeita antes de ir ao Firestore
+_OPENAI_KEY_RE = re.compile(r'^sk-[A-Za-z0-9_\-]{20,}$')
+
+
 @app.route('/api/settings', methods=['GET'])
 def get_settings():
     username, _ = get_admin_credentials()
@@ -2144,9 +3051,8 @@ def get_settings():
     tema = False
     try:
         if db:
-            doc = db.collection('Automacoes').document('config').get()
-            if doc.exists:
-                data = doc.to_dict() or {}
+            data = _get_doc_dict(db.collection('Automacoes').document('config'))
+            if data is not None:
                 key = data.get('openai_api_key', '').strip()
                 if key:
                     api_key_set = True
@@ -2160,6 +3066,7 @@ def get_settings():
 
 
 @app.route('/api/settings/credentials', methods=['POST'])
+@rate_limited(5, 60)
 def update_credentials():
     data = request.get_json() or {}
     new_user = data.get('username', '').strip()
@@ -2170,7 +3077,7 @@ def update_credentials():
         db.collection('Automacoes').document('admin').set({
             'userAdmin': new_user,
             'passAdmin': new_pass,
-            'updated_at': datetime.now().isoformat(),
+            'updated_at': firestore.SERVER_TIMESTAMP,
         }, merge=True)
         _admin_creds_cache['user'] = new_user
         _admin_creds_cache['passwd'] = new_pass
@@ -2181,17 +3088,19 @@ def update_credentials():
 
 
 @app.route('/api/settings/openai-key', methods=['POST'])
+@rate_limited(5, 60)
 def update_openai_key():
     data = request.get_json() or {}
     key = data.get('api_key', '').strip()
-    if not key or not key.startswith('sk-') or len(key) < 20:
+    if not _OPENAI_KEY_RE.match(key):
         return jsonify({'success': False, 'error': 'Chave inválida. Deve começar com sk- e ter pelo menos 20 caracteres'}), 400
     try:
-        db.collection('Automacoes').document('config').set({
-            'openai_api_key': key,
-            'updated_at': datetime.now().isoformat(),
-        }, merge=True)
-        _reload_openai_client(key)
+        config_ref = db.collection('Automacoes').document('config')
+        if _cached_doc_field(config_ref, 'openai_api_key') == key:
+            return jsonify({'success': True, 'noop': True})
+        fields = {'openai_api_key': key, 'updated_at': firestore.SERVER_TIMESTAMP}
+        _remember_doc_write(config_ref, config_ref.set(fields, merge=True), fields)
+        reload_openai_client_async(key)
         logger.info("Chave OpenAI atualizada via settings")
         return jsonify({'success': True})
     except Exception as e:
@@ -2203,9 +3112,9 @@ def update_openai_key():
 def get_theme():
     try:
         if db:
-            doc = db.collection('Automacoes').document('config').get()
-            if doc.exists:
-                tema = (doc.to_dict() or {}).get('tema', False)
+            data = _get_doc_dict(db.collection('Automacoes').document('config'))
+            if data is not None:
+                tema = data.get('tema', False)
                 return jsonify({'tema': bool(tema)})
     except Exception as e:
         logger.warning(f"Erro ao buscar tema: {e}")
@@ -2217,10 +3126,12 @@ def save_theme():
     data = request.get_json() or {}
     tema = bool(data.get('tema', False))
     try:
-        db.collection('Automacoes').document('config').set(
-            {'tema': tema, 'updated_at': datetime.now().isoformat()},
-            merge=True
-        )
+        config_ref = db.collection('Automacoes').document('config')
+        # Alternar o tema para o valor que ja esta salvo nao gasta uma escrita
+        if _cached_doc_field(config_ref, 'tema') == tema:
+            return jsonify({'success': True, 'noop': True})
+        fields = {'tema': tema, 'updated_at': firestore.SERVER_TIMESTAMP}
+        _remember_doc_write(config_ref, config_ref.set(fields, merge=True), fields)
         return jsonify({'success': True})
     except Exception as e:
         logger.error(f"Erro ao salvar tema: {e}")
@@ -2242,9 +3153,9 @@ def _get_all_establishment_ids():
     seen = set(result)
     try:
         if db:
-            doc = db.collection('Automacoes').document('config').get()
-            if doc.exists:
-                for e in (doc.to_dict() or {}).get('estabelecimentos', []):
+            data = _get_doc_dict(db.collection('Automacoes').document('config'))
+            if data is not None:
+                for e in data.get('estabelecimentos', []):
                     eid = e.get('id', '').strip()
                     if eid and eid not in seen:
                         result.append(eid)
@@ -2302,9 +3213,9 @@ def get_estabelecimentos():
     default_ids = {e['id'] for e in _DEFAULT_ESTABELECIMENTOS}
     try:
         if db:
-            doc = db.collection('Automacoes').document('config').get()
-            if doc.exists:
-                extras = (doc.to_dict() or {}).get('estabelecimentos', [])
+            data = _get_doc_dict(db.collection('Automacoes').document('config'))
+            if data is not None:
+                extras = data.get('estabelecimentos', [])
                 for e in extras:
                     if e.get('id') and e['id'] not in default_ids:
                         result.append({'id': e['id'], 'name': e.get('name', e['id']), 'default': False})
@@ -2330,7 +3241,8 @@ def add_estabelecimento():
         if any(e.get('id') == est_id for e in extras):
             return jsonify({'success': False, 'error': 'Estabelecimento ja cadastrado'}), 400
         extras.append({'id': est_id, 'name': name})
-        doc_ref.set({'estabelecimentos': extras, 'updated_at': datetime.now().isoformat()}, merge=True)
+        fields = {'estabelecimentos': extras, 'updated_at': firestore.SERVER_TIMESTAMP}
+        _remember_doc_write(doc_ref, doc_ref.set(fields, merge=True), fields)
         return jsonify({'success': True})
     except Exception as e:
         logger.error(f'Erro ao adicionar estabelecimento: {e}')
@@ -2347,7 +3259,8 @@ def delete_estabelecimento(est_id):
         doc = doc_ref.get()
         extras = (doc.to_dict() or {}).get('estabelecimentos', []) if doc.exists else []
         extras = [e for e in extras if e.get('id') != est_id]
-        doc_ref.set({'estabelecimentos': extras, 'updated_at': datetime.now().isoformat()}, merge=True)
+        fields = {'estabelecimentos': extras, 'updated_at': firestore.SERVER_TIMESTAMP}
+        _remember_doc_write(doc_ref, doc_ref.set(fields, merge=True), fields)
         return jsonify({'success': True})
     except Exception as e:
         logger.error(f'Erro ao remover estabelecimento: {e}')
@@ -2368,6 +3281,7 @@ def relatorio():
 
 
 @app.route('/api/report/categorizer', methods=['GET'])
+@require_init
 def categorizer_report():
     est_id = request.args.get('estabelecimento_id', 'estabelecimento-teste')
     if not db:
@@ -2411,6 +3325,7 @@ def categorizer_report():
 
 
 @app.route('/api/report/renamer', methods=['GET'])
+@require_init
 def renamer_report():
     """Relatório de produtos renomeados (últimas mudanças do undo_store)"""
     est_id = request.args.get('estabelecimento_id', 'estabelecimento-teste')
@@ -2434,7 +3349,7 @@ def renamer_report():
             products_by_id[doc.id] = data.get('name', '')
         
         # Extrair histórico de mudanças do undo_store (últimas renomeações)
-        with _undo_lock:
+        with _undo_locks['renamer']:
             changes = [c for c in undo_store['renamer'] if c.get('estabelecimento_id') == est_id]
         
         # Construir lista de produtos renomeados com before/after
@@ -2476,6 +3391,7 @@ def renamer_report():
 # Rotas: Renamer
 # ============================================================
 @app.route('/api/renamer/categories', methods=['GET'])
+@require_init
 def get_categories():
     global automator
     if not automator:
@@ -2486,6 +3402,7 @@ def get_categories():
 
 
 @app.route('/api/renamer/prompt', methods=['GET'])
+@require_init
 def get_prompt():
     global automator
     if not automator:
@@ -2499,6 +3416,7 @@ def get_prompt():
 
 
 @app.route('/api/renamer/prompt', methods=['POST'])
+@require_init
 def save_prompt():
     global automator
     if not automator:
@@ -2517,6 +3435,7 @@ def save_prompt():
 
 
 @app.route('/api/renamer/user-additions', methods=['GET'])
+@require_init
 def get_user_additions():
     global automator
     if not automator:
@@ -2525,6 +3444,7 @@ def get_user_additions():
 
 
 @app.route('/api/renamer/user-additions', methods=['POST'])
+@require_init
 def save_user_additions():
     global automator
     if not automator:
@@ -2542,16 +3462,17 @@ def save_user_additions():
 
 @app.route('/api/renamer/error-logs', methods=['GET'])
 def get_renamer_error_logs():
-    return jsonify({'success': True, 'error_logs': automation_state.get('error_logs', [])})
+    return jsonify({'success': True, 'error_logs': list(automation_state['error_logs'])})
 
 
 @app.route('/api/renamer/error-logs/clear', methods=['POST'])
 def clear_renamer_error_logs():
-    automation_state['error_logs'] = []
+    automation_state['error_logs'].clear()
     return jsonify({'success': True})
 
 
 @app.route('/api/renamer/start', methods=['POST'])
+@require_init
 def start_automation():
     global automator
     if not automator:
@@ -2574,9 +3495,8 @@ def start_automation():
         def run_thread():
             automator.run_automation(estabelecimento_id, categories, delay, dry_run, custom_prompt, filter_subcategory_id, use_images, only_raw_names, only_standardized, create_backup=create_backup)
 
-        thread = Thread(target=run_thread)
-        thread.daemon = True
-        thread.start()
+        if not submit_job('renamer', run_thread):
+            return jsonify({'error': 'Automacao ja em execucao ou na fila'}), 400
         return jsonify({'success': True, 'message': 'Automacao iniciada'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -2600,57 +3520,238 @@ def stop_automation():
 
 @app.route('/api/renamer/undo-info', methods=['GET'])
 def renamer_undo_info():
-    with _undo_lock:
+    with _undo_locks['renamer']:
         count = len(undo_store['renamer'])
     return jsonify({'count': count, 'available': count > 0})
 
 
+def _bulk_update(db_client, updates, label):
+    """Aplica [(doc_ref, campos), ...] com um BulkWriter (escritas em paralelo, com
+    retentativa) e aguarda todas. Retorna (sucessos, erros)."""
+    counts = Counter()
+    lock = threading.Lock()
+    writer = db_client.bulk_writer()
+
+    def _on_result(reference, result, bulk_writer):
+        with lock:
+            counts['ok'] += 1
+
+    def _on_error(error, bulk_writer):
+        if error.attempts < 3:
+            return True
+        logger.error(f"{label} erro {error.operation.reference.id}: {error.message}")
+        with lock:
+            counts['errors'] += 1
+        return False
+
+    writer.on_write_result(_on_result)
+    writer.on_write_error(_on_error)
+    for doc_ref, fields in updates:
+        try:
+            writer.update(doc_ref, fields)
+        except Exception as e:
+            logger.error(f"{label} erro {doc_ref.id}: {e}")
+            with lock:
+                counts['errors'] += 1
+    writer.close()
+    return counts['ok'], counts['errors']
+
+
 @app.route('/api/renamer/undo', methods=['POST'])
+@require_init
 def renamer_undo():
     global automator
     if not automator:
         return jsonify({'error': 'Automatizador nao inicializado'}), 500
     if automation_state['running']:
         return jsonify({'error': 'Aguarde a execucao terminar antes de desfazer'}), 400
-    with _undo_lock:
+    with _undo_locks['renamer']:
         changes = list(undo_store['renamer'])
     if not changes:
         return jsonify({'error': 'Nenhuma alteracao para desfazer'}), 400
-    reverted, errors = 0, 0
-    for entry in changes:
-        try:
-            doc_ref = (automator.db.collection('estabelecimentos')
-                       .document(entry['estabelecimento_id'])
-                       .collection('Products')
-                       .document(entry['product_id']))
-            doc_ref.update({'name': entry['old_name']})
-            reverted += 1
-        except Exception as e:
-            logger.error(f"Undo renamer erro {entry['product_id']}: {e}")
-            errors += 1
-    with _undo_lock:
+    reverted, errors = _bulk_update(automator.db, (
+        (automator.db.collection('estabelecimentos')
+         .document(entry['estabelecimento_id'])
+         .collection('Products')
+         .document(entry['product_id']), {'name': entry['old_name']})
+        for entry in changes
+    ), 'Undo renamer')
+    with _undo_locks['renamer']:
         undo_store['renamer'].clear()
     return jsonify({'success': True, 'reverted': reverted, 'errors': errors})
 
 
+def _logs_etag(logs):
+    """ETag barato para os logs: o seq do buffer muda a cada append."""
+    return f"{logs.seq}-{len(logs)}"
+
+
+def _logs_cursor():
+    """Cursor incremental dos logs: ?since=<seq> ou o header Last-Event-ID."""
+    raw = request.args.get('since') or request.headers.get('Last-Event-ID')
+    if raw is None:
+        return None
+    try:
+        return int(raw)
+    except ValueError:
+        return None
+
+
+def _logs_response(logs, dumps=None):
+    """Fallback HTTP dos logs (o frontend recebe tudo via WebSocket).
+    Com cursor responde NDJSON so com as entradas novas (X-Log-Seq traz o seq a
+    guardar para o proximo pedido); sem cursor devolve a lista inteira e 304
+    quando o cliente ja tem a versao atual."""
+    cursor = _logs_cursor()
+    if cursor is not None:
+        seq, entries = logs.since(cursor)
+
+        def _ndjson():
+            for entry in entries:
+                yield _dumps(entry) + b'\n'
+
+        resp = Response(_ndjson(), mimetype="application/x-ndjson")
+        resp.headers['X-Log-Seq'] = str(seq)
+        return resp
+    etag = _logs_etag(logs)
+    if etag in request.if_none_match:
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        return resp
+    logs = list(logs)
+    if dumps:
+        resp = Response(dumps({'logs': logs}), mimetype="application/json")
+    else:
+        resp = jsonify({'logs': logs})
+    resp.set_etag(etag)
+    return resp
+
+
+def _json_response(obj, status=200):
+    """Resposta JSON serializada com _dumps (orjson quando disponivel)."""
+    return Response(_dumps(obj), status=status, mimetype="application/json")
+
+
+REQUIRED = object()
+
+
+def _coerce_field(kind, value):
+    if kind is str:
+        if not isinstance(value, str):
+            raise ValueError
+        return value.strip()
+    if kind is bool:
+        if not isinstance(value, (bool, int)):
+            raise ValueError
+        return bool(value)
+    if isinstance(value, bool):
+        raise ValueError
+    return kind(value)
+
+
+def parse_body(fields):
+    """Le o corpo JSON uma unica vez e valida/converte pelos campos declarados
+    ({nome: (tipo, padrao)}, padrao REQUIRED = obrigatorio). Strings vazias e
+    null valem o padrao. Devolve (valores, None) ou (None, mensagem de erro)."""
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    elif not isinstance(data, dict):
+        return None, 'Corpo da requisicao deve ser um objeto JSON'
+    values, missing = {}, []
+    for name, (kind, default) in fields.items():
+        raw = data.get(name)
+        try:
+            value = None if raw is None else _coerce_field(kind, raw)
+        except (TypeError, ValueError):
+            return None, f"Campo '{name}' invalido"
+        if value is None or value == '':
+            if default is REQUIRED:
+                missing.append(name)
+                continue
+            value = default
+        values[name] = value
+    if missing:
+        return None, f"{' e '.join(missing)} {'sao obrigatorios' if len(missing) > 1 else 'e obrigatorio'}"
+    return values, None
+
+
+_status_cache = {}
+
+
+def _status_fingerprint(state, keys):
+    return (state[keys[0]], state[keys[2]], tuple(state[keys[1]].values()), job_queue_depth())
+
+
+def _status_body(state, keys):
+    """JSON das rotas /status e do stream SSE: chaves do estado + queue_depth."""
+    body = {k: state[k] for k in keys}
+    body['queue_depth'] = job_queue_depth()
+    return _dumps(body)
+
+
+def _status_response(name, state, keys=('running', 'progress', 'current_product')):
+    """Resposta das rotas /status reaproveitando o JSON ja serializado enquanto
+    o estado (flags + valores do progresso + fila) nao muda."""
+    fingerprint = _status_fingerprint(state, keys)
+    cached = _status_cache.get(name)
+    if cached is None or cached[0] != fingerprint:
+        cached = (fingerprint, _status_body(state, keys))
+        _status_cache[name] = cached
+    return Response(cached[1], mimetype="application/json")
+
+
+SSE_KEEPALIVE_SECONDS = 15
+# Cada stream aberto ocupa uma thread do servidor: encerra apos este tempo (o
+# EventSource reconecta sozinho) e assim que o modulo fica ocioso
+SSE_MAX_SECONDS = 300
+SSE_IDLE_RETRY_MS = 10000
+
+
+def _status_stream(state, keys=('running', 'progress', 'current_product')):
+    """Server-Sent Events com o status: envia um evento so quando o estado muda
+    (acordado pelo emit de progresso) e um comentario de keepalive quando ocioso.
+    Alternativa ao polling de /status para clientes sem WebSocket. O stream termina
+    quando a execucao nao esta rodando (com retry maior para a reconexao) ou apos
+    SSE_MAX_SECONDS."""
+    def _generate():
+        last = None
+        deadline = time.monotonic() + SSE_MAX_SECONDS
+        while True:
+            fingerprint = _status_fingerprint(state, keys)
+            if fingerprint != last:
+                last = fingerprint
+                yield f"data: {_status_body(state, keys).decode()}\n\n"
+            if not state[keys[0]]:
+                yield f"retry: {SSE_IDLE_RETRY_MS}\n\n"
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            with progress_changed:
+                woken = progress_changed.wait(timeout=min(SSE_KEEPALIVE_SECONDS, remaining))
+            if not woken:
+                yield ": keepalive\n\n"
+
+    return Response(_generate(), mimetype="text/event-stream",
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.route('/api/renamer/status', methods=['GET'])
 def renamer_status():
-    return jsonify({
-        'running': automation_state['running'],
-        'progress': automation_state['progress'],
-        'current_product': automation_state['current_product']
-    })
+    return _status_response('renamer', automation_state)
 
 
 @app.route('/api/renamer/logs', methods=['GET'])
 def renamer_logs():
-    return jsonify({'logs': automation_state['logs']})
+    return _logs_response(automation_state['logs'])
 
 
 # ============================================================
 # Rotas: Explorador Avancado
 # ============================================================
 @app.route('/api/explorer/explore', methods=['POST'])
+@require_init
 def explorer_explore():
     global advanced_explorer
     if not advanced_explorer:
@@ -2662,13 +3763,10 @@ def explorer_explore():
         path = data.get('path', '').strip()
         max_docs = min(int(data.get('max_docs', 10)), 200)
 
-        if path in explorer_state['structure_cache']:
-            cached_result = explorer_state['structure_cache'][path]
+        cached_result = explorer_state['structure_cache'].get(path)
+        if cached_result is not None:
             cached_result['from_cache'] = True
-            return Response(
-                json.dumps({'success': True, 'data': cached_result}, default=firestore_default),
-                mimetype="application/json"
-            )
+            return _json_response({'success': True, 'data': cached_result})
 
         if '*' in path:
             result = _explore_wildcard(path, max_docs, advanced_explorer)
@@ -2676,15 +3774,13 @@ def explorer_explore():
             result = advanced_explorer.explore_firestore_path(path, max_docs)
 
         explorer_state['structure_cache'][path] = result
-        return Response(
-            json.dumps({'success': True, 'data': result}, default=firestore_default),
-            mimetype="application/json"
-        )
+        return _json_response({'success': True, 'data': result})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/explorer/suggestions', methods=['POST'])
+@require_init
 def explorer_suggestions():
     global advanced_explorer
     if not advanced_explorer:
@@ -2693,47 +3789,45 @@ def explorer_suggestions():
         data = request.json or {}
         partial_path = data.get('path', '').strip()
         suggestions = advanced_explorer.get_path_suggestions(partial_path)
-        return Response(
-            json.dumps({'success': True, 'suggestions': suggestions}, default=firestore_default),
-            mimetype="application/json"
-        )
+        return _json_response({'success': True, 'suggestions': suggestions})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/explorer/cache', methods=['GET'])
 def explorer_cache_list():
-    return Response(
-        json.dumps({'success': True, 'cached_paths': list(explorer_state['structure_cache'].keys())}, default=firestore_default),
-        mimetype="application/json"
-    )
+    return _json_response({'success': True, 'cached_paths': list(explorer_state['structure_cache'])})
 
 
 @app.route('/api/explorer/cache/<path:cached_path>', methods=['GET'])
 def explorer_cache_get(cached_path):
-    if cached_path in explorer_state['structure_cache']:
-        result = explorer_state['structure_cache'][cached_path]
+    result = explorer_state['structure_cache'].get(cached_path)
+    if result is not None:
         result['from_cache'] = True
-        return Response(
-            json.dumps({'success': True, 'data': result}, default=firestore_default),
-            mimetype="application/json"
-        )
+        return _json_response({'success': True, 'data': result})
     return jsonify({'error': 'Caminho nao encontrado no cache'}), 404
 
 
 @app.route('/api/explorer/export/<path:cached_path>', methods=['GET'])
 def explorer_export(cached_path):
-    if cached_path in explorer_state['structure_cache']:
-        result = explorer_state['structure_cache'][cached_path]
-        export_data = {
-            "firestore_structure": result,
-            "exported_at": datetime.now().isoformat(),
-            "export_format": "firestore_structure_v1"
-        }
-        response = Response(
-            json.dumps(export_data, default=firestore_default),
-            mimetype="application/json"
-        )
+    result = explorer_state['structure_cache'].get(cached_path)
+    if result is not None:
+        exported_at = datetime.now().isoformat()
+
+        def _stream():
+            # Serializa em pedacos: o download comeca antes do JSON inteiro
+            # ficar pronto e nao ha uma string gigante em memoria
+            buf, size = ['{"firestore_structure": '], 0
+            for chunk in json.JSONEncoder(default=firestore_default).iterencode(result):
+                buf.append(chunk)
+                size += len(chunk)
+                if size >= 65536:
+                    yield ''.join(buf)
+                    buf, size = [], 0
+            yield ''.join(buf)
+            yield f', "exported_at": {json.dumps(exported_at)}, "export_format": "firestore_structure_v1"}}'
+
+        response = Response(_stream(), mimetype="application/json")
         response.headers['Content-Disposition'] = f'attachment; filename=firestore_structure_{cached_path.replace("/", "_")}.json'
         return response
     return jsonify({'error': 'Caminho nao encontrado no cache'}), 404
@@ -2741,28 +3835,19 @@ def explorer_export(cached_path):
 
 @app.route('/api/explorer/status', methods=['GET'])
 def explorer_status():
-    return Response(
-        json.dumps({
-            'exploring': explorer_state['exploring'],
-            'progress': explorer_state['progress'],
-            'current_path': explorer_state['current_path']
-        }, default=firestore_default),
-        mimetype="application/json"
-    )
+    return _status_response('explorer', explorer_state, ('exploring', 'progress', 'current_path'))
 
 
 @app.route('/api/explorer/logs', methods=['GET'])
 def explorer_logs():
-    return Response(
-        json.dumps({'logs': explorer_state['logs']}, default=firestore_default),
-        mimetype="application/json"
-    )
+    return _logs_response(explorer_state['logs'], dumps=_dumps)
 
 
 # ============================================================
 # Rotas: Explorador Simples
 # ============================================================
 @app.route('/api/explorer-simple/explore', methods=['POST'])
+@require_init
 def simple_explore():
     global simple_explorer
     if not simple_explorer:
@@ -2787,15 +3872,16 @@ def simple_explore():
             result = simple_explorer.explore(path, max_docs)
 
         result_safe = to_json_safe(result)
-        return Response(json.dumps({'success': True, 'data': result_safe}, ensure_ascii=False), mimetype="application/json")
+        return _json_response({'success': True, 'data': result_safe})
     except Exception as e:
-        return Response(json.dumps({'error': str(e)}), status=500, mimetype="application/json")
+        return _json_response({'error': str(e)}, status=500)
 
 
 # ============================================================
 # Rotas: Categorizador
 # ============================================================
 @app.route('/api/categorizer/prompt', methods=['GET'])
+@require_init
 def get_cat_prompt():
     global categorizer
     if not categorizer:
@@ -2804,6 +3890,7 @@ def get_cat_prompt():
 
 
 @app.route('/api/categorizer/prompt', methods=['POST'])
+@require_init
 def save_cat_prompt():
     global categorizer
     if not categorizer:
@@ -2818,6 +3905,7 @@ def save_cat_prompt():
 
 
 @app.route('/api/categorizer/start', methods=['POST'])
+@require_init
 def start_categorization():
     global categorizer
     if not categorizer:
@@ -2843,6 +3931,29 @@ def start_categorization():
         if max_categories not in (1, 2):
             max_categories = 2
         create_backup = bool(data.get('create_backup', True))
+        max_workers = int(data.get('max_workers') or 0) or None
+
+        if data.get('batch_api', False):
+            # Execucao offline pelo Batch API: so o modo simples (uma categoria por
+            # produto, sem imagens); max_categories so vale para o modo review
+            if review_categorized or use_images:
+                return jsonify({'error': 'batch_api nao suporta review_categorized nem use_images'}), 400
+
+            def run():
+                categorizer.run_categorization_batchapi(
+                    estabelecimento_id, dry_run,
+                    only_uncategorized=only_uncategorized,
+                    filter_category_id=filter_category_id,
+                    include_mercearia=include_mercearia,
+                    filter_subcategory_id=filter_subcategory_id,
+                    fallback_category_id=fallback_category_id,
+                    fallback_subcategory_id=fallback_subcategory_id,
+                    create_backup=create_backup,
+                )
+
+            if not submit_job('categorizer', run):
+                return jsonify({'error': 'Categorizacao ja em execucao ou na fila'}), 400
+            return jsonify({'success': True, 'message': 'Categorizacao via Batch API iniciada'})
 
         def run():
             categorizer.run_categorization(
@@ -2857,9 +3968,11 @@ def start_categorization():
                 review_categorized=review_categorized,
                 max_categories=max_categories,
                 create_backup=create_backup,
+                max_workers=max_workers,
             )
 
-        Thread(target=run, daemon=True).start()
+        if not submit_job('categorizer', run):
+            return jsonify({'error': 'Categorizacao ja em execucao ou na fila'}), 400
         return jsonify({'success': True, 'message': 'Categorizacao iniciada'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -2870,6 +3983,9 @@ def stop_categorization():
     if not categorizer_state['running']:
         return jsonify({'error': 'Nenhuma categorizacao em execucao'}), 400
     categorizer_state['running'] = False
+    if categorizer:
+        categorizer.stop_batchapi()
+        categorizer.emit_status()
     return jsonify({'success': True})
 
 
@@ -2878,36 +3994,31 @@ def _undo_categorizer_changes(history_key):
     global categorizer
     if not categorizer:
         return 0, 0, 'Categorizador nao inicializado'
-    with _undo_lock:
+    with _undo_locks[history_key]:
         changes = list(undo_store[history_key])
     if not changes:
         return 0, 0, 'Nenhuma alteracao para desfazer'
-    reverted, errors = 0, 0
-    for entry in changes:
-        try:
-            doc_ref = (categorizer.db.collection('estabelecimentos')
-                       .document(entry['estabelecimento_id'])
-                       .collection('Products')
-                       .document(entry['product_id']))
+    def _updates():
+        for entry in changes:
             old = entry.get('old_data', {})
-            doc_ref.update({
+            yield categorizer._products_col(entry['estabelecimento_id']).document(entry['product_id']), {
                 'categoriesIds': old.get('categoriesIds', []),
                 'subcategoriesIds': old.get('subcategoriesIds', []),
                 'shelves': old.get('shelves', []),
                 'shelvesIds': old.get('shelvesIds', []),
-            })
-            reverted += 1
-        except Exception as e:
-            logger.error(f"Undo categorizer erro {entry['product_id']}: {e}")
-            errors += 1
-    with _undo_lock:
+            }
+
+    reverted, errors = _bulk_update(categorizer.db, _updates(), 'Undo categorizer')
+    for est_id in {entry['estabelecimento_id'] for entry in changes}:
+        categorizer._invalidate_products_cache(est_id)
+    with _undo_locks[history_key]:
         undo_store[history_key].clear()
     return reverted, errors, None
 
 
 @app.route('/api/categorizer/undo-info', methods=['GET'])
 def categorizer_undo_info():
-    with _undo_lock:
+    with _undo_locks['categorizer']:
         count = len(undo_store['categorizer'])
     return jsonify({'count': count, 'available': count > 0})
 
@@ -2924,7 +4035,7 @@ def categorizer_undo():
 
 @app.route('/api/categorizer-targeted/undo-info', methods=['GET'])
 def categorizer_targeted_undo_info():
-    with _undo_lock:
+    with _undo_locks['categorizer_targeted']:
         count = len(undo_store['categorizer_targeted'])
     return jsonify({'count': count, 'available': count > 0})
 
@@ -2941,19 +4052,21 @@ def categorizer_targeted_undo():
 
 @app.route('/api/categorizer/status', methods=['GET'])
 def categorizer_status():
-    return jsonify({
-        'running': categorizer_state['running'],
-        'progress': categorizer_state['progress'],
-        'current_product': categorizer_state['current_product']
-    })
+    return _status_response('categorizer', categorizer_state)
+
+
+@app.route('/api/categorizer/stream', methods=['GET'])
+def categorizer_stream():
+    return _status_stream(categorizer_state)
 
 
 @app.route('/api/categorizer/logs', methods=['GET'])
 def categorizer_logs():
-    return jsonify({'logs': categorizer_state['logs']})
+    return _logs_response(categorizer_state['logs'])
 
 
 @app.route('/api/categorizer/categories', methods=['GET'])
+@require_init
 def get_categorizer_categories():
     global categorizer
     if not categorizer:
@@ -2966,6 +4079,7 @@ def get_categorizer_categories():
 
 
 @app.route('/api/subcategories', methods=['GET'])
+@require_init
 def get_subcategories():
     global categorizer
     if not categorizer:
@@ -2983,33 +4097,41 @@ def get_subcategories():
 # ============================================================
 # Rotas: Categorizador Dirigido
 # ============================================================
+START_TARGETED_FIELDS = {
+    'estabelecimento_id': (str, REQUIRED),
+    'target_category_id': (str, REQUIRED),
+    'include_others': (bool, False),
+    'delay': (float, 0.5),
+    'dry_run': (bool, False),
+    'filter_subcategory_id': (str, None),
+    'find_mode': (bool, False),
+    'include_mercearia': (bool, False),
+    'fallback_category_id': (str, None),
+    'fallback_subcategory_id': (str, None),
+}
+
+
 @app.route('/api/categorizer-targeted/start', methods=['POST'])
+@require_init
 def start_categorization_targeted():
     global categorizer
     if not categorizer:
         return jsonify({'error': 'Categorizador nao inicializado'}), 500
     if categorizer_targeted_state['running']:
         return jsonify({'error': 'Ja em execucao'}), 400
-    data = request.json or {}
-    est_id = data.get('estabelecimento_id', '').strip()
-    target_cat_id = data.get('target_category_id', '').strip()
-    if not est_id or not target_cat_id:
-        return jsonify({'error': 'estabelecimento_id e target_category_id sao obrigatorios'}), 400
-    include_others = bool(data.get('include_others', False))
-    delay = float(data.get('delay', 0.5))
-    dry_run = bool(data.get('dry_run', False))
-    filter_subcategory_id = data.get('filter_subcategory_id', '').strip() or None
-    find_mode = bool(data.get('find_mode', False))
-    include_mercearia = bool(data.get('include_mercearia', False))
-    fallback_category_id = data.get('fallback_category_id', '').strip() or None
-    fallback_subcategory_id = data.get('fallback_subcategory_id', '').strip() or None
+    body, error = parse_body(START_TARGETED_FIELDS)
+    if error:
+        return jsonify({'error': error}), 400
 
     def run():
-        categorizer.run_categorization_targeted(est_id, target_cat_id, include_others, delay, dry_run,
-                                                 filter_subcategory_id, find_mode, include_mercearia,
-                                                 fallback_category_id, fallback_subcategory_id)
-
-    Thread(target=run, daemon=True).start()
+        categorizer.run_categorization_targeted(body['estabelecimento_id'], body['target_category_id'],
+                                                 body['include_others'], body['delay'], body['dry_run'],
+                                                 body['filter_subcategory_id'], body['find_mode'],
+                                                 body['include_mercearia'],
+                                                 body['fallback_category_id'], body['fallback_subcategory_id'])
+
+    if not submit_job('categorizer_targeted', run):
+        return jsonify({'error': 'Ja em execucao ou na fila'}), 400
     return jsonify({'success': True, 'message': 'Categorizacao dirigida iniciada'})
 
 
@@ -3018,21 +4140,24 @@ def stop_categorization_targeted():
     if not categorizer_targeted_state['running']:
         return jsonify({'error': 'Nenhuma execucao em andamento'}), 400
     categorizer_targeted_state['running'] = False
+    if categorizer:
+        categorizer.emit_status_targeted()
     return jsonify({'success': True})
 
 
 @app.route('/api/categorizer-targeted/status', methods=['GET'])
 def categorizer_targeted_status():
-    return jsonify({
-        'running': categorizer_targeted_state['running'],
-        'progress': categorizer_targeted_state['progress'],
-        'current_product': categorizer_targeted_state['current_product']
-    })
+    return _status_response('categorizer_targeted', categorizer_targeted_state)
+
+
+@app.route('/api/categorizer-targeted/stream', methods=['GET'])
+def categorizer_targeted_stream():
+    return _status_stream(categorizer_targeted_state)
 
 
 @app.route('/api/categorizer-targeted/logs', methods=['GET'])
 def categorizer_targeted_logs_route():
-    return jsonify({'logs': categorizer_targeted_state['logs']})
+    return _logs_response(categorizer_targeted_state['logs'])
 
 
 # ============================================================
@@ -3040,6 +4165,7 @@ def categorizer_targeted_logs_route():
 # ============================================================
 
 @app.route('/api/tagger/categories', methods=['GET'])
+@require_init
 def tagger_categories():
     global tagger
     if not tagger:
@@ -3063,6 +4189,7 @@ def tagger_categories():
 
 
 @app.route('/api/tagger/start', methods=['POST'])
+@require_init
 def tagger_start():
     global tagger
     if not tagger:
@@ -3088,15 +4215,15 @@ def tagger_start():
         def run_thread():
             tagger.run_tagging(estabelecimento_id, categories, delay, dry_run, use_images, overwrite, tag_characteristics, only_untagged, tag_brands, filter_subcategory_id, create_backup=create_backup)
 
-        t = Thread(target=run_thread)
-        t.daemon = True
-        t.start()
+        if not submit_job('tagger', run_thread):
+            return jsonify({'error': 'Tagger ja em execucao ou na fila'}), 400
         return jsonify({'success': True, 'message': 'Tagger iniciado'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/tagger/prompt', methods=['GET'])
+@require_init
 def get_tagger_prompt():
     global tagger
     if not tagger:
@@ -3105,6 +4232,7 @@ def get_tagger_prompt():
 
 
 @app.route('/api/tagger/prompt', methods=['POST'])
+@require_init
 def save_tagger_prompt():
     global tagger
     if not tagger:
@@ -3136,16 +4264,12 @@ def tagger_stop():
 
 @app.route('/api/tagger/status', methods=['GET'])
 def tagger_status():
-    return jsonify({
-        'running': tagger_state['running'],
-        'progress': tagger_state['progress'],
-        'current_product': tagger_state['current_product']
-    })
+    return _status_response('tagger', tagger_state)
 
 
 @app.route('/api/tagger/logs', methods=['GET'])
 def tagger_logs():
-    return jsonify({'logs': tagger_state['logs']})
+    return _logs_response(tagger_state['logs'])
 
 
 # ============================================================
@@ -3164,77 +4288,98 @@ def download_backup(filename):
 # ============================================================
 # Rotas: Estatísticas diárias
 # ============================================================
+_daily_stats_body = (None, b'')
+
+
 @app.route('/api/stats/daily', methods=['GET'])
 def daily_stats_api():
-    return jsonify({'success': True, 'today': get_today_stats(), 'all': get_all_stats()})
+    # Historico inteiro serializado so quando algum uso novo foi registrado
+    global _daily_stats_body
+    version = stats_version()
+    if _daily_stats_body[0] != version:
+        _daily_stats_body = (version, _dumps({'success': True, 'today': get_today_stats(), 'all': get_all_stats()}))
+    return Response(_daily_stats_body[1], mimetype="application/json")
 
 
 # ============================================================
 # WebSocket
 # ============================================================
+# Quantas linhas de log de cada modulo vao no bootstrap do connect; o historico
+# completo (ate o maxlen do buffer) continua disponivel em /logs
+BOOTSTRAP_LOG_TAIL = 100
+
+
+def _bootstrap_logs(logs):
+    """Ultimas BOOTSTRAP_LOG_TAIL entradas + o seq para retomar via /logs?since=."""
+    seq, tail = logs.since(logs.seq - BOOTSTRAP_LOG_TAIL)
+    return {'logs': tail, 'log_seq': seq}
+
+
 @socketio.on('connect')
 def handle_connect():
     # Se nao ha nada rodando, zera os estados para a pagina iniciar limpa
     if not automation_state['running']:
-        automation_state['progress'] = {
-            'total': 0, 'processed': 0, 'updated': 0,
-            'unchanged': 0, 'errors': 0, 'tokens_used': 0, 'estimated_cost': 0.0
-        }
+        reset_progress(automation_state['progress'])
         automation_state['current_product'] = None
-        automation_state['logs'] = []
+        automation_state['logs'].clear()
     if not categorizer_state['running']:
-        categorizer_state['progress'] = {
-            'total': 0, 'processed': 0, 'updated': 0,
-            'errors': 0, 'tokens_used': 0, 'estimated_cost': 0.0
-        }
+        reset_progress(categorizer_state['progress'])
         categorizer_state['current_product'] = None
-        categorizer_state['logs'] = []
+        categorizer_state['logs'].clear()
     if not categorizer_targeted_state['running']:
-        categorizer_targeted_state['progress'] = {
-            'total': 0, 'processed': 0, 'updated': 0,
-            'skipped': 0, 'errors': 0, 'tokens_used': 0, 'estimated_cost': 0.0
-        }
+        reset_progress(categorizer_targeted_state['progress'])
         categorizer_targeted_state['current_product'] = None
-        categorizer_targeted_state['logs'] = []
-
-    emit('renamer_status_update', {
-        'running': automation_state['running'],
-        'progress': automation_state['progress'],
-        'current_product': automation_state['current_product']
-    })
-    emit('explorer_status_update', {
-        'exploring': explorer_state['exploring'],
-        'progress': explorer_state['progress'],
-        'current_path': explorer_state['current_path']
-    })
-    emit('categorizer_status_update', {
-        'running': categorizer_state['running'],
-        'progress': categorizer_state['progress'],
-        'current_product': categorizer_state['current_product']
-    })
-    emit('categorizer_targeted_status_update', {
-        'running': categorizer_targeted_state['running'],
-        'progress': categorizer_targeted_state['progress'],
-        'current_product': categorizer_targeted_state['current_product']
-    })
+        categorizer_targeted_state['logs'].clear()
     if not tagger_state['running']:
-        tagger_state['progress'] = {
-            'total': 0, 'processed': 0, 'updated': 0,
-            'skipped': 0, 'errors': 0, 'tokens_used': 0, 'estimated_cost': 0.0
-        }
+        reset_progress(tagger_state['progress'])
         tagger_state['current_product'] = None
-        tagger_state['logs'] = []
-    emit('tagger_status_update', {
-        'running': tagger_state['running'],
-        'progress': tagger_state['progress'],
-        'current_product': tagger_state['current_product']
+        tagger_state['logs'].clear()
+
+    # Um unico frame com o estado de todos os modulos (o frontend redistribui
+    # para os handlers de *_status_update / *_logs_update)
+    emit('bootstrap', {
+        'renamer': {
+            'status': {
+                'running': automation_state['running'],
+                'progress': automation_state['progress'],
+                'current_product': automation_state['current_product']
+            },
+            **_bootstrap_logs(automation_state['logs']),
+        },
+        'explorer': {
+            'status': {
+                'exploring': explorer_state['exploring'],
+                'progress': explorer_state['progress'],
+                'current_path': explorer_state['current_path']
+            },
+            **_bootstrap_logs(explorer_state['logs']),
+        },
+        'categorizer': {
+            'status': {
+                'running': categorizer_state['running'],
+                'progress': categorizer_state['progress'],
+                'current_product': categorizer_state['current_product']
+            },
+            **_bootstrap_logs(categorizer_state['logs']),
+        },
+        'categorizer_targeted': {
+            'status': {
+                'running': categorizer_targeted_state['running'],
+                'progress': categorizer_targeted_state['progress'],
+                'current_product': categorizer_targeted_state['current_product']
+            },
+            **_bootstrap_logs(categorizer_targeted_state['logs']),
+        },
+        'tagger': {
+            'status': {
+                'running': tagger_state['running'],
+                'progress': tagger_state['progress'],
+                'current_product': tagger_state['current_product']
+            },
+            **_bootstrap_logs(tagger_state['logs']),
+        },
+        'daily_stats': get_today_stats(),
     })
-    emit('tagger_logs_update', {'logs': tagger_state['logs']})
-    emit('renamer_logs_update', {'logs': automation_state['logs']})
-    emit('explorer_logs_update', {'logs': explorer_state['logs']})
-    emit('categorizer_logs_update', {'logs': categorizer_state['logs']})
-    emit('categorizer_targeted_logs_update', {'logs': categorizer_targeted_state['logs']})
-    emit('daily_stats_update', get_today_stats())
 
 
 @socketio.on('disconnect')
@@ -3249,9 +4394,6 @@ def handle_disconnect():
 # ============================================================
 _init_thread = Thread(target=init_all, daemon=True)
 _init_thread.start()
-_init_thread.join(timeout=5)  # Permite no maximo 5 segundos para inicializar
-if _init_thread.is_alive():
-    logger.warning("Inicializacao ainda em andamento (timeout). Servidor funcionara sem Firestore completo.")
 
 
 # ============================================================
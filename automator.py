@@ -3,11 +3,12 @@ from datetime import datetime
 import threading
 import time
 import re
-from concurrent.futures import ThreadPoolExecutor
 
+from firebase_admin import firestore
 import openai as _openai_module
-from extensions import openai_client, socketio, _is_quota_error, emit_quota_exceeded
-from utils import to_json_safe, firestore_default, safe_sample, record_daily_usage, automation_state, undo_store, _undo_lock
+import extensions as _ext
+from extensions import socketio, get_db, _is_quota_error, emit_quota_exceeded
+from utils import to_json_safe, firestore_default, record_daily_usage, automation_state, undo_store, _undo_locks, reset_progress, chunked
 from utils import get_today_stats
 from config import logger
 
@@ -20,8 +21,8 @@ def _parse_rate_limit_wait(error: Exception, default: float = 5.0) -> float:
 
 
 class FirestoreProductAutomator:
-    def __init__(self, db_client):
-        self.db = db_client
+    def __init__(self, db_client=None):
+        self.db = db_client if db_client is not None else get_db()
         self.tokens_used = 0
         self.estimated_cost = 0
         self.input_token_cost  = 0.0025 / 1000   # gpt-4o
@@ -202,7 +203,7 @@ MARCAS CONHECIDAS (use para identificar o tipo do produto quando o nome for ambi
             doc_ref = self.db.collection('Automacoes').document('padronizador_nomes')
             doc_ref.set({
                 'base_prompt': prompt,
-                'updated_at': datetime.now().isoformat(),
+                'updated_at': firestore.SERVER_TIMESTAMP,
                 'tool': 'padronizador_nomes',
                 'description': 'Prompt usado pela IA para padronizar nomes de produtos'
             }, merge=True)
@@ -218,7 +219,7 @@ MARCAS CONHECIDAS (use para identificar o tipo do produto quando o nome for ambi
             doc_ref = self.db.collection('Automacoes').document('padronizador_nomes')
             doc_ref.set({
                 'user_additions': additions,
-                'updated_at': datetime.now().isoformat(),
+                'updated_at': firestore.SERVER_TIMESTAMP,
             }, merge=True)
             self.user_additions = additions
             logger.info("Instrucoes adicionais salvas no Firestore (Automacoes/padronizador_nomes)")
@@ -231,12 +232,8 @@ MARCAS CONHECIDAS (use para identificar o tipo do produto quando o nome for ambi
         timestamp = datetime.now().strftime("%H:%M:%S")
         log_entry = {'timestamp': timestamp, 'message': message, 'level': level}
         automation_state['logs'].append(log_entry)
-        if len(automation_state['logs']) > 500:
-            automation_state['logs'] = automation_state['logs'][-500:]
         if level == 'error':
             automation_state['error_logs'].append(log_entry)
-            if len(automation_state['error_logs']) > 200:
-                automation_state['error_logs'] = automation_state['error_logs'][-200:]
             try:
                 socketio.emit('renamer_error_log_update', log_entry)
             except Exception:
@@ -277,6 +274,9 @@ MARCAS CONHECIDAS (use para identificar o tipo do produto quando o nome for ambi
             logger.error(f"Erro ao carregar categorias: {e}")
             return []
 
+    # Limite de valores do operador array_contains_any do Firestore
+    ARRAY_CONTAINS_ANY_MAX = 10
+
     def get_products_from_firestore(self, estabelecimento_id: str, categories: List[str],
                                      filter_subcategory_id: str = None,
                                      use_images: bool = False) -> List[Dict]:
@@ -285,7 +285,18 @@ MARCAS CONHECIDAS (use para identificar o tipo do produto quando o nome for ambi
                        .document(estabelecimento_id)
                        .collection('Products'))
             products = []
-            for doc in col_ref.stream():
+            # Projecao: o servidor so envia os campos usados aqui
+            fields = ['name', 'description', 'categoriesIds', 'subcategoriesIds']
+            if use_images:
+                fields.append('images')
+            # Filtro no servidor (uma clausula de array por consulta): subcategoria quando
+            # houver, senao as categorias; os filtros abaixo continuam valendo no cliente
+            query = col_ref
+            if filter_subcategory_id:
+                query = query.where('subcategoriesIds', 'array_contains', filter_subcategory_id)
+            elif categories and len(categories) <= self.ARRAY_CONTAINS_ANY_MAX:
+                query = query.where('categoriesIds', 'array_contains_any', list(categories))
+            for doc in query.select(fields).stream():
                 data = doc.to_dict()
                 if not data or not data.get('name'):
                     continue
@@ -319,7 +330,7 @@ MARCAS CONHECIDAS (use para identificar o tipo do produto quando o nome for ambi
         max_retries = 8
         for attempt in range(max_retries):
             try:
-                response = openai_client.chat.completions.create(
+                response = _ext.openai_client.chat.completions.create(
                     model="gpt-4o",
                     messages=[{"role": "user", "content": full_prompt}],
                     max_tokens=100,
@@ -379,7 +390,7 @@ MARCAS CONHECIDAS (use para identificar o tipo do produto quando o nome for ambi
         max_retries = 8
         for attempt in range(max_retries):
             try:
-                response = openai_client.chat.completions.create(
+                response = _ext.openai_client.chat.completions.create(
                     model="gpt-4o",
                     messages=[{"role": "user", "content": msg_content}],
                     max_tokens=60 * len(product_names),
@@ -455,7 +466,7 @@ MARCAS CONHECIDAS (use para identificar o tipo do produto quando o nome for ambi
             if new_description is not None:
                 update_data['description'] = new_description
             doc_ref.update(update_data)
-            with _undo_lock:
+            with _undo_locks['renamer']:
                 undo_store['renamer'].append({
                     'product_id': product_id,
                     'estabelecimento_id': estabelecimento_id,
@@ -472,7 +483,6 @@ MARCAS CONHECIDAS (use para identificar o tipo do produto quando o nome for ambi
                                 use_images: bool = False):
         total = len(products)
         BATCH_SIZE = 30
-        batches = [products[s:s + BATCH_SIZE] for s in range(0, total, BATCH_SIZE)]
 
         def _process_batch(args):
             batch_start, batch = args
@@ -529,8 +539,9 @@ MARCAS CONHECIDAS (use para identificar o tipo do produto quando o nome for ambi
                         automation_state['progress']['estimated_cost'] = self.estimated_cost
                     self.update_progress()
 
-        with ThreadPoolExecutor(max_workers=1) as executor:
-            list(executor.map(_process_batch, ((i * BATCH_SIZE, b) for i, b in enumerate(batches))))
+        # Lotes em sequencia (um por vez): sem pool, direto na thread da execucao
+        for i, batch in enumerate(chunked(products, BATCH_SIZE)):
+            _process_batch((i * BATCH_SIZE, batch))
 
     @staticmethod
     def _is_raw_name(name: str) -> bool:
@@ -550,10 +561,7 @@ MARCAS CONHECIDAS (use para identificar o tipo do produto quando o nome for ambi
             self.estimated_cost = 0
             automation_state['running'] = True
             automation_state['current_product'] = None
-            automation_state['progress'] = {
-                'total': 0, 'processed': 0, 'updated': 0,
-                'unchanged': 0, 'errors': 0, 'tokens_used': 0, 'estimated_cost': 0.0
-            }
+            reset_progress(automation_state['progress'])
             # Adiciona separador de execucao no log (nao limpa)
             sep = {'timestamp': datetime.now().strftime("%H:%M:%S"), 'message': '─' * 40, 'level': 'separator'}
             automation_state['logs'].append(sep)
@@ -616,11 +624,7 @@ MARCAS CONHECIDAS (use para identificar o tipo do produto quando o nome for ambi
                     return False
 
             total = len(products)
-            automation_state['progress'] = {
-                'total': total, 'processed': 0, 'updated': 0,
-                'unchanged': 0, 'errors': 0,
-                'tokens_used': 0, 'estimated_cost': 0.0,
-            }
+            reset_progress(automation_state['progress'], total)
             self.update_progress()
             self.log_message(f"Processando {total} produtos em lotes de 30", "info")
 
@@ -1,8 +1,8 @@
 import threading
-from datetime import datetime
+from firebase_admin import firestore
 from config import logger
 from extensions import openai_client, socketio, _is_quota_error, emit_quota_exceeded
-from utils import categorizer_state, categorizer_targeted_state, _undo_lock, undo_store, record_daily_usage
+from utils import categorizer_state, categorizer_targeted_state, _undo_locks, undo_store, record_daily_usage
 
 class ProductCategorizerAgent:
     DEFAULT_CAT_SYSTEM_PROMPT = (
@@ -40,7 +40,7 @@ class ProductCategorizerAgent:
         try:
             self.db.collection('Automacoes').document('defenir_catsub').set({
                 'user_additions': additions,
-                'updated_at': datetime.now().isoformat(),
+                'updated_at': firestore.SERVER_TIMESTAMP,
             }, merge=True)
             self.cat_user_additions = additions
             self.cat_system_prompt = self._build_system_prompt()
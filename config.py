@@ -15,3 +15,13 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 SECRET_KEY = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-prod')
+
+# Fallback de credenciais de admin (desenvolvimento local), resolvido uma vez no import
+FALLBACK_ADMIN_USER = os.getenv('ADMIN_USERNAME', '').strip()
+FALLBACK_ADMIN_PASS = os.getenv('ADMIN_PASSWORD', '').strip()
+
+# Categorizador: lotes processados em paralelo e limites da conta OpenAI
+# (usados para limitar a taxa de forma proativa, antes de tomar 429)
+CATEGORIZER_MAX_WORKERS = int(os.getenv('CATEGORIZER_MAX_WORKERS', '10'))
+OPENAI_RPM_LIMIT = int(os.getenv('OPENAI_RPM_LIMIT', '500'))
+OPENAI_TPM_LIMIT = int(os.getenv('OPENAI_TPM_LIMIT', '200000'))
@@ -2,20 +2,18 @@ from typing import List, Dict, Any
 from datetime import datetime
 
 from config import logger
-from utils import safe_sample, to_json_safe
-from extensions import socketio
+from utils import to_json_safe
+from extensions import socketio, get_db
 from utils import explorer_state
 
 class FirestoreStructureExplorer:
-    def __init__(self, db_client):
-        self.db = db_client
+    def __init__(self, db_client=None):
+        self.db = db_client if db_client is not None else get_db()
 
     def log_message(self, message, level="info"):
         timestamp = datetime.now().strftime("%H:%M:%S")
         log_entry = {'timestamp': timestamp, 'message': message, 'level': level}
         explorer_state['logs'].append(log_entry)
-        if len(explorer_state['logs']) > 100:
-            explorer_state['logs'] = explorer_state['logs'][-100:]
         try:
             socketio.emit('explorer_log_update', log_entry)
         except Exception:
@@ -131,8 +129,8 @@ class FirestoreStructureExplorer:
 
 
 class FirestoreSimpleExplorer:
-    def __init__(self, db_client):
-        self.db = db_client
+    def __init__(self, db_client=None):
+        self.db = db_client if db_client is not None else get_db()
 
     def parse_path(self, path: str):
         path = path.strip('/')
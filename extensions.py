@@ -1,26 +1,45 @@
 import os
 import json
+import threading
 import firebase_admin
 from firebase_admin import credentials, firestore
 from openai import OpenAI
 import openai as _openai_module
+from flask.json.provider import DefaultJSONProvider
 from flask_socketio import SocketIO
 from flask_cors import CORS
+from utils import orjson, firestore_default
+from config import logger
 
 # module-level globals set by init_extensions
 socketio = None
 openai_client = None
 _db = None
 _async_mode = None
+_openai_lock = threading.Lock()
+_firebase_lock = threading.Lock()
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider do Flask usando orjson (jsonify e request.get_json)."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=firestore_default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 
 def init_extensions(app):
-    global socketio, openai_client, _db, _async_mode
+    global socketio, openai_client, _async_mode
     try:
-        import gevent as _gevent_check  # noqa
-        _async_mode = 'gevent'
+        # gevent so quando o monkey-patch de app.py foi aplicado (GEVENT=0 roda em threads)
+        from gevent import monkey as _gevent_monkey
+        _async_mode = 'gevent' if _gevent_monkey.is_module_patched('socket') else 'threading'
     except Exception:
         _async_mode = 'threading'
+    if orjson is not None:
+        app.json = OrjsonProvider(app)
     socketio = SocketIO(app, cors_allowed_origins="*", async_mode=_async_mode)
     CORS(app)
     openai_client = OpenAI()
@@ -31,29 +50,49 @@ def init_extensions(app):
 
 
 def init_firebase():
+    """Inicializa o Firebase e o client Firestore uma unica vez (idempotente)."""
     global _db
-    if not firebase_admin._apps:
-        creds_json = os.getenv('FIREBASE_CREDENTIALS_JSON', '').strip()
-        if creds_json:
-            creds_dict = json.loads(creds_json)
-            cred = credentials.Certificate(creds_dict)
-            firebase_admin.initialize_app(cred)
-        elif os.getenv('FIREBASE_CREDENTIALS_PATH') and os.path.exists(os.getenv('FIREBASE_CREDENTIALS_PATH')):
-            cred = credentials.Certificate(os.getenv('FIREBASE_CREDENTIALS_PATH'))
-            firebase_admin.initialize_app(cred)
-        else:
-            firebase_admin.initialize_app()
-    _db = firestore.client()
+    if _db is not None:
+        return _db
+    with _firebase_lock:
+        if _db is not None:
+            return _db
+        if not firebase_admin._apps:
+            creds_json = os.getenv('FIREBASE_CREDENTIALS_JSON', '').strip()
+            if creds_json:
+                creds_dict = json.loads(creds_json)
+                cred = credentials.Certificate(creds_dict)
+                firebase_admin.initialize_app(cred)
+            elif os.getenv('FIREBASE_CREDENTIALS_PATH') and os.path.exists(os.getenv('FIREBASE_CREDENTIALS_PATH')):
+                cred = credentials.Certificate(os.getenv('FIREBASE_CREDENTIALS_PATH'))
+                firebase_admin.initialize_app(cred)
+            else:
+                firebase_admin.initialize_app()
+        _db = firestore.client()
     return _db
 
 
 def get_db():
+    """Client Firestore compartilhado; inicializa sob demanda no primeiro uso."""
+    if _db is None:
+        try:
+            return init_firebase()
+        except Exception as e:
+            logger.warning(f"Firestore indisponivel: {e}")
+            return None
     return _db
 
 
 def _reload_openai_client(api_key: str):
     global openai_client
-    openai_client = OpenAI(api_key=api_key)
+    client = OpenAI(api_key=api_key)
+    with _openai_lock:
+        openai_client = client
+
+
+def reload_openai_client_async(api_key: str):
+    """Recria o client OpenAI em background para nao segurar a requisicao HTTP."""
+    threading.Thread(target=_reload_openai_client, args=(api_key,), daemon=True).start()
 
 
 def _is_quota_error(exc: Exception) -> bool:
@@ -9,7 +9,7 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import openai as _openai_module
 import extensions as _ext
-from utils import record_daily_usage, tagger_state
+from utils import record_daily_usage, tagger_state, reset_progress
 from config import logger
 
 
@@ -57,8 +57,8 @@ class ProductTagger:
         "Sem markdown, sem explicacoes."
     )
 
-    def __init__(self, db_client):
-        self.db = db_client
+    def __init__(self, db_client=None):
+        self.db = db_client if db_client is not None else _ext.get_db()
         self.tokens_used = 0
         self.estimated_cost = 0.0
         self._lock = threading.Lock()
@@ -101,8 +101,6 @@ class ProductTagger:
         }
         with self._lock:
             tagger_state['logs'].append(entry)
-            if len(tagger_state['logs']) > 500:
-                tagger_state['logs'] = tagger_state['logs'][-500:]
         logger.info(f"[TAGGER] {message}")
         try:
             _ext.socketio.emit('tagger_log_update', entry)
@@ -369,10 +367,7 @@ class ProductTagger:
                     create_backup: bool = True):
         tagger_state['running'] = True
         tagger_state['current_product'] = None
-        tagger_state['progress'] = {
-            'total': 0, 'processed': 0, 'updated': 0,
-            'skipped': 0, 'errors': 0, 'tokens_used': 0, 'estimated_cost': 0.0
-        }
+        reset_progress(tagger_state['progress'])
 
         sep = {'timestamp': datetime.now().strftime("%H:%M:%S"), 'message': '─' * 40, 'level': 'separator'}
         tagger_state['logs'].append(sep)
@@ -1,7 +1,12 @@
 import os
+import sys
 import json
-from datetime import datetime
+import atexit
+import time
+from datetime import datetime, timedelta
 import threading
+from collections import deque, OrderedDict
+from itertools import islice
 
 # Serializadores JSON e helpers extraidos de app.py
 
@@ -25,130 +30,404 @@ try:
 except Exception:
     ProtoTimestamp = None
 
+# orjson vem no requirements.txt (acelera as respostas JSON, ver extensions.init_extensions);
+# o fallback para json da stdlib so cobre instalacoes antigas sem ele
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def to_json_safe(value):
-    if DatetimeWithNanoseconds and isinstance(value, DatetimeWithNanoseconds):
-        return value.isoformat()
-    from datetime import datetime
-    if isinstance(value, datetime):
-        return value.isoformat()
-    if GeoPoint and isinstance(value, GeoPoint):
-        return {"_type": "GeoPoint", "latitude": float(value.latitude), "longitude": float(value.longitude)}
-    if hasattr(value, "latitude") and hasattr(value, "longitude") and \
-       isinstance(getattr(value, "latitude"), (int, float)) and \
-       isinstance(getattr(value, "longitude"), (int, float)):
-        return {"_type": "GeoPoint", "latitude": float(value.latitude), "longitude": float(value.longitude)}
-    if DocumentReference and isinstance(value, DocumentReference):
-        return {"_type": "DocumentReference", "path": value.path}
-    if hasattr(value, "path") and hasattr(value, "parent") and hasattr(value, "id"):
-        try:
-            return {"_type": "DocumentReference", "path": str(value.path)}
-        except Exception:
-            pass
+
+def _identity(value):
+    return value
+
+
+def _isoformat(value):
+    return value.isoformat()
+
+
+def _bytes_to_json(value):
+    # bytes, bytearray e memoryview tem .hex() proprio: sem a copia de bytes(value)
+    try:
+        return {"_type": "bytes", "base16": value.hex()}
+    except Exception:
+        return {"_type": "bytes", "len": len(value)}
+
+
+def _intern_short(value):
+    # Nomes de campo e valores tipo enum (unidade, status...) se repetem em todos
+    # os documentos; internar faz as copias apontarem para o mesmo objeto
+    return sys.intern(value) if len(value) < 64 else value
+
+
+# Marcadores de container: dicts e sequencias nao tem handler proprio, sao
+# expandidos pela pilha explicita de to_json_safe
+_DICT = object()
+_SEQ = object()
+
+# Despacho por type(value) exato: uma consulta de dict no lugar da cadeia de
+# isinstance/hasattr. Subclasses e tipos desconhecidos caem na cadeia abaixo.
+_TO_JSON_FAST = {
+    str: _intern_short, int: _identity, float: _identity, bool: _identity, type(None): _identity,
+    datetime: _isoformat,
+    bytes: _bytes_to_json, bytearray: _bytes_to_json, memoryview: _bytes_to_json,
+    dict: _DICT,
+    list: _SEQ, tuple: _SEQ, set: _SEQ, frozenset: _SEQ, deque: _SEQ,
+}
+
+
+def _geopoint_to_json(value):
+    return {"_type": "GeoPoint", "latitude": float(value.latitude), "longitude": float(value.longitude)}
+
+
+def _docref_to_json(value):
+    return {"_type": "DocumentReference", "path": value.path}
+
+
+# Cadeia de isinstance para subclasses, montada no import so com os tipos
+# Firestore que existem neste ambiente (sem testar "X is not None" por valor)
+# (DatetimeWithNanoseconds e subclasse de datetime: o mesmo isinstance cobre os dois)
+_TO_JSON_SUBCLASS = tuple((cls, handler) for cls, handler in (
+    (datetime, _isoformat),
+    (GeoPoint, _geopoint_to_json),
+    (DocumentReference, _docref_to_json),
+) if cls is not None)
+_TO_JSON_FAST.update((cls, handler) for cls, handler in _TO_JSON_SUBCLASS if cls not in _TO_JSON_FAST)
+if DatetimeWithNanoseconds is not None:
+    _TO_JSON_FAST[DatetimeWithNanoseconds] = _isoformat
+
+
+_JSON_SCALAR_TYPES = (str, int, float, bool, type(None))
+# Sentinela para getattr: uma unica busca de atributo no lugar de hasattr + getattr
+_MISSING = object()
+
+
+def _to_json_kind(value):
+    """Handler de um valor que nao esta no despacho exato (subclasses e tipos desconhecidos)."""
+    for cls, handler in _TO_JSON_SUBCLASS:
+        if isinstance(value, cls):
+            return handler
+    lat = getattr(value, "latitude", _MISSING)
+    if lat is not _MISSING:
+        lng = getattr(value, "longitude", _MISSING)
+        if isinstance(lat, (int, float)) and isinstance(lng, (int, float)):
+            return _geopoint_to_json
+    path = getattr(value, "path", _MISSING)
+    if path is not _MISSING and getattr(value, "parent", _MISSING) is not _MISSING \
+       and getattr(value, "id", _MISSING) is not _MISSING:
+        return _docref_path_to_json
     if isinstance(value, (bytes, bytearray, memoryview)):
-        try:
-            return {"_type": "bytes", "base16": bytes(value).hex()}
-        except Exception:
-            return {"_type": "bytes", "len": len(value)}
+        return _bytes_to_json
     if isinstance(value, dict):
-        return {str(k): to_json_safe(v) for k, v in value.items()}
-    if isinstance(value, (list, tuple, set)):
-        return [to_json_safe(v) for v in list(value)]
+        return _DICT
+    if isinstance(value, (list, tuple, set, frozenset, deque)):
+        return _SEQ
+    if isinstance(value, _JSON_SCALAR_TYPES):
+        return _identity
+    return str
+
+
+def _docref_path_to_json(value):
     try:
-        json.dumps(value)
-        return value
+        return {"_type": "DocumentReference", "path": str(value.path)}
     except Exception:
         return str(value)
 
 
-def firestore_default(obj):
-    if 'GeoPoint' in obj.__class__.__name__ if hasattr(obj, '__class__') else False:
-        try:
-            lat = getattr(obj, 'latitude', None) or getattr(obj, '_latitude', None)
-            lng = getattr(obj, 'longitude', None) or getattr(obj, '_longitude', None)
-            return {"_type": "GeoPoint", "latitude": float(lat), "longitude": float(lng)}
-        except Exception:
-            return {"_type": "GeoPoint", "repr": str(obj)}
+def to_json_safe(value):
+    # Iterativo: so containers vao para a pilha (destino, valor); folhas sao
+    # convertidas no lugar, sem um frame Python por no do documento Firestore
+    fast = _TO_JSON_FAST
+    handler = fast.get(type(value)) or _to_json_kind(value)
+    if handler is not _DICT and handler is not _SEQ:
+        return handler(value)
+    root = {} if handler is _DICT else []
+    stack = [(root, value)]
+    pop, push = stack.pop, stack.append
+    while stack:
+        out, v = pop()
+        if out.__class__ is dict:
+            for k, child in v.items():
+                handler = fast.get(type(child)) or _to_json_kind(child)
+                k = _intern_short(str(k))
+                if handler is _DICT:
+                    sub = out[k] = {}
+                    push((sub, child))
+                elif handler is _SEQ:
+                    sub = out[k] = []
+                    push((sub, child))
+                else:
+                    out[k] = handler(child)
+        else:
+            append = out.append
+            for child in v:
+                handler = fast.get(type(child)) or _to_json_kind(child)
+                if handler is _DICT:
+                    sub = {}
+                    push((sub, child))
+                elif handler is _SEQ:
+                    sub = []
+                    push((sub, child))
+                else:
+                    sub = handler(child)
+                append(sub)
+    return root
+
+
+def _fd_geopoint(obj):
     try:
-        if DocumentReference and isinstance(obj, DocumentReference):
-            return {"_type": "DocumentReference", "path": obj.path}
+        lat = getattr(obj, 'latitude', _MISSING)
+        if lat is _MISSING:
+            lat = getattr(obj, '_latitude', None)
+        lng = getattr(obj, 'longitude', _MISSING)
+        if lng is _MISSING:
+            lng = getattr(obj, '_longitude', None)
+        return {"_type": "GeoPoint", "latitude": float(lat), "longitude": float(lng)}
     except Exception:
-        pass
-    if ProtoTimestamp is not None and isinstance(obj, ProtoTimestamp):
-        try:
-            return obj.ToJsonString()
-        except Exception:
-            pass
-    from datetime import datetime
-    if isinstance(obj, datetime):
-        return obj.isoformat()
-    if isinstance(obj, (bytes, bytearray, memoryview)):
-        try:
-            return {"_type": "bytes", "base16": bytes(obj).hex()}
-        except Exception:
-            return {"_type": "bytes", "len": len(obj)}
-    if isinstance(obj, (set, tuple)):
-        return list(obj)
+        return {"_type": "GeoPoint", "repr": str(obj)}
+
+
+def _fd_document_reference(obj):
+    try:
+        return {"_type": "DocumentReference", "path": obj.path}
+    except Exception:
+        return _fd_str(obj)
+
+
+def _fd_proto_timestamp(obj):
+    try:
+        return obj.ToJsonString()
+    except Exception:
+        return _fd_str(obj)
+
+
+def _fd_str(obj):
     try:
         return str(obj)
     except Exception:
         return "<unserializable>"
 
 
+def _resolve_firestore_default(t):
+    """Escolhe o handler de firestore_default para o tipo t (executado uma vez por tipo)."""
+    if t.__name__ == 'GeoPoint' or (GeoPoint is not None and issubclass(t, GeoPoint)):
+        return _fd_geopoint
+    if DocumentReference is not None and issubclass(t, DocumentReference):
+        return _fd_document_reference
+    if ProtoTimestamp is not None and issubclass(t, ProtoTimestamp):
+        return _fd_proto_timestamp
+    if issubclass(t, datetime):
+        return _isoformat
+    if issubclass(t, (bytes, bytearray, memoryview)):
+        return _bytes_to_json
+    if issubclass(t, (set, frozenset, tuple, deque)):
+        return list
+    return _fd_str
+
+
+_FD_CACHE = {}
+
+
+def firestore_default(obj):
+    t = type(obj)
+    handler = _FD_CACHE.get(t)
+    if handler is None:
+        handler = _FD_CACHE[t] = _resolve_firestore_default(t)
+    return handler(obj)
+
+
+# dumps/loads dos caminhos quentes: orjson quando disponivel, stdlib como fallback.
+# _dumps sempre devolve bytes.
+if orjson is not None:
+    def _dumps(obj):
+        return orjson.dumps(obj, default=firestore_default, option=orjson.OPT_NON_STR_KEYS)
+    _loads = orjson.loads
+else:
+    def _dumps(obj):
+        return json.dumps(obj, default=firestore_default).encode()
+    _loads = json.loads
+
+
 def safe_sample(value):
+    # to_json_safe ja devolve uma arvore serializavel; evita o dumps -> loads
     try:
-        return json.loads(json.dumps(value, default=firestore_default))
+        return to_json_safe(value)
     except Exception:
         s = str(value)
         return s[:100] + ("..." if len(s) > 100 else "")
 
 # Estatisticas diarias
+# daily_stats.json guarda o historico completo; o dia corrente vai para um arquivo
+# pequeno (daily_stats_today.json), entao cada flush grava O(1) bytes. O historico
+# so e regravado quando o dia muda (ou no primeiro flush do processo).
 DAILY_STATS_FILE = 'daily_stats.json'
-_daily_stats_data: dict = {}
+DAILY_STATS_TODAY_FILE = 'daily_stats_today.json'
+# Um dict por campo (dia -> valor): record_daily_usage faz tres atualizacoes
+# diretas em vez de buscar e alterar um dict aninhado por dia. O formato em
+# disco/API continua {dia: {'tokens', 'cost', 'calls'}}.
+_daily_tokens: dict = {}
+_daily_cost: dict = {}
+_daily_calls: dict = {}
+# Gravacao em disco com debounce: record_daily_usage so marca como sujo e
+# um timer grava no maximo a cada _STATS_FLUSH_INTERVAL segundos
+_STATS_FLUSH_INTERVAL = 2.0
+_stats_lock = threading.Lock()
+_stats_dirty = False
+_stats_flush_timer = None
+_stats_history_day = None  # dia em que o historico completo foi gravado pela ultima vez
+# Uso ainda nao enviado ao Firestore: {dia: [tokens, custo, chamadas]}, somado entre flushes
+_pending_remote_usage = {}
+# Incrementado a cada uso registrado; permite cachear respostas derivadas das estatisticas
+_stats_version = 0
+
+
+def _day_entry(day: str) -> dict:
+    return {
+        'tokens': _daily_tokens.get(day, 0),
+        'cost': _daily_cost.get(day, 0.0),
+        'calls': _daily_calls.get(day, 0),
+    }
+
+
+def _set_day(day: str, entry: dict):
+    _daily_tokens[day] = entry.get('tokens', 0)
+    _daily_cost[day] = entry.get('cost', 0.0)
+    _daily_calls[day] = entry.get('calls', 0)
+
+
+def _stats_as_dict() -> dict:
+    return {day: _day_entry(day) for day in _daily_calls}
+
+
+def _read_json_file(path):
+    """Le um JSON do disco; None se o arquivo nao existe ou esta vazio (sem tentar parsear)."""
+    try:
+        if os.path.getsize(path) == 0:
+            return None
+    except OSError:
+        return None
+    with open(path, 'rb') as f:
+        return _loads(f.read())
 
 
 def _load_daily_stats():
-    global _daily_stats_data
+    _daily_tokens.clear()
+    _daily_cost.clear()
+    _daily_calls.clear()
     try:
-        if os.path.exists(DAILY_STATS_FILE):
-            with open(DAILY_STATS_FILE, 'r') as f:
-                _daily_stats_data = json.load(f)
+        for day, entry in (_read_json_file(DAILY_STATS_FILE) or {}).items():
+            _set_day(day, entry)
     except Exception:
-        _daily_stats_data = {}
+        _daily_tokens.clear()
+        _daily_cost.clear()
+        _daily_calls.clear()
+    try:
+        today_entry = _read_json_file(DAILY_STATS_TODAY_FILE)
+        if today_entry:
+            _set_day(today_entry.pop('date'), today_entry)
+    except Exception:
+        pass
+
+
+def _write_atomic(path, payload: bytes):
+    """Grava em arquivo temporario e troca com os.replace (o JSON nunca fica pela metade)."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+    os.replace(tmp_path, path)
 
 
 def _save_daily_stats():
+    global _stats_history_day
     try:
-        with open(DAILY_STATS_FILE, 'w') as f:
-            json.dump(_daily_stats_data, f)
+        today = _today()
+        with _stats_lock:
+            history = _dumps(_stats_as_dict()) if _stats_history_day != today else None
+            today_payload = _dumps({'date': today, **_day_entry(today)})
+        if history is not None:
+            _write_atomic(DAILY_STATS_FILE, history)
+            _stats_history_day = today
+        _write_atomic(DAILY_STATS_TODAY_FILE, today_payload)
     except Exception:
         pass
 
 
+def _flush_daily_stats():
+    global _stats_dirty, _stats_flush_timer, _pending_remote_usage
+    with _stats_lock:
+        _stats_flush_timer = None
+        if not _stats_dirty:
+            return
+        _stats_dirty = False
+        remote, _pending_remote_usage = _pending_remote_usage, {}
+    _save_daily_stats()
+    for day, (tokens, cost, calls) in remote.items():
+        _save_usage_to_firestore(day, tokens, cost, calls)
+
+
+def _schedule_stats_flush():
+    """Chamar com _stats_lock adquirido."""
+    global _stats_dirty, _stats_flush_timer
+    _stats_dirty = True
+    if _stats_flush_timer is None:
+        _stats_flush_timer = threading.Timer(_STATS_FLUSH_INTERVAL, _flush_daily_stats)
+        _stats_flush_timer.daemon = True
+        _stats_flush_timer.start()
+
+
+atexit.register(_flush_daily_stats)
+
+
+_today_str = ''
+_today_until = 0.0
+
+
+def _today() -> str:
+    """Data de hoje (YYYY-MM-DD), recalculada so quando passa da meia-noite local."""
+    global _today_str, _today_until
+    if time.time() >= _today_until:
+        now = datetime.now()
+        next_midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        _today_str = now.strftime('%Y-%m-%d')
+        _today_until = next_midnight.timestamp()
+    return _today_str
+
+
+def stats_version() -> tuple:
+    """Muda sempre que as estatisticas (ou o dia corrente) mudam."""
+    return (_stats_version, _today())
+
+
+# (stats_version, dict de hoje): o mesmo dict e devolvido ate o proximo uso
+# registrado ou a virada do dia. Um dict novo por versao (em vez de alterar o
+# snapshot no lugar) para nao mudar um payload que ainda esta sendo emitido.
+_today_snapshot = (None, None)
+
+
 def get_today_stats() -> dict:
-    today = datetime.now().strftime('%Y-%m-%d')
-    d = _daily_stats_data.get(today, {})
-    return {
-        'date': today,
-        'tokens': d.get('tokens', 0),
-        'cost': d.get('cost', 0.0),
-        'calls': d.get('calls', 0),
-    }
+    """Estatisticas de hoje; tratar como somente leitura (snapshot compartilhado)."""
+    global _today_snapshot
+    version = stats_version()
+    cached_version, snapshot = _today_snapshot
+    if cached_version != version:
+        today = version[1]
+        snapshot = {'date': today, **_day_entry(today)}
+        _today_snapshot = (version, snapshot)
+    return snapshot
 
 
 def get_all_stats() -> dict:
-    return dict(_daily_stats_data)
+    return _stats_as_dict()
 
 
-def _save_usage_to_firestore(tokens: int, cost: float):
+def _save_usage_to_firestore(today: str, tokens: int, cost: float, calls: int):
     try:
         from extensions import get_db
         from google.cloud import firestore as _fs
         db = get_db()
         if not db:
             return
-        now = datetime.now()
-        today = now.strftime('%Y-%m-%d')
+        now = datetime.strptime(today, '%Y-%m-%d')
         year, week, _ = now.isocalendar()
         week_key = f'{year}-S{week:02d}'
         month_key = now.strftime('%Y-%m')
@@ -156,13 +435,13 @@ def _save_usage_to_firestore(tokens: int, cost: float):
         update_data = {
             f'diario.{today}.tokens': _fs.Increment(tokens),
             f'diario.{today}.cost': _fs.Increment(cost),
-            f'diario.{today}.calls': _fs.Increment(1),
+            f'diario.{today}.calls': _fs.Increment(calls),
             f'semanal.{week_key}.tokens': _fs.Increment(tokens),
             f'semanal.{week_key}.cost': _fs.Increment(cost),
-            f'semanal.{week_key}.calls': _fs.Increment(1),
+            f'semanal.{week_key}.calls': _fs.Increment(calls),
             f'mensal.{month_key}.tokens': _fs.Increment(tokens),
             f'mensal.{month_key}.cost': _fs.Increment(cost),
-            f'mensal.{month_key}.calls': _fs.Increment(1),
+            f'mensal.{month_key}.calls': _fs.Increment(calls),
         }
         try:
             doc_ref.update(update_data)
@@ -173,15 +452,14 @@ def _save_usage_to_firestore(tokens: int, cost: float):
         pass
 
 
-def record_daily_usage(tokens: int, cost: float):
-    today = datetime.now().strftime('%Y-%m-%d')
-    if today not in _daily_stats_data:
-        _daily_stats_data[today] = {'tokens': 0, 'cost': 0.0, 'calls': 0}
-    _daily_stats_data[today]['tokens'] += tokens
-    _daily_stats_data[today]['cost'] += cost
-    _daily_stats_data[today]['calls'] += 1
-    _save_daily_stats()
-    threading.Thread(target=_save_usage_to_firestore, args=(tokens, cost), daemon=True).start()
+# Emissao de daily_stats_update limitada a uma a cada _STATS_EMIT_INTERVAL segundos;
+# um timer de "borda final" garante que o ultimo valor sempre chega ao frontend
+_STATS_EMIT_INTERVAL = 0.1
+_last_stats_emit = 0.0
+_stats_emit_timer = None
+
+
+def _emit_daily_stats():
     try:
         from extensions import socketio
         socketio.emit('daily_stats_update', get_today_stats())
@@ -189,8 +467,107 @@ def record_daily_usage(tokens: int, cost: float):
         pass
 
 
+def _emit_daily_stats_trailing():
+    global _last_stats_emit, _stats_emit_timer
+    with _stats_lock:
+        _stats_emit_timer = None
+        _last_stats_emit = time.monotonic()
+    _emit_daily_stats()
+
+
+def _schedule_stats_emit():
+    global _last_stats_emit, _stats_emit_timer
+    with _stats_lock:
+        if _stats_emit_timer is not None:
+            return
+        now = time.monotonic()
+        wait = _STATS_EMIT_INTERVAL - (now - _last_stats_emit)
+        if wait > 0:
+            _stats_emit_timer = threading.Timer(wait, _emit_daily_stats_trailing)
+            _stats_emit_timer.daemon = True
+            _stats_emit_timer.start()
+            return
+        _last_stats_emit = now
+    _emit_daily_stats()
+
+
+def record_daily_usage(tokens: int, cost: float):
+    global _stats_version
+    today = _today()
+    with _stats_lock:
+        _stats_version += 1
+        _daily_tokens[today] = _daily_tokens.get(today, 0) + tokens
+        _daily_cost[today] = _daily_cost.get(today, 0.0) + cost
+        _daily_calls[today] = _daily_calls.get(today, 0) + 1
+        pending = _pending_remote_usage.setdefault(today, [0, 0.0, 0])
+        pending[0] += tokens
+        pending[1] += cost
+        pending[2] += 1
+        _schedule_stats_flush()
+    _schedule_stats_emit()
+
+
 _load_daily_stats()
 
+# ============================================================
+# Emissao de logs em lote
+# ============================================================
+# Entradas de log acumuladas por evento e enviadas juntas ('<evento>_batch')
+# a cada _LOG_EMIT_INTERVAL segundos, em vez de um emit por linha
+_LOG_EMIT_INTERVAL = 0.1
+_pending_logs = {}
+_pending_progress = {}
+_pending_logs_lock = threading.Lock()
+_log_emit_timer = None
+# Notificado a cada emit de progresso (acorda os streams SSE de /stream)
+progress_changed = threading.Condition()
+
+
+def _flush_log_emits():
+    global _pending_logs, _pending_progress, _log_emit_timer
+    with _pending_logs_lock:
+        pending, _pending_logs = _pending_logs, {}
+        progress, _pending_progress = _pending_progress, {}
+        _log_emit_timer = None
+    try:
+        from extensions import socketio
+        for event, entries in pending.items():
+            socketio.emit(f'{event}_batch', entries)
+        for event, state in progress.items():
+            socketio.emit(event, {
+                'progress': state['progress'],
+                'current_product': state['current_product'],
+            })
+    except Exception:
+        pass
+    if progress:
+        with progress_changed:
+            progress_changed.notify_all()
+
+
+def _schedule_log_flush():
+    """Deve ser chamado com _pending_logs_lock."""
+    global _log_emit_timer
+    if _log_emit_timer is None:
+        _log_emit_timer = threading.Timer(_LOG_EMIT_INTERVAL, _flush_log_emits)
+        _log_emit_timer.daemon = True
+        _log_emit_timer.start()
+
+
+def queue_log_emit(event: str, entry: dict):
+    with _pending_logs_lock:
+        _pending_logs.setdefault(event, []).append(entry)
+        _schedule_log_flush()
+
+
+def queue_progress_emit(event: str, state: dict):
+    """Agenda o emit do progresso do estado; varias chamadas no mesmo intervalo
+    viram um unico emit com os valores mais recentes."""
+    with _pending_logs_lock:
+        _pending_progress[event] = state
+        _schedule_log_flush()
+
+
 # ============================================================
 # Backup de produtos
 # ============================================================
@@ -231,7 +608,73 @@ def _cleanup_backups(automation: str, keep: int = 10):
         pass
 
 
+def chunked(items, size: int):
+    """Itera em listas de ate `size` itens sem fatiar tudo de antemao."""
+    it = iter(items)
+    return iter(lambda: list(islice(it, size)), [])
+
+
+def reset_progress(progress: dict, total: int = 0) -> dict:
+    """Zera os contadores de progresso no proprio dict (mesmas chaves, sem realocar)."""
+    for key in progress:
+        progress[key] = 0.0 if key == 'estimated_cost' else 0
+    progress['total'] = total
+    return progress
+
+
+class LRUDict(OrderedDict):
+    """dict limitado a `maxsize` entradas; leituras renovam a entrada e a
+    gravacao alem do limite descarta a usada ha mais tempo."""
+
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+        self._lru_lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lru_lock:
+            if key not in self:
+                return default
+            self.move_to_end(key)
+            return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        with self._lru_lock:
+            super().__setitem__(key, value)
+            self.move_to_end(key)
+            while len(self) > self.maxsize:
+                self.popitem(last=False)
+
+
+class LogBuffer(deque):
+    """deque com maxlen que numera cada append com um `seq` crescente (nao volta
+    a zero no clear), usado como cursor pelos clientes que buscam so os logs novos."""
+
+    def __init__(self, maxlen: int):
+        super().__init__(maxlen=maxlen)
+        self.seq = 0
+        self._seq_lock = threading.Lock()
+
+    def append(self, entry):
+        with self._seq_lock:
+            super().append(entry)
+            self.seq += 1
+
+    def since(self, cursor: int):
+        """(seq atual, entradas com numero > cursor). Cursor fora da janela
+        (antigo demais ou de outro processo) devolve tudo que ainda esta no buffer."""
+        with self._seq_lock:
+            seq, count = self.seq, len(self)
+            new = seq - cursor
+            if new == 0:
+                return seq, []
+            if new < 0 or new >= count:
+                return seq, list(self)
+            return seq, list(islice(self, count - new, count))
+
+
 # Estado globals usados pelas classes e rotas
+# Os logs sao LogBuffers (deques com maxlen): append O(1) e memoria limitada em execucoes longas
 automation_state = {
     'running': False,
     'progress': {
@@ -240,16 +683,19 @@ automation_state = {
         'tokens_used': 0, 'estimated_cost': 0.0
     },
     'current_product': None,
-    'logs': [],
-    'error_logs': []
+    'logs': LogBuffer(maxlen=500),
+    'error_logs': deque(maxlen=200)
 }
 
+STRUCTURE_CACHE_MAX = 32
+
 explorer_state = {
     'exploring': False,
     'progress': {'total_docs': 0, 'processed_docs': 0, 'collections_found': 0},
     'current_path': None,
-    'logs': [],
-    'structure_cache': {}
+    'logs': LogBuffer(maxlen=100),
+    # Resultados do explorador por caminho (arvores grandes): so os mais recentes
+    'structure_cache': LRUDict(maxsize=STRUCTURE_CACHE_MAX)
 }
 
 categorizer_state = {
@@ -259,17 +705,17 @@ categorizer_state = {
         'errors': 0, 'tokens_used': 0, 'estimated_cost': 0.0
     },
     'current_product': None,
-    'logs': []
+    'logs': LogBuffer(maxlen=200)
 }
 
 categorizer_targeted_state = {
     'running': False,
     'progress': {
         'total': 0, 'processed': 0, 'updated': 0,
-        'errors': 0, 'tokens_used': 0, 'estimated_cost': 0.0
+        'skipped': 0, 'errors': 0, 'tokens_used': 0, 'estimated_cost': 0.0
     },
     'current_product': None,
-    'logs': []
+    'logs': LogBuffer(maxlen=200)
 }
 
 tagger_state = {
@@ -279,13 +725,16 @@ tagger_state = {
         'skipped': 0, 'errors': 0, 'tokens_used': 0, 'estimated_cost': 0.0
     },
     'current_product': None,
-    'logs': []
+    'logs': LogBuffer(maxlen=500)
 }
 
-# Undo store and lock
+# Undo store and locks
+# Limitado para nao crescer sem fim em execucoes longas (as entradas mais antigas saem primeiro)
+UNDO_MAXLEN = 10_000
 undo_store = {
-    'renamer': [],
-    'categorizer': [],
-    'categorizer_targeted': [],
+    'renamer': deque(maxlen=UNDO_MAXLEN),
+    'categorizer': deque(maxlen=UNDO_MAXLEN),
+    'categorizer_targeted': deque(maxlen=UNDO_MAXLEN),
 }
-_undo_lock = threading.Lock()
+# Um lock por bucket: renamer e categorizadores rodando juntos nao disputam o mesmo lock
+_undo_locks = {bucket: threading.Lock() for bucket in undo_store}